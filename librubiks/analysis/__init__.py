@@ -2,13 +2,13 @@ import os
 
 import numpy as np
 import torch
-from scipy.stats import entropy
+import torch.nn.functional as F
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolour
 
 from librubiks import cube
 from librubiks.model import Model
-from librubiks.utils import NullLogger, Logger
+from librubiks.utils import NullLogger, Logger, RunningMetrics
 
 try:
 	import networkx
@@ -62,33 +62,36 @@ class TrainAnalysis:
 		self.param_total_changes = list()
 
 		self.policy_entropies = list()
-		self.rollout_policy = list()
+		# Per rollout statistics are accumulated on the device and read once in `rollout`
+		self.metrics = RunningMetrics("policy_entropy", "substate_val_std")
 
 		self.log = logger
 		self.log.verbose(f"Analysis of this training was enabled. Extra analysis is done for evaluations and for first {extra_evals} rollouts")
 
-	def rollout(self, net: Model, rollout: int, value_targets: torch.Tensor):
+	def rollout(self, net: Model, rollout: int, value_targets: torch.Tensor, positions: torch.Tensor):
 		"""Saves statistics after a rollout has been performed for understanding the loss development
 
 		:param torch.nn.Model net: The current net, used for saving values and policies of first 12 states
 		:param rollout int: The rollout number. Used to determine whether it is evaluation time => check targets
 		:param torch.Tensor value_targets: Used for visualizing value change
+		:param torch.Tensor positions: Position of each state in its game, used to average the value targets at each depth
 		"""
 		# First time
 		if self.params is None: self.params = net.get_params()
 
-		# Keeping track of the entropy off on the 12-dimensional log-probability policy-output
-		entropies = [entropy(policy, axis=1) for policy in self.rollout_policy]
-		#Currently:  Mean over all games in entire rollout. Maybe we want it more fine grained later.
-		self.policy_entropies.append(np.mean( [np.nanmean(entropy) for entropy in entropies] ))
-		self.rollout_policy = list() #reset for next rollout
+		# Mean entropy of the policy output over all training batches and substate value std of ADI in this rollout
+		means = self.metrics.means()
+		self.policy_entropies.append(means["policy_entropy"])
+		self.substate_val_stds.append(means["substate_val_std"])
+		self.metrics.reset()
 
 		if rollout in self.evaluations:
 			net.eval()
 
 			# Calculating value targets
-			targets = value_targets.cpu().numpy().reshape((-1, self.depth))
-			self.avg_value_targets.append(targets.mean(axis=0))
+			positions = positions.cpu().numpy()
+			targets = np.bincount(positions, weights=value_targets.cpu().numpy(), minlength=self.depth)
+			self.avg_value_targets.append(targets / np.bincount(positions, minlength=self.depth))
 
 			# Calculating model change
 			model_change = torch.sqrt((net.get_params()-self.params)**2).mean().cpu()
@@ -105,9 +108,14 @@ class TrainAnalysis:
 
 	def ADI(self, values: torch.Tensor):
 		"""Saves statistics after a run of ADI. """
-		self.substate_val_stds.append(
-			float(values.std(dim=1).mean())
-		)
+		self.metrics.add("substate_val_std", values.std(dim=1).mean())
+
+	@torch.no_grad()
+	def batch(self, policy_pred: torch.Tensor):
+		"""Saves the mean entropy of the 12-dimensional policy output of a training batch"""
+		policy_pred = policy_pred.float()
+		entropies = -(F.softmax(policy_pred, dim=1) * F.log_softmax(policy_pred, dim=1)).sum(dim=1)
+		self.metrics.add("policy_entropy", entropies.mean())
 
 
 	def plot_substate_distributions(self, loc: str, show=False):
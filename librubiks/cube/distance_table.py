@@ -0,0 +1,95 @@
+"""
+Table of the exact distance to the solved state for all states within a number of moves of it.
+The states are stored as packed keys sorted by their hashes (see tensor_cube.pack and tensor_cube.hash_packed),
+so lookups are binary searches on the device. The table is saved as .npy files, which are memory-mapped when loaded.
+Tables can be created by running `python rundistancetable.py --depth 6 --location <folder>`
+"""
+import os
+import json
+
+import numpy as np
+import torch
+
+from librubiks import gpu
+from librubiks.utils import NullLogger
+from librubiks.cube import cube, tensor_cube
+
+
+class DistanceTable:
+
+	def __init__(self, depth: int, is2024: bool, hashes: torch.tensor, keys: torch.tensor, distances: torch.tensor):
+		"""
+		:param depth: All states within this many moves of the solved state are in the table
+		:param hashes: Sorted hashes of the packed states
+		:param keys: Packed states in the same order as the hashes
+		:param distances: int8 distances in the same order as the hashes
+		"""
+		self.depth = depth
+		self.is2024 = is2024
+		self.hashes, self.keys, self.distances = hashes, keys, distances
+
+	def __len__(self):
+		return len(self.hashes)
+
+	@classmethod
+	def build(cls, depth: int, device: torch.device=gpu, logger=NullLogger()):
+		"""
+		Finds all states within `depth` moves of the solved state by breadth first search
+		"""
+		frontier = tensor_cube.get_solved(device).unsqueeze(0)
+		seen_keys = tensor_cube.pack(frontier)
+		seen_hashes = tensor_cube.hash_packed(seen_keys)
+		seen_distances = torch.zeros(1, dtype=torch.int8, device=device)
+		for d in range(1, depth+1):
+			children = tensor_cube.multi_rotate(frontier.repeat_interleave(cube.action_dim, dim=0), *tensor_cube.iter_actions(len(frontier), device))
+			children, _ = tensor_cube.unique(children)
+			# Children that have been seen before are at a shorter distance
+			keys = tensor_cube.pack(children)
+			hashes = tensor_cube.hash_packed(keys)
+			idcs = torch.searchsorted(seen_hashes, hashes).clamp(max=len(seen_hashes)-1)
+			new = (seen_hashes[idcs] != hashes) | (seen_keys[idcs] != keys).any(dim=1)
+			frontier = children[new]
+			seen_hashes, order = torch.sort(torch.cat([seen_hashes, hashes[new]]))
+			seen_keys = torch.cat([seen_keys, keys[new]])[order]
+			seen_distances = torch.cat([seen_distances, torch.full((len(frontier),), d, dtype=torch.int8, device=device)])[order]
+			logger.verbose(f"Depth {d}: {len(frontier):,} states")
+
+		# Lookups only compare with the first state with a given hash, so all hashes must be different
+		if len(seen_hashes) > 1 and not (seen_hashes[1:] != seen_hashes[:-1]).all():
+			raise RuntimeError("Two states in the table have the same hash")
+		logger(f"Created distance table with {len(seen_hashes):,} states within {depth} moves of the solved state")
+		return cls(depth, cube.get_is2024(), seen_hashes, seen_keys, seen_distances)
+
+	def lookup(self, states: torch.tensor) -> torch.tensor:
+		"""
+		Exact distances to the solved state of the given states, which must be on the same device as the table
+		:return: int64 tensor of distances. States that are not in the table have distance -1
+		"""
+		assert self.is2024 == cube.get_is2024(), "The table is for a different representation than the one in use"
+		keys = tensor_cube.pack(states)
+		hashes = tensor_cube.hash_packed(keys)
+		idcs = torch.searchsorted(self.hashes, hashes).clamp(max=len(self)-1)
+		found = (self.hashes[idcs] == hashes) & (self.keys[idcs] == keys).all(dim=1)
+		return torch.where(found, self.distances[idcs].long(), -1)
+
+	def save(self, save_dir: str):
+		os.makedirs(save_dir, exist_ok=True)
+		with open(os.path.join(save_dir, "distance_table.json"), "w", encoding="utf-8") as f:
+			json.dump({ "depth": self.depth, "is2024": self.is2024 }, f, indent=4)
+		for name in ("hashes", "keys", "distances"):
+			np.save(os.path.join(save_dir, f"{name}.npy"), getattr(self, name).cpu().numpy())
+
+	@classmethod
+	def load(cls, load_dir: str, device: torch.device=gpu):
+		"""
+		Returns the saved table or None if it does not exist
+		On the cpu, the arrays are memory-mapped copy-on-write, so they are read from disk as needed and shared between processes
+		"""
+		path = os.path.join(load_dir, "distance_table.json")
+		if not os.path.isfile(path):
+			return None
+		with open(path, encoding="utf-8") as f:
+			meta = json.load(f)
+		arrays = [torch.from_numpy(np.load(os.path.join(load_dir, f"{name}.npy"), mmap_mode="c")).to(device)
+				  for name in ("hashes", "keys", "distances")]
+		return cls(meta["depth"], meta["is2024"], *arrays)
@@ -0,0 +1,141 @@
+"""
+Torch implementation of the parts of the cube API used to generate and expand many states at once, such as in ADI.
+States are integer tensors with the same shape and values as the numpy states in librubiks.cube, and all functions
+work on tensors on any device, so states can stay on the same device from scrambling to network input.
+As librubiks.cube, this module carries no state, and the representation is set using librubiks.cube.set_is2024.
+"""
+import functools
+import numpy as np
+import torch
+
+from librubiks import gpu
+from librubiks.cube import cube
+
+
+@functools.lru_cache()
+def _tables(is2024: bool, device: torch.device) -> dict:
+	# Lookup tables as tensors on the device. Created once for each representation and device
+	if is2024:
+		return {
+			# Flattened to 2 * 24 for each action, such that corners index the first 24 values and sides the last 24
+			"maps":   torch.from_numpy(cube._Cube2024.maps.reshape(2, 6, 48).astype(np.int64)).to(device),
+			"offset": torch.from_numpy(cube._Cube2024.corner_side_idcs * 24).to(device),
+			"oh_idcs": torch.from_numpy(cube._Cube2024.oh_idcs).to(device),
+			"solved": torch.from_numpy(cube._solved2024).to(device),
+			"pack_shifts": torch.arange(10, device=device) * 5,
+		}
+	# In the 6x8x6 representation, each action permutes the 48 stickers
+	# The permutation is found by rotating a state where each sticker is its own index
+	stickers = np.arange(48).reshape(6, 8, 1)
+	perms = np.array([[cube._Cube686.rotate(stickers, face, direction).ravel() for face in range(6)] for direction in range(2)])
+	return {
+		"perms":  torch.from_numpy(perms).to(device),
+		"solved": torch.from_numpy(cube._solved686).to(device),
+		"pack_shifts": torch.arange(16, device=device) * 3,
+	}
+
+_hash_multiplier = -7046029254386353131  # 0x9E3779B97F4A7C15 as a signed 64 bit integer
+
+def _get_tables(device: torch.device) -> dict:
+	return _tables(cube.get_is2024(), torch.device(device))
+
+def get_solved(device: torch.device=gpu) -> torch.tensor:
+	return _get_tables(device)["solved"].clone()
+
+def is_solved(state: torch.tensor) -> bool:
+	return bool((state == _get_tables(state.device)["solved"]).all())
+
+def multi_is_solved(states: torch.tensor) -> torch.tensor:
+	return (states == _get_tables(states.device)["solved"]).flatten(1).all(dim=1)
+
+def rotate(state: torch.tensor, face: int, direction: int) -> torch.tensor:
+	"""
+	Performs one move on the cube, specified by the side (0-5),
+	and whether the rotation is in a positive direction (0 for negative and 1 for positive)
+	"""
+	faces = torch.tensor([face], device=state.device)
+	return multi_rotate(state.unsqueeze(0), faces, torch.tensor([direction], device=state.device))[0]
+
+def multi_rotate(states: torch.tensor, faces: torch.tensor, directions: torch.tensor) -> torch.tensor:
+	# Performs action (faces[i], directions[i]) on states[i]
+	tables = _get_tables(states.device)
+	faces = torch.as_tensor(faces, device=states.device).long()
+	directions = torch.as_tensor(directions, device=states.device).long()
+	if cube.get_is2024():
+		maps = tables["maps"][directions, faces]
+		return states + maps.gather(1, tables["offset"] + states.long()).to(states.dtype)
+	perms = tables["perms"][directions, faces]
+	stickers = states.reshape(len(states), 48, 6)
+	return stickers.gather(1, perms.unsqueeze(2).expand(-1, -1, 6)).reshape(states.shape)
+
+def as_oh(states: torch.tensor) -> torch.tensor:
+	# Takes in n states and returns an n x 480 or n x 288 one-hot tensor on the same device
+	if cube.get_is2024():
+		states = states.reshape(-1, 20)
+		oh = torch.zeros(len(states), 480, device=states.device)
+		return oh.scatter_(1, _get_tables(states.device)["oh_idcs"] + states.long(), 1)
+	return states.reshape(-1, 288).float()
+
+def pack(states: torch.tensor) -> torch.tensor:
+	"""
+	Packs n states into an n x k integer tensor, such that two states are equal iff. their rows are equal
+	In the 20x24 representation, each row is two words of ten 5 bit values. In the 6x8x6 representation,
+	the colour of each of the 48 stickers takes up 3 bits, giving three words of 16 stickers
+	"""
+	shifts = _get_tables(states.device)["pack_shifts"]
+	if cube.get_is2024():
+		values = states.reshape(-1, 2, 10).long()
+	else:
+		values = states.reshape(-1, 3, 16, 6).argmax(dim=3)
+	return (values << shifts).sum(dim=2)
+
+def hash_packed(keys: torch.tensor) -> torch.tensor:
+	# Hashes packed states from `pack` to single integers. Different states can have the same hash, though it is very unlikely
+	hashes = keys[:, 0]
+	for i in range(1, keys.shape[1]):
+		hashes = hashes * _hash_multiplier + keys[:, i]  # Overflows wrap around
+	return hashes
+
+def unique(states: torch.tensor) -> (torch.tensor, torch.tensor):
+	"""
+	Finds the unique states in no particular order, such that unique_states[inverse] == states
+	The packed rows are hashed to single integers, which are much faster to sort than rows. The result is checked against
+	the packed rows, and in the unlikely case of a hash collision, the rows are sorted instead
+	"""
+	keys = pack(states)
+	hashes = hash_packed(keys)
+	unique_hashes, inverse = torch.unique(hashes, return_inverse=True)
+	# Any occurrence of each hash can represent it
+	first = torch.empty(len(unique_hashes), dtype=torch.long, device=states.device)
+	first.scatter_(0, inverse, torch.arange(len(states), device=states.device))
+	if not (keys[first][inverse] == keys).all():
+		_, inverse = torch.unique(keys, dim=0, return_inverse=True)
+		first = torch.empty(int(inverse.max()) + 1, dtype=torch.long, device=states.device)
+		first.scatter_(0, inverse, torch.arange(len(states), device=states.device))
+	return states[first], inverse
+
+def iter_actions(n: int=1, device: torch.device=gpu) -> (torch.tensor, torch.tensor):
+	"""
+	Returns faces and directions of all actions tiled n times
+	Practical for use with multi_rotate, e.g. multi_rotate(states.repeat_interleave(action_dim, dim=0), *iter_actions(len(states)))
+	"""
+	actions = torch.arange(cube.action_dim, device=device).repeat(n)
+	# Same order as cube.action_space, where the positive direction comes first for each face
+	return actions // 2, 1 - actions % 2
+
+def sequence_scrambler(games: int, depth: int, with_solved: bool, device: torch.device=gpu) -> (torch.tensor, torch.tensor):
+	"""
+	Same as librubiks.cube.sequence_scrambler, but the states are generated on the device
+	Returns a (games * depth) x *Cube shape tensor of states and their one-hot representations
+	:with_solved: Whether to include the solved cube in the sequence
+	"""
+	current_states = get_solved(device).expand(games, *cube.shape())
+	states = torch.empty(games, depth, *cube.shape(), dtype=current_states.dtype, device=device)
+	faces = torch.randint(0, 6, (depth, games), device=device)
+	dirs = torch.randint(0, 2, (depth, games), device=device)
+	if with_solved: states[:, 0] = current_states
+	for d in range(depth - with_solved):
+		current_states = multi_rotate(current_states, faces[d], dirs[d])
+		states[:, d + with_solved] = current_states
+	states = states.reshape(games * depth, *cube.shape())
+	return states, as_oh(states)
@@ -0,0 +1,232 @@
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+import torch
+import torch.nn.functional as F
+
+from librubiks import gpu, no_grad, reset_cuda, rc_params
+from librubiks.utils import Logger, NullLogger, unverbose, TickTock, TimeUnit, RunningMetrics
+
+from librubiks import cube
+from librubiks.cube import tensor_cube
+from librubiks.model import Model
+from librubiks.train import MinibatchSampler
+
+from librubiks.solving.agents import DeepAgent
+from librubiks.solving.evaluation import Evaluator
+plt.rcParams.update(rc_params)
+
+class Distill:
+	"""
+	Knowledge distillation: Trains a small student network to match the policy and value outputs of a larger teacher network.
+	The states are generated in the same way as in ADI, so the student learns the heuristic on the states seen during search.
+	"""
+
+	states_per_rollout: int
+
+	train_rollouts: np.ndarray
+	policy_losses: np.ndarray
+	value_losses: np.ndarray
+	train_losses: np.ndarray
+	sol_percents: list
+
+	teacher_ff_size = 10_000  # Maximum number of states in each feedforward of the teacher
+
+	def __init__(self,
+				 rollouts: int,
+				 batch_size: int,
+				 rollout_games: int,
+				 rollout_depth: int,
+				 optim_fn,
+				 lr: float,
+				 temperature: float,
+				 agent: DeepAgent,
+				 evaluator: Evaluator,
+				 evaluation_interval: int,
+				 logger: Logger = NullLogger(),
+				 ):
+		"""
+		:param float temperature: Temperature of the teacher and student policy softmaxes in the policy loss.
+			Higher values put more weight on the relative probabilities of the less likely actions
+		"""
+		self.rollouts = rollouts
+		self.train_rollouts = np.arange(self.rollouts)
+		self.batch_size = batch_size
+		self.rollout_games = rollout_games
+		self.rollout_depth = rollout_depth
+		self.states_per_rollout = self.rollout_games * self.rollout_depth
+
+		self.optim = optim_fn
+		self.lr = lr
+		self.temperature = temperature
+
+		self.agent = agent
+		self.evaluator = evaluator
+		# Evaluations are performed every evaluation_interval rollouts and after the last rollout
+		self.evaluation_rollouts = np.unique(np.append(np.arange(evaluation_interval-1, self.rollouts, evaluation_interval), self.rollouts-1))\
+			if evaluation_interval else np.array([])
+
+		self.log = logger
+		self.log("\n".join([
+			"Created distiller",
+			f"Optimizer:      {self.optim}",
+			f"Learning rate:  {self.lr}",
+			f"Temperature:    {self.temperature}",
+			f"Rollouts:       {self.rollouts}",
+			f"Batch size:     {self.batch_size}",
+			f"Rollout games:  {self.rollout_games}",
+			f"Rollout depth:  {self.rollout_depth}",
+		]))
+
+		self.tt = TickTock()
+
+	def distill(self, teacher: Model, student: Model) -> (Model, Model):
+		"""
+		Trains the student to match the teacher for `self.rollouts` rollouts, each on newly generated states.
+		The student is evaluated for each rollout number in `self.evaluation_rollouts` according to `self.evaluator`.
+		:return: The student after all rollouts and the student with the best evaluation score
+		"""
+		self.tt.reset()
+		self.tt.tick()
+		self.log(f"Beginning distillation. Optimization is performed in batches of {self.batch_size}")
+		teacher.eval()
+		best_solve = 0
+		best_student = student.clone()
+
+		optimizer = self.optim(student.parameters(), lr=self.lr)
+		self.policy_losses = np.empty(self.rollouts)
+		self.value_losses = np.empty(self.rollouts)
+		self.train_losses = np.empty(self.rollouts)
+		self.sol_percents = list()
+
+		for rollout in range(self.rollouts):
+			reset_cuda()
+
+			self.tt.profile("Teacher targets")
+			oh_states, policy_targets, value_targets = self.teacher_targets(teacher)
+			self.tt.end_profile("Teacher targets")
+
+			self.tt.profile("Training loop")
+			student.train()
+			sampler = MinibatchSampler(self.batch_size)
+			# The losses are summed on the device, so the loop does not wait for each batch to finish
+			metrics = RunningMetrics("policy_loss", "value_loss")
+			for states_batch, policy_batch, value_batch in sampler(oh_states, policy_targets, value_targets):
+				optimizer.zero_grad()
+				policy_pred, value_pred = student(states_batch, policy=True, value=True)
+				policy_loss, value_loss = self.loss(policy_pred, value_pred, policy_batch, value_batch)
+				loss = policy_loss + value_loss
+				loss.backward()
+				optimizer.step()
+				metrics.add("policy_loss", policy_loss)
+				metrics.add("value_loss", value_loss)
+			means = metrics.means()
+			self.policy_losses[rollout], self.value_losses[rollout] = means["policy_loss"], means["value_loss"]
+			self.train_losses[rollout] = self.policy_losses[rollout] + self.value_losses[rollout]
+			self.tt.end_profile("Training loop")
+
+			if self.log.is_verbose() or rollout in (np.linspace(0, 1, 20)*self.rollouts).astype(int):
+				self.log(f"Rollout {rollout} completed with mean loss {self.train_losses[rollout]}")
+
+			if rollout in self.evaluation_rollouts:
+				student.eval()
+				self.agent.net = student
+				self.tt.profile(f"Evaluating using agent {self.agent}")
+				with unverbose:
+					eval_results, _, _ = self.evaluator.eval(self.agent)
+				eval_reward = (eval_results != -1).mean()
+				self.sol_percents.append(eval_reward)
+				self.tt.end_profile(f"Evaluating using agent {self.agent}")
+
+				if eval_reward > best_solve:
+					best_solve = eval_reward
+					best_student = student.clone()
+					self.log(f"Updated best student with solve rate {eval_reward*100:.2f} % at depth {self.evaluator.scrambling_depths}")
+
+		self.log.section("Finished distillation")
+		if len(self.evaluation_rollouts):
+			self.log(f"Best student solves {best_solve*100:.2f} % of games at depth {self.evaluator.scrambling_depths}")
+		self.log(f"Total running time: {self.tt.stringify_time(self.tt.tock(), TimeUnit.second)}")
+		self.log.verbose(self.tt)
+		self.log_speedup(teacher, student.eval())
+
+		return student, best_student
+
+	@no_grad
+	def teacher_targets(self, teacher: Model) -> (torch.tensor, torch.tensor, torch.tensor):
+		"""
+		Generates states in the same way as ADI and computes the teacher outputs on them
+		:return: One-hot states, policy probabilities at `self.temperature`, and values
+		"""
+		_, oh_states = tensor_cube.sequence_scrambler(self.rollout_games, self.rollout_depth, with_solved=False, device=gpu)
+		policy_parts, value_parts = list(), list()
+		for i in range(0, len(oh_states), self.teacher_ff_size):
+			policy, value = teacher(oh_states[i:i+self.teacher_ff_size], policy=True, value=True)
+			policy_parts.append(F.softmax(policy / self.temperature, dim=1))
+			value_parts.append(value.squeeze(1))
+		return oh_states, torch.cat(policy_parts), torch.cat(value_parts)
+
+	def loss(self, policy_pred: torch.tensor, value_pred: torch.tensor, policy_targets: torch.tensor, value_targets: torch.tensor)\
+			-> (torch.tensor, torch.tensor):
+		"""
+		The policy loss is the cross entropy between the softened teacher and student policies scaled by temperature^2,
+		so its gradients are independent of the temperature. The value loss is the mean squared error
+		"""
+		log_probs = F.log_softmax(policy_pred / self.temperature, dim=1)
+		policy_loss = -(policy_targets * log_probs).sum(dim=1).mean() * self.temperature ** 2
+		value_loss = F.mse_loss(value_pred.squeeze(1), value_targets)
+		return policy_loss, value_loss
+
+	@no_grad
+	def log_speedup(self, teacher: Model, student: Model, batch_size: int=1200, repeats: int=10):
+		# Logs how many times faster the student feedforward is than the teacher at a batch size as used by AStar
+		oh_states = cube.as_oh(np.array([cube.scramble(10)[0] for _ in range(batch_size)]))
+		times = list()
+		for net in (teacher, student):
+			net(oh_states, policy=False)
+			self.tt.tick()
+			for _ in range(repeats): net(oh_states, policy=False)
+			times.append(self.tt.tock())
+		self.log(f"Value feedforward of {batch_size} states: Teacher {times[0]/repeats*1000:.2f} ms, student {times[1]/repeats*1000:.2f} ms. "
+				 f"Student is {times[0]/times[1]:.2f} times faster")
+
+	def plot_distillation(self, save_dir: str, name: str, show=False):
+		"""
+		Visualizes distillation by showing the losses and evaluation solve rates in the same plot
+		"""
+		self.log("Making plot of distillation")
+		fig, loss_ax = plt.subplots(figsize=(23, 10))
+
+		colour = "red"
+		loss_ax.set_ylabel("Distillation loss")
+		loss_ax.plot(self.train_rollouts, self.train_losses,  linewidth=3,                      color=colour,   label="Distillation loss")
+		loss_ax.plot(self.train_rollouts, self.policy_losses, linewidth=2, linestyle="dashdot", color="orange", label="Policy loss")
+		loss_ax.plot(self.train_rollouts, self.value_losses,  linewidth=2, linestyle="dashed",  color="green",  label="Value loss")
+		loss_ax.tick_params(axis='y', labelcolor=colour)
+		loss_ax.set_xlabel(f"Rollout, each of {TickTock.thousand_seps(self.states_per_rollout)} states")
+		h1, l1 = loss_ax.get_legend_handles_labels()
+
+		if len(self.evaluation_rollouts):
+			color = 'blue'
+			reward_ax = loss_ax.twinx()
+			reward_ax.set_ylim([-5, 105])
+			reward_ax.set_ylabel("Solve rate [%]")
+			reward_ax.plot(self.evaluation_rollouts, np.array(self.sol_percents)*100, "-o", color=color, label="Student performance")
+			reward_ax.tick_params(axis='y', labelcolor=color)
+			h2, l2 = reward_ax.get_legend_handles_labels()
+			h1 += h2
+			l1 += l2
+		loss_ax.legend(h1, l1, loc=2)
+
+		plt.title(f"Distillation - {TickTock.thousand_seps(self.rollouts*self.states_per_rollout)} states")
+		fig.tight_layout()
+		plt.grid(True)
+
+		os.makedirs(save_dir, exist_ok=True)
+		path = os.path.join(save_dir, f"distillation_{name}.png")
+		plt.savefig(path)
+		self.log(f"Saved loss and evaluation plot to {path}")
+
+		if show: plt.show()
+		plt.clf()
@@ -7,11 +7,15 @@ import json
 import numpy as np
 import torch
 
+from librubiks import cube
 from librubiks.cube import get_is2024, with_used_repr, store_repr, restore_repr, set_is2024
 from librubiks.utils import get_commit, Logger
 
-from librubiks.model import Model, ModelConfig
+from librubiks.model import Model, ModelConfig, InferenceProfile
+from librubiks.cube.distance_table import DistanceTable
 from librubiks.train import Train
+from librubiks.distill import Distill
+from librubiks.prune import Prune
 
 from librubiks.solving import agents
 from librubiks.solving.agents import PolicySearch, ValueSearch, DeepAgent, Agent
@@ -43,6 +47,15 @@ class TrainJob:
 				 arch: str,
 				 analysis: bool,
 				 reward_method: str,
+				 inference_profile: str,
+				 mixed_precision: bool,
+				 workers: int,
+				 epochs: int,
+				 async_evaluation: bool,
+				 checkpoint_interval: int,
+				 resume: bool,
+				 distance_table: str,
+				 depth_curriculum: bool,
 
 				 # Currently not set by argparser/configparser
 				 agent = PolicySearch(net=None),
@@ -76,7 +89,9 @@ class TrainJob:
 		assert issubclass(self.optim_fn, torch.optim.Optimizer)
 
 		self.location = location
-		self.logger = Logger(f"{self.location}/train.log", name, verbose) #Already creates logger at init to test whether path works
+		self.resume = resume
+		assert isinstance(self.resume, bool)
+		self.logger = Logger(f"{self.location}/train.log", name, verbose, append=self.resume) #Already creates logger at init to test whether path works
 		self.logger.log(f"Initialized {self.name}")
 
 		self.evaluator = Evaluator(n_games=self.eval_games, max_time=self.max_time, scrambling_depths=scrambling_depths, logger=self.logger)
@@ -96,7 +111,27 @@ class TrainJob:
 		self.reward_method = reward_method
 		assert self.reward_method in ["paper", "lapanfix", "schultzfix", "reward0"]
 
-		assert arch in ["fc_small", "fc_big", "res_small", "res_big", "conv"]
+		self.inference_profile = InferenceProfile.load(inference_profile) if inference_profile else None
+		assert self.inference_profile is not None or not inference_profile, f"No inference profile found in {inference_profile}"
+		self.mixed_precision = mixed_precision
+		assert isinstance(self.mixed_precision, bool)
+		self.workers = workers
+		assert isinstance(self.workers, int) and self.workers > 0
+		assert self.rollout_games % self.workers == 0 and self.batch_size % self.workers == 0,\
+			f"rollout_games and batch_size must be divisible by the number of workers, {self.workers}"
+		self.epochs = epochs
+		assert isinstance(self.epochs, int) and self.epochs > 0
+		self.async_evaluation = async_evaluation
+		assert isinstance(self.async_evaluation, bool)
+		self.checkpoint_interval = checkpoint_interval
+		assert isinstance(self.checkpoint_interval, int) and 0 <= self.checkpoint_interval
+		self.distance_table = DistanceTable.load(distance_table) if distance_table else None
+		assert self.distance_table is not None or not distance_table, f"No distance table found in {distance_table}"
+		assert self.distance_table is None or self.distance_table.is2024 == is2024, "The distance table is for a different representation"
+		self.depth_curriculum = depth_curriculum
+		assert isinstance(self.depth_curriculum, bool)
+
+		assert arch in ["fc_tiny", "fc_small", "fc_big", "res_small", "res_big", "conv"]
 		if arch == "conv": assert not self.is2024
 		assert isinstance(self.model_cfg, ModelConfig)
 
@@ -122,11 +157,20 @@ class TrainJob:
 					  evaluation_interval	= self.evaluation_interval,
 					  evaluator				= self.evaluator,
 					  with_analysis			= self.analysis,
+					  inference_profile		= self.inference_profile,
+					  mixed_precision		= self.mixed_precision,
+					  workers				= self.workers,
+					  epochs				= self.epochs,
+					  async_evaluation		= self.async_evaluation,
+					  checkpoint_interval	= self.checkpoint_interval,
+					  checkpoint_dir		= self.location,
+					  distance_table		= self.distance_table,
+					  depth_curriculum		= self.depth_curriculum,
 					  )
 		self.logger(f"Rough upper bound on total evaluation time during training: {len(train.evaluation_rollouts)*self.evaluator.approximate_time()/60:.2f} min")
 
 		net = Model.create(self.model_cfg, self.logger)
-		net, min_net = train.train(net)
+		net, min_net = train.train(net, resume=self.resume)
 		net.save(self.location)
 		if self.evaluation_interval:
 			min_net.save(self.location, True)
@@ -134,8 +178,8 @@ class TrainJob:
 		train.plot_training(self.location, name=self.name)
 		analysispath = os.path.join(self.location, "analysis")
 		datapath = os.path.join(self.location, "train-data")
-		os.mkdir(datapath)
-		os.mkdir(analysispath)
+		os.makedirs(datapath, exist_ok=True)
+		os.makedirs(analysispath, exist_ok=True)
 
 		if self.analysis:
 			train.analysis.plot_substate_distributions(analysispath)
@@ -150,6 +194,8 @@ class TrainJob:
 		np.save(f"{datapath}/policy_losses.npy", train.policy_losses)
 		np.save(f"{datapath}/value_losses.npy", train.value_losses)
 		np.save(f"{datapath}/losses.npy", train.train_losses)
+		np.save(f"{datapath}/dedup_ratios.npy", train.dedup_ratios)
+		np.save(f"{datapath}/depth_shares.npy", train.depth_shares)
 		np.save(f"{datapath}/evaluation_rollouts.npy", train.evaluation_rollouts)
 		np.save(f"{datapath}/evaluations.npy", train.sol_percents)
 
@@ -170,6 +216,281 @@ class TrainJob:
 		return content
 
 
+class DistillJob:
+	eval_games = 200
+	max_time = 0.05
+	is2024: bool
+
+	def __init__(self,
+				 name: str,
+				 # Set by parser, should correspond to options in rundistill
+				 location: str,
+				 teacher: str,
+				 use_best: bool,
+				 arch: str,
+				 rollouts: int,
+				 rollout_games: int,
+				 rollout_depth: int,
+				 batch_size: int,
+				 optim_fn: str,
+				 lr: float,
+				 temperature: float,
+				 evaluation_interval: int,
+				 nn_init: str,
+
+				 # Currently not set by argparser/configparser
+				 agent = PolicySearch(net=None),
+				 scrambling_depths: tuple = (10,),
+				 verbose: bool = True,
+			):
+		self.name = name
+		assert isinstance(self.name, str)
+
+		self.rollouts = rollouts
+		assert self.rollouts > 0
+		self.rollout_games = rollout_games
+		assert self.rollout_games > 0
+		self.rollout_depth = rollout_depth
+		assert rollout_depth > 0
+		self.batch_size = batch_size
+		assert 0 < self.batch_size <= self.rollout_games * self.rollout_depth
+		self.lr = lr
+		assert float(lr) and lr <= 1
+		self.temperature = temperature
+		assert temperature > 0
+		self.optim_fn = getattr(torch.optim, optim_fn)
+		assert issubclass(self.optim_fn, torch.optim.Optimizer)
+
+		self.teacher = teacher
+		self.use_best = use_best
+		assert os.path.isfile(os.path.join(self.teacher, "model.pt")), f"No model.pt found in teacher location {self.teacher}"
+		with open(os.path.join(self.teacher, "config.json"), encoding="utf-8") as f:
+			self.is2024 = json.load(f)["is2024"]
+
+		self.location = location
+		self.logger = Logger(f"{self.location}/distill.log", name, verbose)
+		self.logger.log(f"Initialized {self.name}")
+
+		self.evaluator = Evaluator(n_games=self.eval_games, max_time=self.max_time, scrambling_depths=scrambling_depths, logger=self.logger)
+		self.evaluation_interval = evaluation_interval
+		assert isinstance(self.evaluation_interval, int) and 0 <= self.evaluation_interval
+		self.agent = agent
+		assert isinstance(self.agent, DeepAgent)
+
+		assert arch in ["fc_tiny", "fc_small", "fc_big", "res_small", "res_big", "conv"]
+		if arch == "conv": assert not self.is2024
+		assert nn_init in ["glorot", "he"] or ( float(nn_init) or True ),\
+				f"Initialization must be glorot, he or a number, but was {nn_init}"
+		self.model_cfg = ModelConfig(architecture=arch, is2024=self.is2024, init=nn_init)
+
+	@with_used_repr
+	def execute(self):
+		self.logger.section(f"Starting distillation job:\n{self.name} with teacher {self.teacher}\nLocation {self.location}\nCommit: {get_commit()}")
+
+		distill = Distill(self.rollouts,
+						  batch_size			= self.batch_size,
+						  rollout_games			= self.rollout_games,
+						  rollout_depth			= self.rollout_depth,
+						  optim_fn				= self.optim_fn,
+						  lr					= self.lr,
+						  temperature			= self.temperature,
+						  agent					= self.agent,
+						  evaluator				= self.evaluator,
+						  evaluation_interval	= self.evaluation_interval,
+						  logger				= self.logger,
+						  )
+		teacher = Model.load(self.teacher, load_best=self.use_best)
+		student = Model.create(self.model_cfg, self.logger)
+		student, best_student = distill.distill(teacher, student)
+		# Saved in the same layout as trained models, so they can be used by all agents
+		student.save(self.location)
+		if self.evaluation_interval:
+			best_student.save(self.location, True)
+
+		distill.plot_distillation(self.location, name=self.name)
+		datapath = os.path.join(self.location, "train-data")
+		os.makedirs(datapath, exist_ok=True)
+		np.save(f"{datapath}/rollouts.npy", distill.train_rollouts)
+		np.save(f"{datapath}/policy_losses.npy", distill.policy_losses)
+		np.save(f"{datapath}/value_losses.npy", distill.value_losses)
+		np.save(f"{datapath}/losses.npy", distill.train_losses)
+		np.save(f"{datapath}/evaluation_rollouts.npy", distill.evaluation_rollouts)
+		np.save(f"{datapath}/evaluations.npy", distill.sol_percents)
+
+		return distill.train_rollouts, distill.train_losses
+
+
+class PruneJob:
+	eval_games = 200
+	max_time = 0.05
+	is2024: bool
+
+	def __init__(self,
+				 name: str,
+				 # Set by parser, should correspond to options in runprune
+				 location: str,
+				 model: str,
+				 use_best: bool,
+				 amounts: list,
+				 rollouts: int,
+				 rollout_games: int,
+				 rollout_depth: int,
+				 batch_size: int,
+				 optim_fn: str,
+				 lr: float,
+				 reward_method: str,
+				 latency_batch_size: int,
+
+				 # Currently not set by argparser/configparser
+				 agent = PolicySearch(net=None),
+				 scrambling_depths: tuple = (10,),
+				 verbose: bool = True,
+			):
+		self.name = name
+		assert isinstance(self.name, str)
+
+		self.amounts = amounts
+		assert all(0 < amount < 1 for amount in self.amounts), f"Pruning amounts must be in ]0, 1[, but were {self.amounts}"
+		self.rollouts = rollouts
+		assert self.rollouts >= 0
+		self.rollout_games = rollout_games
+		assert self.rollout_games > 0
+		self.rollout_depth = rollout_depth
+		assert rollout_depth > 0
+		self.batch_size = batch_size
+		assert 0 < self.batch_size <= self.rollout_games * self.rollout_depth
+		self.lr = lr
+		assert float(lr) and lr <= 1
+		self.optim_fn = getattr(torch.optim, optim_fn)
+		assert issubclass(self.optim_fn, torch.optim.Optimizer)
+		self.reward_method = reward_method
+		assert self.reward_method in ["paper", "lapanfix", "schultzfix", "reward0"]
+		self.latency_batch_size = latency_batch_size
+		assert self.latency_batch_size > 0
+
+		self.model = model
+		self.use_best = use_best
+		assert os.path.isfile(os.path.join(self.model, "model.pt")), f"No model.pt found in model location {self.model}"
+		with open(os.path.join(self.model, "config.json"), encoding="utf-8") as f:
+			config = json.load(f)
+		self.is2024 = config["is2024"]
+		assert config["architecture"].startswith("fc"), f"Only fully connected architectures can be pruned, but the model is {config['architecture']}"
+
+		self.location = location
+		self.logger = Logger(f"{self.location}/prune.log", name, verbose)
+		self.logger.log(f"Initialized {self.name}")
+
+		self.evaluator = Evaluator(n_games=self.eval_games, max_time=self.max_time, scrambling_depths=scrambling_depths, logger=self.logger)
+		self.agent = agent
+		assert isinstance(self.agent, DeepAgent)
+
+	@with_used_repr
+	def execute(self):
+		self.logger.section(f"Starting pruning job:\n{self.name} with model {self.model}\nLocation {self.location}\nCommit: {get_commit()}")
+
+		prune = Prune(self.amounts,
+					  rollouts				= self.rollouts,
+					  batch_size			= self.batch_size,
+					  rollout_games			= self.rollout_games,
+					  rollout_depth			= self.rollout_depth,
+					  optim_fn				= self.optim_fn,
+					  lr					= self.lr,
+					  reward_method			= self.reward_method,
+					  agent					= self.agent,
+					  evaluator				= self.evaluator,
+					  latency_batch_size	= self.latency_batch_size,
+					  logger				= self.logger,
+					  )
+		model = Model.load(self.model, load_best=self.use_best)
+		pruned_models = prune.prune(model)
+		# Each pruned model is saved in a subfolder in the same layout as trained models, so they can be evaluated using runeval
+		for amount, pruned in zip(prune.amounts[1:], pruned_models[1:]):
+			pruned.save(os.path.join(self.location, f"pruned-{amount*100:.0f}"))
+
+		prune.plot_pruning(self.location, name=self.name)
+		with open(os.path.join(self.location, "pruning.json"), "w", encoding="utf-8") as f:
+			json.dump({
+				"amounts":      prune.amounts.tolist(),
+				"shared_sizes": [m.config.shared_sizes for m in pruned_models],
+				"part_sizes":   [m.config.part_sizes for m in pruned_models],
+				"n_params":     prune.n_params.tolist(),
+				"latencies":    prune.latencies.tolist(),
+				"sol_percents": prune.sol_percents.tolist(),
+			}, f, indent=4)
+
+		return prune.latencies, prune.sol_percents
+
+
+class CalibrateJob:
+	def __init__(self,
+				 name: str,
+				 # Set by parser, should correspond to options in runcalibrate
+				 location: str,
+				 use_best: bool,
+				 quantized: bool,
+				 batch_sizes: list,
+				 min_time: float,
+
+				 # Currently not set by argparser/configparser
+				 verbose: bool = True,
+			):
+		self.name = name
+		assert isinstance(self.name, str)
+
+		self.location = location
+		assert os.path.isfile(os.path.join(self.location, "model.pt")), f"No model.pt found in location {self.location}"
+		with open(os.path.join(self.location, "config.json"), encoding="utf-8") as f:
+			self.is2024 = json.load(f)["is2024"]
+		self.use_best = use_best
+		assert isinstance(self.use_best, bool)
+		self.quantized = quantized
+		assert isinstance(self.quantized, bool)
+		self.batch_sizes = batch_sizes
+		assert all(isinstance(bs, int) and bs > 0 for bs in self.batch_sizes)
+		self.min_time = min_time
+		assert self.min_time > 0
+
+		self.logger = Logger(f"{self.location}/calibration.log", name, verbose)
+
+	@with_used_repr
+	def execute(self) -> InferenceProfile:
+		self.logger.section(f"Calibrating inference of the model in {self.location}")
+		net = Model.load(self.location, self.logger, load_best=self.use_best, quantized=self.quantized)
+		profile = InferenceProfile.calibrate(net, self.batch_sizes, min_time=self.min_time, logger=self.logger)
+		profile.save(self.location, self.quantized)
+		self.logger("Best number of threads: " + ", ".join(f"{bs}: {profile.best_threads(bs)}" for bs in profile.batch_sizes))
+		return profile
+
+class DistanceTableJob:
+	def __init__(self,
+				 name: str,
+				 # Set by parser, should correspond to options in rundistancetable
+				 location: str,
+				 depth: int,
+				 is2024: bool,
+
+				 # Currently not set by argparser/configparser
+				 verbose: bool = True,
+			):
+		self.name = name
+		assert isinstance(self.name, str)
+
+		self.location = location
+		self.depth = depth
+		assert isinstance(self.depth, int) and self.depth >= 0
+		self.is2024 = is2024
+		assert isinstance(self.is2024, bool)
+
+		self.logger = Logger(f"{self.location}/distance_table.log", name, verbose)
+
+	@with_used_repr
+	def execute(self) -> DistanceTable:
+		self.logger.section(f"Building distance table of depth {self.depth}")
+		table = DistanceTable.build(self.depth, logger=self.logger)
+		table.save(self.location)
+		self.logger(f"Saved distance table to {self.location}")
+		return table
+
 class EvalJob:
 	is2024: bool
 
@@ -178,6 +499,8 @@ class EvalJob:
 				 # Set by parser, should correspond to options in runeval
 				 location: str,
 				 use_best: bool,
+				 frozen: bool,
+				 quantized: bool,
 				 agent: str,
 				 games: int,
 				 max_time: float,
@@ -189,6 +512,7 @@ class EvalJob:
 				 policy_sample: bool,
 				 astar_lambda: float,
 				 astar_expansions: int,
+				 astar_top_k: int,
 				 egvm_epsilon: float,
 				 egvm_workers: int,
 				 egvm_depth: int,
@@ -207,6 +531,8 @@ class EvalJob:
 		assert max_time or max_states
 		scrambling = range(*scrambling)
 		assert isinstance(optimized_params, bool)
+		assert isinstance(frozen, bool)
+		assert isinstance(quantized, bool)
 
 		#Create evaluator
 		self.logger = Logger(f"{self.location}/{self.name}.log", name, verbose)  # Already creates logger at init to test whether path works
@@ -217,6 +543,7 @@ class EvalJob:
 		agent = getattr(agents, agent_string)
 		assert issubclass(agent, agents.Agent)
 
+		self.quantized_pairs = {}  # Names of int8 quantized agents mapped to names of the corresponding float agents
 		if issubclass(agent, agents.DeepAgent):
 			self.agents, self.reps, agents_args = {}, {}, {}
 
@@ -227,10 +554,11 @@ class EvalJob:
 			elif agent == agents.PolicySearch:
 				assert isinstance(policy_sample, bool)
 				agents_args = { 'sample_policy': policy_sample }
-			elif agent == agents.AStar:
+			elif agent in (agents.AStar, agents.BatchedAStar):
 				assert isinstance(astar_lambda, float) and 0 <= astar_lambda <= 1, "AStar lambda must be float in [0, 1]"
 				assert isinstance(astar_expansions, int) and astar_expansions >= 1 and (not max_states or astar_expansions < max_states) , "Expansions must be int < max states"
-				agents_args = { 'lambda_': astar_lambda, 'expansions': astar_expansions }
+				assert isinstance(astar_top_k, int) and 0 <= astar_top_k <= cube.action_dim, "A* top k must be int in [0, 12]"
+				agents_args = { 'lambda_': astar_lambda, 'expansions': astar_expansions, 'top_k': astar_top_k or None }
 			elif agent == agents.EGVM:
 				assert isinstance(egvm_epsilon, float) and 0 <= egvm_epsilon <= 1, "EGVM epsilon must be float in [0, 1]"
 				assert isinstance(egvm_workers, int) and egvm_workers >= 1, "Number of EGWM workers must a natural number"
@@ -256,11 +584,17 @@ class EvalJob:
 						self.logger.log(f"Optimized params was set to true, but no file {parampath} was found, proceding with arguments for this {agent_string}.")
 
 				set_is2024(cfg["is2024"])
-				agent = agent.from_saved(folder, use_best=use_best, **agents_args)
-				key = f'{agent}{"" if folder == search_location else " " + os.path.basename(folder.rstrip(os.sep))}'
+				loaded_agent = agent.from_saved(folder, use_best=use_best, frozen=frozen, **agents_args)
+				key = f'{loaded_agent}{"" if folder == search_location else " " + os.path.basename(folder.rstrip(os.sep))}'
 
 				self.reps[key] = cfg["is2024"]
-				self.agents[key] = agent
+				self.agents[key] = loaded_agent
+				if quantized:
+					# The quantized agent is evaluated along with the float agent, so the solve rates can be compared
+					quantized_key = f"{key} int8"
+					self.reps[quantized_key] = cfg["is2024"]
+					self.agents[quantized_key] = agent.from_saved(folder, use_best=use_best, frozen=frozen, quantized=True, **agents_args)
+					self.quantized_pairs[quantized_key] = key
 				restore_repr()
 
 			if not self.agents:
@@ -281,6 +615,8 @@ class EvalJob:
 		for (name, agent), representation in zip(self.agents.items(), self.reps.values()):
 			self.is2024 = representation
 			self.agent_results[name] = self._single_exec(name, agent)
+		for quantized_name, name in self.quantized_pairs.items():
+			self.evaluator.log_comparison(quantized_name, self.agent_results[quantized_name], name, self.agent_results[name])
 
 	@with_used_repr
 	def _single_exec(self, name: str, agent: Agent):
@@ -1,19 +1,24 @@
+import inspect
 import json
 import os
-from time import time
+from time import time, time_ns, perf_counter
+from glob import glob, escape as glob_escape
 from copy import deepcopy
+from collections import OrderedDict
 
+import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
 from librubiks import cube
-from librubiks import gpu
-from librubiks.utils import NullLogger
+from librubiks import cpu, gpu
+from librubiks.utils import NullLogger, Logger
 
 
 class ModelConfig:
 
+	_fc_tiny_arch   = { "shared_sizes": [1024, 512], "part_sizes": [256] }  # Mainly for fast students in distillation
 	_fc_small_arch  = { "shared_sizes": [4096, 2048], "part_sizes": [512] }
 	_fc_big_arch    = { "shared_sizes": [8192, 4096, 2048], "part_sizes": [1024, 512] }
 	_res_small_arch = { "shared_sizes": [4096, 1024], "part_sizes": [512], "res_blocks": 4, "res_size": 1024 }
@@ -25,19 +30,21 @@ class ModelConfig:
 				 batchnorm=True, architecture="fc_small",
 				 init="glorot",
 				 is2024=True,
+				 shared_sizes: list=None,
+				 part_sizes: list=None,
 				 **kwargs,  # For backwardscompatibility
 			):
 		self.activation_function = activation_function
 		self.batchnorm = batchnorm
-		self.architecture = self._backward_comp_arch(architecture)  # Options: 'fc_small', 'fc_big', 'res_small', 'res_big', 'conv'
+		self.architecture = self._backward_comp_arch(architecture)  # Options: 'fc_tiny', 'fc_small', 'fc_big', 'res_small', 'res_big', 'conv'
 		self.init = init  # Options: glorot, he or a number
 		self.is2024 = is2024
 
 		self.id = hash(time())
 
-		# General purpose values
-		self.shared_sizes = self._get_arch()["shared_sizes"]
-		self.part_sizes = self._get_arch()["part_sizes"]
+		# General purpose values. Custom sizes are used by pruned models
+		self.shared_sizes = list(shared_sizes or self._get_arch()["shared_sizes"])
+		self.part_sizes = list(part_sizes or self._get_arch()["part_sizes"])
 
 		# ResNet values
 		if self.architecture.startswith("res"):
@@ -58,14 +65,33 @@ class ModelConfig:
 	def _get_arch(self):
 		return getattr(self, f"_{self.architecture}_arch")
 
+	def activation_size(self) -> int:
+		"""
+		Estimate of the largest number of activations per state that are stored at once in a feedforward without gradients.
+		Each layer keeps its input until its output is computed, so this is twice the widest layer plus what is kept on the side:
+		The input of each residual block in ResNets and the output of the fc layers while the convolutions run in ConvNets
+		"""
+		widths = [cube.get_oh_shape(), *self.shared_sizes, *self.part_sizes]
+		kept = 0
+		if self.architecture.startswith("res"):
+			widths.append(self.res_size)
+			kept = self.res_size
+		if self.architecture.startswith("conv"):
+			conv_sizes = [channels * 8 for channels in self.conv_channels]
+			widths += [*conv_sizes, conv_sizes[-1] + self.shared_sizes[-1], *self.cat_sizes]
+			kept = self.shared_sizes[-1]
+		return 2 * max(widths) + kept
+
 	@classmethod
 	def _get_non_serializable(cls):
 		return { "activation_function": cls._get_activation_function }
 
 	def as_json_dict(self):
 		d = deepcopy(self.__dict__)
+		# Sizes are only saved if they differ from the architecture
 		for key in ["shared_sizes", "part_sizes", "res_blocks", "res_size", "conv_channels", "cat_sizes"]:
-			d.pop(key, None)
+			if d.get(key) == self._get_arch().get(key):
+				d.pop(key, None)
 		for a, f in self._get_non_serializable().items():
 			d[a] = f(d[a], False)
 		return d
@@ -108,11 +134,15 @@ class Model(nn.Module):
 		Allows this class to be used to instantiate other Network architectures based on the content
 		of the configuartion file.
 		"""
-		if config.architecture.startswith("fc"):  return Model(config, logger).to(gpu)
-		if config.architecture.startswith("res"): return ResNet(config, logger).to(gpu)
-		if config.architecture == "conv":         return ConvNet(config, logger).to(gpu)
+		return Model._get_class(config)(config, logger).to(gpu)
+
+	@staticmethod
+	def _get_class(config: ModelConfig):
+		if config.architecture.startswith("fc"):  return Model
+		if config.architecture.startswith("res"): return ResNet
+		if config.architecture == "conv":         return ConvNet
 
-		raise KeyError(f"Network architecture should be 'fc_small', 'fc_big', 'res_small', 'res_big', 'conv', but '{config.architecture}' was given")
+		raise KeyError(f"Network architecture should be 'fc_tiny', 'fc_small', 'fc_big', 'res_small', 'res_big', 'conv', but '{config.architecture}' was given")
 
 	def _construct_net(self, pv_input_size: int=None):
 		"""
@@ -130,7 +160,10 @@ class Model(nn.Module):
 
 	def forward(self, x, policy=True, value=True):
 		assert policy or value
-		x = self.shared_net(x)
+		return self._forward_parts(self.shared_net(x), policy, value)
+
+	def _forward_parts(self, x, policy: bool, value: bool):
+		# Policy and value parts given the output of the shared part
 		return_values = []
 		if policy:
 			policy = self.policy_net(x)
@@ -140,6 +173,56 @@ class Model(nn.Module):
 			return_values.append(value)
 		return return_values if len(return_values) > 1 else return_values[0]
 
+	def supports_incremental(self) -> bool:
+		"""
+		Whether the output of the first layer can be computed incrementally using `first_layer` and `first_layer_children`.
+		This requires the sparse one-hot input of the 20x24 representation and an unquantized linear first layer
+		"""
+		return cube.get_is2024() and not isinstance(self, ConvNet) and type(self.shared_net[0]) is nn.Linear
+
+	def _first_layer_table(self) -> torch.tensor:
+		# Transposed first layer weights, such that row i is the contribution of one-hot entry i. Cached until the weights change
+		weight = self.shared_net[0].weight
+		key = (weight.data_ptr(), weight._version)
+		if getattr(self, "_table_key", None) != key:
+			self._table, self._table_key = weight.detach().T.contiguous(), key
+		return self._table
+
+	def first_layer(self, states: np.ndarray) -> torch.tensor:
+		"""
+		Output of the first linear layer before the activation function for the given 20x24 states
+		As the input is one-hot, it is the bias plus the sum of the 20 weight columns of the ones
+		"""
+		idcs = torch.from_numpy(cube.oh_indices(states)).to(gpu)
+		return F.embedding_bag(idcs, self._first_layer_table(), mode="sum") + self.shared_net[0].bias.detach()
+
+	def first_layer_children(self, parent_outputs: torch.tensor, parents: np.ndarray, children: np.ndarray, parent_idcs: np.ndarray) -> torch.tensor:
+		"""
+		Incremental version of `first_layer`, where children[i] is a child of parents[parent_idcs[i]], and `parent_outputs`
+		is the first layer output of the parents. A move changes only 8 of the 20 entries, so the output of a child is that of its parent
+		plus the weight columns of the new values of the changed entries minus those of the old values
+		"""
+		parent_oh = cube.oh_indices(parents)[parent_idcs]
+		child_oh = cube.oh_indices(children)
+		changed = parent_oh != child_oh
+		# For each child the new values of the changed entries are added, and the old ones subtracted
+		changed = np.concatenate([changed, changed], axis=1)
+		idcs = np.concatenate([child_oh, parent_oh], axis=1)[changed]
+		signs = np.where(np.arange(40) < 20, 1, -1).astype(np.float32)[np.nonzero(changed)[1]]
+		offsets = np.zeros(len(children), dtype=np.int64)
+		np.cumsum(changed.sum(axis=1)[:-1], out=offsets[1:])
+
+		outputs = parent_outputs.index_select(0, torch.from_numpy(parent_idcs).to(gpu))
+		return outputs.add_(F.embedding_bag(torch.from_numpy(idcs).to(gpu), self._first_layer_table(), torch.from_numpy(offsets).to(gpu),
+			mode="sum", per_sample_weights=torch.from_numpy(signs).to(gpu)))
+
+	def forward_from_first_layer(self, x: torch.tensor, policy=True, value=True):
+		"""
+		Same as forward, but takes the output of `first_layer` or `first_layer_children` as input
+		"""
+		assert policy or value
+		return self._forward_parts(self.shared_net[1:](x), policy, value)
+
 	def _create_fc_layers(self, thiccness: list, final: bool):
 		"""
 		Helper function to return fully connected feed forward layers given a list of layer sizes and
@@ -168,6 +251,96 @@ class Model(nn.Module):
 		new_net.load_state_dict(new_state_dict)
 		return new_net
 
+	@torch.no_grad()
+	def fold_batchnorm(self):
+		"""
+		Returns an eval mode copy of the model with batchnorms folded into linear layers where possible
+		"""
+		folded = self.clone().eval()
+		following = [folded.policy_net[0], folded.value_net[0]]
+		if isinstance(folded, ConvNet):
+			folded.cat_net = _fold_batchnorm(folded.cat_net, following)
+			folded.shared_conv_net = _fold_batchnorm(folded.shared_conv_net)
+			# The fc output is the first part of the input to the concatenation layers
+			following = [folded.cat_net[0]] if isinstance(folded.cat_net[0], nn.Linear) else []
+		folded.shared_net = _fold_batchnorm(folded.shared_net, following)
+		folded.policy_net = _fold_batchnorm(folded.policy_net)
+		folded.value_net = _fold_batchnorm(folded.value_net)
+		return folded
+
+	def quantize(self):
+		"""
+		Returns an eval mode copy of the model for CPU inference, where batchnorms are folded
+		and linear layers are dynamically quantized to int8
+		"""
+		assert gpu.type == "cpu", "Dynamic int8 quantization is only supported on CPU"
+		return torch.quantization.quantize_dynamic(self.fold_batchnorm(), {nn.Linear}, dtype=torch.qint8)
+
+	@torch.no_grad()
+	def prune(self, amount: float):
+		"""
+		Structured pruning: Returns an eval mode copy of the model where the fraction `amount` of the neurons in each hidden layer
+		with the lowest importance are removed. The copy has a config with custom layer sizes, so it can be saved and loaded as usual.
+		The importance of a neuron is the L1 norm of its outgoing weights times the scale of its batchnorm.
+		The mean output of a removed neuron is added to the biases of the next layer(s).
+		As the policy and value nets share part_sizes, the same number of neurons is kept in each of their layers.
+		Only fully connected architectures are supported, as the residual connections and convolutions fix some of the sizes.
+		"""
+		assert type(self) is Model, "Only fully connected architectures can be pruned"
+		assert 0 <= amount < 1
+		nets = { "shared": self.shared_net, "policy": self.policy_net, "value": self.value_net }
+		linears = { key: [l for l in net if isinstance(l, nn.Linear)] for key, net in nets.items() }
+		bns = { key: [l for l in net if isinstance(l, nn.BatchNorm1d)] or [None] * len(net) for key, net in nets.items() }
+
+		def keep(layer: nn.Linear, bn: nn.BatchNorm1d, next_layers: list):
+			n_keep = max(round(layer.out_features * (1 - amount)), 1)
+			importance = sum(l.weight.abs().sum(dim=0) for l in next_layers)
+			if bn is not None: importance *= _bn_scale_shift(bn)[0].abs()
+			return importance.argsort(descending=True)[:n_keep].sort().values
+
+		shared_keep = [keep(l, bns["shared"][i], [linears["shared"][i+1]] if i+1 < len(linears["shared"])
+						else [linears["policy"][0], linears["value"][0]]) for i, l in enumerate(linears["shared"])]
+		part_keeps = { key: [keep(l, bns[key][i], [linears[key][i+1]]) for i, l in enumerate(linears[key][:-1])]
+					   for key in ("policy", "value") }
+
+		config = deepcopy(self.config)
+		config.shared_sizes = [len(k) for k in shared_keep]
+		config.part_sizes = [len(k) for k in part_keeps["policy"]]
+		pruned = Model.create(config, self.log).eval()
+		pruned_nets = { "shared": pruned.shared_net, "policy": pruned.policy_net, "value": pruned.value_net }
+		for key, keeps in (("shared", shared_keep), *part_keeps.items()):
+			input_keep = torch.arange(cube.get_oh_shape(), device=gpu) if key == "shared" else shared_keep[-1]
+			input_bn = None if key == "shared" else bns["shared"][-1]
+			new_linears = [l for l in pruned_nets[key] if isinstance(l, nn.Linear)]
+			new_bns = [l for l in pruned_nets[key] if isinstance(l, nn.BatchNorm1d)]
+			for i, (layer, new_layer) in enumerate(zip(linears[key], new_linears)):
+				rows = keeps[i] if i < len(keeps) else torch.arange(layer.out_features, device=gpu)
+				cols, prev_bn = (input_keep, input_bn) if i == 0 else (keeps[i-1], bns[key][i-1])
+				new_layer.weight.copy_(layer.weight[rows][:, cols])
+				bias = layer.bias.clone()
+				if prev_bn is not None:
+					removed = torch.ones(layer.in_features, dtype=torch.bool, device=bias.device)
+					removed[cols] = False
+					bias += layer.weight[:, removed] @ prev_bn.bias[removed]
+				new_layer.bias.copy_(bias[rows])
+				if i < len(keeps) and bns[key][i] is not None:
+					for name, buffer in bns[key][i].state_dict().items():
+						new_bns[i].state_dict()[name].copy_(buffer if buffer.dim() == 0 else buffer[rows])
+
+		self.log(f"Pruned {amount*100:.0f} % of neurons: {self.config.shared_sizes}, {self.config.part_sizes} -> {config.shared_sizes}, {config.part_sizes}")
+		return pruned
+
+	def export_inference(self, save_dir: str=None, is_min=False, quantized=False):
+		"""
+		Creates a frozen TorchScript version of the model for fast inference with batchnorms folded into linear layers.
+		If save_dir is given, it is saved next to the model, such that it can be loaded with InferenceModel.load
+		"""
+		inference_model = InferenceModel.from_model(self, quantized)
+		if save_dir is not None:
+			inference_model.save(save_dir, is_min)
+			self.log(f"Saved inference model to {save_dir}")
+		return inference_model
+
 	def get_params(self):
 		return torch.cat([x.float().flatten() for x in self.state_dict().values()]).clone()
 
@@ -191,33 +364,132 @@ class Model(nn.Module):
 		self.log(f"Saved model to {model_path} and configuration to {conf_path}")
 
 	@staticmethod
-	def load(load_dir: str, logger=NullLogger(), load_best=False):
+	def load(load_dir: str, logger=NullLogger(), load_best=False, quantized=False, mmap=False):
 		"""
 		Load a model from a configuration directory
+		If quantized, the int8 quantized version of the model is returned in eval mode (see `quantize`)
+		If mmap, the parameters are memory mapped read-only from a flat file next to the model, which is created if needed.
+		All processes on a host loading the model this way then share the same physical memory, and the warm-up feedforward is
+		postponed to the first call of the model, so loading takes very little time and memory.
 		"""
 
 		model_path = os.path.join(load_dir, "model.pt" if not load_best else "model-best.pt")
+		if not os.path.isfile(model_path):
+			model_path = os.path.join(load_dir, "model.pt")
 		conf_path = os.path.join(load_dir, "config.json")
 		with open(conf_path, encoding="utf-8") as conf:
-			try:
-				state_dict = torch.load(model_path, map_location=gpu)
-			except FileNotFoundError:
-				model_path = os.path.join(load_dir, "model.pt")
-				state_dict = torch.load(model_path, map_location=gpu)
 			config = ModelConfig.from_json_dict(json.load(conf))
 
-		model = Model.create(config, logger)
-		model.load_state_dict(state_dict)
-		model.to(gpu)
-		# First time the net is loaded, a feedforward is performed, as the first time is slow
-		# This avoids skewing evaluation results
-		with torch.no_grad():
-			model.eval()
-			model(cube.as_oh(cube.get_solved()))
-			model.train()
+		if mmap:
+			state_dict = _load_mmap(model_path)
+			if _has_meta_device and _has_assign:
+				# Parameters are not allocated and initialized, as they are replaced by the memory mapped ones
+				with torch.device("meta"):
+					model = Model._get_class(config)(config, logger)
+				model.load_state_dict(state_dict, assign=True)
+			else:
+				model = Model.create(config, logger)
+				for name, tensor in [*model.named_parameters(), *model.named_buffers()]:
+					tensor.data = state_dict[name]
+			model.to(gpu)
+			# The warm-up is done right before the first feedforward, as the model may never be used by this process
+			def warm_up_hook(module, inputs):
+				handle.remove()
+				_warm_up(module)
+			handle = model.register_forward_pre_hook(warm_up_hook)
+		else:
+			state_dict = torch.load(model_path, map_location=gpu)
+			model = Model.create(config, logger)
+			model.load_state_dict(state_dict)
+			model.to(gpu)
+			_warm_up(model)
+		if quantized:
+			model = model.quantize()
+			logger(f"Quantized linear layers of model to int8")
+		model.inference_profile = InferenceProfile.load(load_dir, quantized)
 		return model
 
 
+_has_meta_device = hasattr(torch.device, "__enter__")  # Modules can be created without allocating parameters in torch >= 2.0
+_has_assign = "assign" in inspect.signature(nn.Module.load_state_dict).parameters  # Tensors can be loaded without copying in torch >= 2.1
+
+def _warm_up(model: Model):
+	# First time the net is loaded, a feedforward is performed, as the first time is slow
+	# This avoids skewing evaluation results
+	training = model.training
+	with torch.no_grad():
+		model.eval()
+		model(cube.as_oh(cube.get_solved()))
+		model.train(training)
+
+def _load_mmap(model_path: str) -> dict:
+	"""
+	Returns a state dict of tensors memory mapped from a flat file next to the saved model.
+	The file is written from the saved model the first time or if the model has been saved since.
+	The mapping is copy-on-write, so the memory is shared by all processes as long as the parameters are not changed.
+	"""
+	index_path = model_path[:-3] + ".mmap.json"
+	if not os.path.isfile(index_path) or os.path.getmtime(index_path) < os.path.getmtime(model_path):
+		_save_mmap(torch.load(model_path, map_location=cpu), model_path)
+	while True:
+		index = _read_mmap_index(index_path)
+		try:
+			data = np.memmap(os.path.join(os.path.dirname(index_path), index["data"]), dtype=np.uint8, mode="c")
+			break
+		except FileNotFoundError:
+			# Removed by another process writing a new version, which should be named by the index when it is read again
+			# If processes writing at the same time have removed each other's versions, a new one is written
+			if _read_mmap_index(index_path)["data"] == index["data"]:
+				_save_mmap(torch.load(model_path, map_location=cpu), model_path)
+	assert data.size == index["size"], f"Size of {index['data']} is {data.size} bytes, but the index says {index['size']}"
+
+	state_dict = OrderedDict()
+	for name, dtype, shape, offset in index["tensors"]:
+		dtype = np.dtype(dtype)
+		array = data[offset:offset+int(np.prod(shape))*dtype.itemsize].view(dtype).reshape(shape)
+		state_dict[name] = torch.from_numpy(array)
+	return state_dict
+
+def _read_mmap_index(index_path: str) -> dict:
+	with open(index_path, encoding="utf-8") as f:
+		return json.load(f)
+
+def _save_mmap(state_dict: dict, model_path: str):
+	# Tensors are written after each other aligned to 64 bytes. The index contains the name, dtype, shape, and offset of each
+	arrays = [tensor.cpu().numpy() for tensor in state_dict.values()]
+	offsets = np.cumsum([0] + [-(-array.nbytes // 64) * 64 for array in arrays])
+	size = max(int(offsets[-1]), 1)
+
+	# The data is written to a new file for each version, and the index, which names the data file, is then replaced in one step
+	# Other processes therefore always see an index and a data file that belong together
+	pid = os.getpid()
+	prefix = model_path[:-3]
+	data_path, index_path = f"{prefix}.{time_ns()}-{pid}.mmap", prefix + ".mmap.json"
+	data = np.memmap(data_path, dtype=np.uint8, mode="w+", shape=(size,))
+	for array, offset in zip(arrays, offsets):
+		data[offset:offset+array.nbytes] = np.ascontiguousarray(array).reshape(-1).view(np.uint8)
+	data.flush()
+	del data
+	index = {
+		"data": os.path.basename(data_path),
+		"size": size,
+		"tensors": [(name, array.dtype.str, array.shape, int(offset)) for name, array, offset in zip(state_dict, arrays, offsets)],
+	}
+	with open(f"{index_path}.{pid}", "w", encoding="utf-8") as f:
+		json.dump(index, f)
+	os.replace(f"{index_path}.{pid}", index_path)
+
+	# Old versions are removed except the one named by the index in case another process has replaced it since
+	# Processes that have already mapped them keep their mapping
+	keep = { data_path, os.path.join(os.path.dirname(index_path), _read_mmap_index(index_path)["data"]) }
+	for path in glob(f"{glob_escape(prefix)}.*-*.mmap"):
+		if path not in keep:
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass
+
+
 class NonConvResBlock(nn.Module):
 	"""
 	A residual block of two linear layers with the same size.
@@ -323,7 +595,7 @@ class ConvNet(Model):
 
 		# Shared part of network
 		fc_out = self.shared_net(x)
-		conv_out = self.shared_conv_net(cube.as_correct(x)).view(len(x), -1)
+		conv_out = self.shared_conv_net(cube.as_correct(x)).flatten(1)
 		x = torch.cat([fc_out, conv_out], dim=1)
 		x = self.cat_net(x)
 
@@ -337,3 +609,197 @@ class ConvNet(Model):
 			return_values.append(value)
 		return return_values if len(return_values) > 1 else return_values[0]
 
+
+
+def _bn_scale_shift(bn: nn.BatchNorm1d) -> (torch.tensor, torch.tensor):
+	# An eval mode batchnorm is the affine function x -> scale * x + shift
+	scale = bn.weight / torch.sqrt(bn.running_var + bn.eps)
+	return scale, bn.bias - bn.running_mean * scale
+
+def _fold_into_previous(layer: nn.Module, bn: nn.BatchNorm1d):
+	# Folds a batchnorm into the linear or convolutional layer directly before it
+	scale, shift = _bn_scale_shift(bn)
+	layer.weight.mul_(scale.view(-1, *[1] * (layer.weight.dim() - 1)))
+	layer.bias.mul_(scale).add_(shift)
+
+def _fold_into_next(layer: nn.Linear, bn: nn.BatchNorm1d):
+	# Folds a batchnorm into the linear layer after it. The output of the batchnorm is the first inputs to the layer
+	scale, shift = _bn_scale_shift(bn)
+	weight = layer.weight[:, :bn.num_features]
+	layer.bias.add_(weight @ shift)
+	weight.mul_(scale)
+
+def _fold_batchnorm(net: nn.Sequential, following: list=()) -> nn.Sequential:
+	"""
+	Folds the batchnorms of an eval mode sequential net into linear layers. The net is changed in place.
+	Batchnorms are folded into the layer before them if it is linear or convolutional, as is the case in residual blocks.
+	Otherwise, they are folded into the linear layer after them, as the activation function comes before the batchnorm.
+	The last batchnorm in the net is folded into all layers in `following`, which should be the first layers of the nets using its output.
+	Batchnorms that cannot be folded are kept.
+	"""
+	layers, folded = list(net), list()
+	for i, layer in enumerate(layers):
+		if isinstance(layer, NonConvResBlock) and layer.with_batchnorm:
+			_fold_into_previous(layer.layer1, layer.batchnorm1)
+			_fold_into_previous(layer.layer2, layer.batchnorm2)
+			layer.with_batchnorm = False
+			folded.append(layer)
+		elif isinstance(layer, nn.BatchNorm1d):
+			if folded and isinstance(folded[-1], (nn.Linear, nn.Conv1d)):
+				_fold_into_previous(folded[-1], layer)
+			elif i + 1 < len(layers) and isinstance(layers[i+1], nn.Linear):
+				_fold_into_next(layers[i+1], layer)
+			elif i + 1 == len(layers) and following:
+				for next_layer in following: _fold_into_next(next_layer, layer)
+			else:
+				folded.append(layer)
+		else:
+			folded.append(layer)
+	return nn.Sequential(*folded)
+
+class _Heads(nn.Module):
+	"""
+	Wraps a model to return a fixed combination of the policy and value outputs, so it can be traced
+	"""
+	def __init__(self, model: Model, policy: bool, value: bool):
+		super().__init__()
+		self.model = model
+		self.policy, self.value = policy, value
+
+	def forward(self, x):
+		out = self.model(x, policy=self.policy, value=self.value)
+		return tuple(out) if self.policy and self.value else out
+
+class InferenceModel(nn.Module):
+	"""
+	Frozen TorchScript version of a Model created by Model.export_inference.
+	A traced module is kept for each combination of policy and value outputs, so only the needed heads are computed.
+	It is called like a Model but cannot be trained or saved as a Model.
+	"""
+	heads = { "both": (True, True), "policy": (True, False), "value": (False, True) }
+
+	def __init__(self, config: ModelConfig, modules: dict, quantized=False):
+		super().__init__()
+		self.config = config
+		self.nets = nn.ModuleDict(modules)
+		self.quantized = quantized
+
+	def forward(self, x, policy=True, value=True):
+		assert policy or value
+		if policy and value:
+			return list(self.nets["both"](x))
+		return self.nets["policy" if policy else "value"](x)
+
+	@classmethod
+	@torch.no_grad()
+	def from_model(cls, model: Model, quantized=False):
+		folded = model.quantize() if quantized else model.fold_batchnorm()
+		example = cube.as_oh(np.array([cube.get_solved()] * 2))
+		modules = dict()
+		for head, (policy, value) in cls.heads.items():
+			traced = torch.jit.trace(_Heads(folded, policy, value).eval(), example)
+			modules[head] = torch.jit.freeze(traced) if hasattr(torch.jit, "freeze") else traced
+		return cls(model.config, modules, quantized)
+
+	@classmethod
+	def _paths(cls, load_dir: str, is_min: bool, quantized: bool) -> dict:
+		name = ("model-best" if is_min else "model") + ("-int8" if quantized else "")
+		return { head: os.path.join(load_dir, f"{name}-frozen-{head}.pt") for head in cls.heads }
+
+	def save(self, save_dir: str, is_min=False):
+		os.makedirs(save_dir, exist_ok=True)
+		for head, path in self._paths(save_dir, is_min, self.quantized).items():
+			torch.jit.save(self.nets[head], path)
+
+	@classmethod
+	def load(cls, load_dir: str, logger=NullLogger(), load_best=False, quantized=False):
+		"""
+		Loads the frozen model from a configuration directory.
+		The frozen model is exported from the saved model and cached if it does not exist or is older than the saved model
+		"""
+		model_path = os.path.join(load_dir, "model-best.pt" if load_best else "model.pt")
+		if not os.path.isfile(model_path):
+			load_best, model_path = False, os.path.join(load_dir, "model.pt")
+		paths = cls._paths(load_dir, load_best, quantized)
+		if all(os.path.isfile(path) and os.path.getmtime(path) >= os.path.getmtime(model_path) for path in paths.values()):
+			with open(os.path.join(load_dir, "config.json"), encoding="utf-8") as conf:
+				config = ModelConfig.from_json_dict(json.load(conf))
+			model = cls(config, { head: torch.jit.load(path, map_location=gpu) for head, path in paths.items() }, quantized)
+			logger(f"Loaded frozen inference model from {load_dir}")
+		else:
+			model = Model.load(load_dir, logger, load_best).export_inference(load_dir, load_best, quantized)
+		model.inference_profile = InferenceProfile.load(load_dir, quantized)
+		return model.eval()
+
+
+class InferenceProfile:
+	"""
+	Feedforward speed of a model on the current host for a number of batch sizes and thread counts.
+	It is created using `calibrate` and saved next to the model. Model.load then sets it as `inference_profile` of the model,
+	which agents and Train use to set the number of threads that is fastest for the batch sizes they use.
+	Profiles can be created by running `python runcalibrate.py --location <folder with model.pt>`
+	"""
+	def __init__(self, batch_sizes: list, threads: list, states_per_sec: np.ndarray):
+		self.batch_sizes = np.array(batch_sizes)
+		self.threads = np.array(threads)
+		self.states_per_sec = np.array(states_per_sec)  # len(threads) x len(batch_sizes)
+
+	@classmethod
+	@torch.no_grad()
+	def calibrate(cls, net: Model, batch_sizes: list=(1, 12, 120, 1200, 12000), threads: list=None,
+				  min_time: float=0.2, logger: Logger=NullLogger()):
+		"""
+		Measures the number of states evaluated per second with both policy and value for all combinations of batch sizes and thread counts
+		:param threads: Thread counts to try. Defaults to powers of two up to and including the number of cpus
+		:param min_time: Minimum time in seconds spent on each combination
+		"""
+		if threads is None:
+			threads = sorted({ *(2 ** np.arange(int(np.log2(os.cpu_count())) + 1)).tolist(), os.cpu_count() })
+		net.eval()
+		orig_threads = torch.get_num_threads()
+		states_per_sec = np.empty((len(threads), len(batch_sizes)))
+		for i, n_threads in enumerate(threads):
+			torch.set_num_threads(n_threads)
+			for j, batch_size in enumerate(batch_sizes):
+				# Inputs are contiguous float32 as produced by cube.as_oh
+				x = cube.as_oh(np.array([cube.get_solved()] * batch_size))
+				net(x)  # Warm up
+				n, start = 0, perf_counter()
+				while not n or perf_counter() - start < min_time:
+					net(x)
+					n += 1
+				states_per_sec[i, j] = n * batch_size / (perf_counter() - start)
+			logger(f"Threads: {n_threads}, states per second: " + ", ".join(f"{bs}: {sps:.0f}" for bs, sps in zip(batch_sizes, states_per_sec[i])))
+		torch.set_num_threads(orig_threads)
+		return cls(batch_sizes, threads, states_per_sec)
+
+	def best_threads(self, batch_size: int) -> int:
+		# Uses the measured batch size closest to the given on a logarithmic scale
+		j = np.abs(np.log(self.batch_sizes) - np.log(max(batch_size, 1))).argmin()
+		return int(self.threads[self.states_per_sec[:, j].argmax()])
+
+	def apply(self, batch_size: int):
+		torch.set_num_threads(self.best_threads(batch_size))
+
+	@staticmethod
+	def _path(load_dir: str, quantized: bool) -> str:
+		return os.path.join(load_dir, f"inference_profile{'-int8' if quantized else ''}.json")
+
+	def save(self, save_dir: str, quantized=False):
+		with open(self._path(save_dir, quantized), "w", encoding="utf-8") as f:
+			json.dump({
+				"batch_sizes": self.batch_sizes.tolist(),
+				"threads": self.threads.tolist(),
+				"states_per_sec": self.states_per_sec.tolist(),
+			}, f, indent=4)
+
+	@classmethod
+	def load(cls, load_dir: str, quantized=False):
+		"""
+		Returns the saved profile or None if it does not exist
+		"""
+		path = cls._path(load_dir, quantized)
+		if not os.path.isfile(path):
+			return None
+		with open(path, encoding="utf-8") as f:
+			return cls(**json.load(f))
@@ -0,0 +1,160 @@
+import os
+
+import matplotlib.pyplot as plt
+import numpy as np
+
+from librubiks import no_grad, rc_params
+from librubiks.utils import Logger, NullLogger, unverbose, TickTock, TimeUnit
+
+from librubiks import cube
+from librubiks.model import Model
+from librubiks.train import Train
+
+from librubiks.solving.agents import DeepAgent
+from librubiks.solving.evaluation import Evaluator
+plt.rcParams.update(rc_params)
+
+class Prune:
+	"""
+	Structured pruning: For each pruning amount, the least important neurons of a trained model are removed (see Model.prune),
+	and the pruned model is fine-tuned briefly using Train.
+	The feedforward latency and solve rate of every model is measured, which gives the latency versus solve rate curve.
+	"""
+
+	amounts: np.ndarray
+	n_params: np.ndarray
+	latencies: np.ndarray
+	sol_percents: np.ndarray
+
+	def __init__(self,
+				 amounts: list,
+				 rollouts: int,
+				 batch_size: int,
+				 rollout_games: int,
+				 rollout_depth: int,
+				 optim_fn,
+				 lr: float,
+				 reward_method: str,
+				 agent: DeepAgent,
+				 evaluator: Evaluator,
+				 latency_batch_size: int = 1200,
+				 logger: Logger = NullLogger(),
+				 ):
+		"""
+		:param list amounts: Fractions of neurons to remove in each hidden layer. The unpruned model is always included as amount 0
+		:param int rollouts: Number of rollouts each pruned model is fine-tuned for. Set to 0 to not fine-tune
+		:param int latency_batch_size: Number of states in the feedforward used to measure latency. The default is as used by AStar
+		"""
+		self.amounts = np.unique([0, *amounts])
+		assert all(0 <= amount < 1 for amount in self.amounts)
+		self.latency_batch_size = latency_batch_size
+
+		self.agent = agent
+		self.evaluator = evaluator
+		self.log = logger
+		self.train = Train(rollouts,
+						   batch_size			= batch_size,
+						   rollout_games		= rollout_games,
+						   rollout_depth		= rollout_depth,
+						   optim_fn				= optim_fn,
+						   alpha_update			= 1,  # The model is already trained, so all targets are weighted equally
+						   lr					= lr,
+						   gamma				= 1,
+						   update_interval		= 0,
+						   agent				= agent,
+						   evaluator			= evaluator,
+						   evaluation_interval	= 0,
+						   with_analysis		= False,
+						   tau					= 1,
+						   reward_method		= reward_method,
+						   logger				= logger,
+						   ) if rollouts else None
+		self.log("\n".join([
+			"Created pruner",
+			f"Amounts:        {', '.join(f'{amount:.2f}' for amount in self.amounts)}",
+			f"Fine-tuning:    {f'{rollouts} rollouts with learning rate {lr}' if rollouts else 'None'}",
+			f"Latency batch:  {self.latency_batch_size}",
+		]))
+
+		self.tt = TickTock()
+
+	def prune(self, model: Model) -> list:
+		"""
+		Prunes and fine-tunes `model` for each amount in `self.amounts`, and measures the latency and solve rate of the results
+		:return: A list of the pruned models in the same order as `self.amounts`. The first is the unpruned model
+		"""
+		self.tt.reset()
+		self.tt.tick()
+		self.log(f"Beginning pruning of {len(self.amounts)-1} models")
+		model.eval()
+		self.n_params = np.empty(len(self.amounts), dtype=int)
+		self.latencies = np.empty(len(self.amounts))
+		self.sol_percents = np.empty(len(self.amounts))
+		pruned_models = list()
+
+		for i, amount in enumerate(self.amounts):
+			if amount:
+				self.tt.profile("Pruning")
+				pruned = model.prune(amount)
+				self.tt.end_profile("Pruning")
+				if self.train is not None:
+					self.tt.profile("Fine-tuning")
+					with unverbose:
+						pruned, _ = self.train.train(pruned)
+					self.tt.end_profile("Fine-tuning")
+			else:
+				pruned = model
+			pruned.eval()
+			pruned_models.append(pruned)
+
+			self.n_params[i] = sum(p.numel() for p in pruned.parameters())
+			self.tt.profile("Latency")
+			self.latencies[i] = self.latency(pruned)
+			self.tt.end_profile("Latency")
+			self.agent.net = pruned
+			self.tt.profile(f"Evaluating using agent {self.agent}")
+			with unverbose:
+				eval_results, _, _ = self.evaluator.eval(self.agent)
+			self.sol_percents[i] = (eval_results != -1).mean()
+			self.tt.end_profile(f"Evaluating using agent {self.agent}")
+			self.log(f"Pruned {amount*100:.0f} %: {pruned.config.shared_sizes}, {pruned.config.part_sizes}, "
+					 f"{TickTock.thousand_seps(self.n_params[i])} parameters, latency {self.latencies[i]*1000:.2f} ms, "
+					 f"solve rate {self.sol_percents[i]*100:.2f} % at depth {self.evaluator.scrambling_depths}")
+
+		self.log.section("Finished pruning")
+		self.log(f"Total running time: {self.tt.stringify_time(self.tt.tock(), TimeUnit.second)}")
+		self.log.verbose(self.tt)
+		return pruned_models
+
+	@no_grad
+	def latency(self, net: Model, repeats: int=10) -> float:
+		# Mean time in seconds of a feedforward of both heads
+		oh_states = cube.as_oh(np.array([cube.scramble(10)[0] for _ in range(self.latency_batch_size)]))
+		net(oh_states)
+		self.tt.tick()
+		for _ in range(repeats): net(oh_states)
+		return self.tt.tock() / repeats
+
+	def plot_pruning(self, save_dir: str, name: str, show=False):
+		"""
+		Visualizes the pruning as the latency versus solve rate curve with each point labelled by the pruning amount
+		"""
+		self.log("Making plot of latency versus solve rate")
+		fig, ax = plt.subplots(figsize=(19.2, 10.8))
+		ax.plot(self.latencies*1000, self.sol_percents*100, "-o", linewidth=3, color="blue")
+		for amount, latency, sol_percent in zip(self.amounts, self.latencies, self.sol_percents):
+			ax.annotate(f"{amount*100:.0f} %", (latency*1000, sol_percent*100), textcoords="offset points", xytext=(5, 5))
+		ax.set_xlabel(f"Latency of feedforward of {TickTock.thousand_seps(self.latency_batch_size)} states [ms]")
+		ax.set_ylabel("Solve rate [%]")
+		ax.set_ylim([-5, 105])
+		plt.title(f"Latency versus solve rate of pruned models at depth {self.evaluator.scrambling_depths}")
+		fig.tight_layout()
+		plt.grid(True)
+
+		os.makedirs(save_dir, exist_ok=True)
+		path = os.path.join(save_dir, f"pruning_{name}.png")
+		plt.savefig(path)
+		self.log(f"Saved latency versus solve rate plot to {path}")
+
+		if show: plt.show()
+		plt.clf()
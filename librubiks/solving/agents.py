@@ -1,5 +1,6 @@
 import heapq
 from collections import deque
+from time import perf_counter
 
 import numpy as np
 import torch
@@ -7,10 +8,22 @@ import torch
 from librubiks.utils import TickTock
 
 from librubiks import gpu, no_grad
-from librubiks.model import Model
+from librubiks.model import Model, InferenceModel
 from librubiks import cube
 
 
+def _in_sorted(keys: np.ndarray, sorted_keys: np.ndarray) -> np.ndarray:
+	"""
+	Vectorized membership test of keys from cube.pack in a sorted vector of keys
+	Returns a boolean vector of the same length as keys
+	"""
+	if not len(sorted_keys):
+		return np.zeros(len(keys), dtype=bool)
+	idcs = np.searchsorted(sorted_keys, keys)
+	idcs[idcs == len(sorted_keys)] = 0
+	return sorted_keys[idcs] == keys
+
+
 class Agent:
 	eps = np.finfo("float").eps
 	_explored_states = 0
@@ -65,19 +78,58 @@ class Agent:
 
 
 class DeepAgent(Agent):
+	# Typical number of states in each feedforward. If the net has an inference profile, it is used to set the number of threads
+	batch_size = 1
+	# Whether to compute the first layer of the net incrementally from parent to child states if the net supports it
+	# See Model.first_layer_children
+	incremental = True
+
 	def __init__(self, net: Model):
 		super().__init__()
 		self.net = net
 
+	def reset(self, time_limit: float, max_states: int):
+		profile = getattr(self.net, "inference_profile", None)
+		if profile is not None:
+			profile.apply(self.batch_size)
+		return super().reset(time_limit, max_states)
+
 	@classmethod
-	def from_saved(cls, loc: str, use_best: bool):
-		net = Model.load(loc, load_best=use_best)
+	def from_saved(cls, loc: str, use_best: bool, frozen: bool=False, **load_kwargs):
+		"""
+		Loads the agent with the saved net in loc.
+		If frozen, the frozen TorchScript version of the net is used, which is exported and cached next to the model if needed.
+		Other keyword arguments are passed to the load method, such as quantized for int8 quantization of the net
+		and, for non-frozen nets, mmap for sharing memory mapped parameters between processes.
+		"""
+		net = (InferenceModel if frozen else Model).load(loc, load_best=use_best, **load_kwargs)
 		net.to(gpu)
 		return cls(net)
 
 	def _step(self, state: np.ndarray) -> (int, np.ndarray, bool):
 		raise NotImplementedError
 
+	def _incremental(self) -> bool:
+		return self.incremental and getattr(self.net, "supports_incremental", lambda: False)()
+
+	def _ff_children(self, children: np.ndarray, parents: np.ndarray=None, parent_idcs: np.ndarray=None, policy=True, value=True):
+		"""
+		Feedforward of states, where children[i] is a child of parents[parent_idcs[i]]
+		With incremental evaluation, the first layer output of the children is computed from that of the parents
+		If parents is None, the first layer output is computed from scratch
+		"""
+		if not self._incremental():
+			return self.net(cube.as_oh(children), policy=policy, value=value)
+		if parents is None:
+			x = self.net.first_layer(children)
+		else:
+			x = self.net.first_layer_children(self.net.first_layer(parents), parents, children, parent_idcs)
+		return self.net.forward_from_first_layer(x, policy=policy, value=value)
+
+	def _ff_input(self, x: torch.tensor, policy=True, value=True):
+		# Feedforward of the one-hot states or, with incremental evaluation, their first layer output
+		return (self.net.forward_from_first_layer if self._incremental() else self.net)(x, policy=policy, value=value)
+
 
 class RandomSearch(Agent):
 	def _step(self, state: np.ndarray) -> (int, np.ndarray, bool):
@@ -90,43 +142,90 @@ class RandomSearch(Agent):
 
 
 class BFS(Agent):
+	"""Level-synchronous breadth-first search
+	Expands an entire depth layer at a time by rotating the full frontier with multi_rotate.
+	The first solution found is therefore optimal.
+	Children are generated using the move pruning in cube.expand_children, and
+	membership is tested against sorted vectors of keys from cube.pack.
+	As the cube graph is undirected, the children of a state at depth d are at depth d-1, d, or d+1,
+	so only the keys of the previous, current, and next layer have to be kept.
+	"""
+
+	_chunk_size = 10_000  # Max. number of frontier states expanded at a time, so limits are also respected within large layers
 
-	states = dict()
+	# Nodes are indexed in the order they are found with the starting state at index 0, which is its own parent
+	parents: np.ndarray  # parents[i] is the index of the state from which state i was found
+	parent_actions: np.ndarray  # parent_actions[i] is the action taken from parents[i] to state i
 
-	def search(self, state: np.ndarray, time_limit: float=None, max_states: int=None) -> (np.ndarray, bool):
+	def search(self, state: np.ndarray, time_limit: float=None, max_states: int=None) -> bool:
 		time_limit, max_states = self.reset(time_limit, max_states)
 		self.tt.tick()
 
 		if cube.is_solved(state): return True
 
-		# Each element contains the state from which it came and the action taken to get to it
-		self.states = { state.tostring(): (None, None) }
-		queue = deque([state])
-		while self.tt.tock() < time_limit and len(self) < max_states:
-			state = queue.popleft()
-			tstate = state.tostring()
-			for i, action in enumerate(cube.action_space):
-				new_state = cube.rotate(state, *action)
-				new_tstate = new_state.tostring()
-				if new_tstate in self.states:
-					continue
-				elif cube.is_solved(new_state):
-					self.action_queue.appendleft(i)
-					while self.states[tstate][0] is not None:
-						self.action_queue.appendleft(self.states[tstate][1])
-						tstate = self.states[tstate][0]
+		self.parents, self.parent_actions = np.array([0]), np.array([cube.no_action])
+		frontier, frontier_idcs = np.expand_dims(state, 0), np.array([0])
+		current_keys = cube.pack(frontier)
+		prev_keys = current_keys[:0]
+		while len(frontier):
+			next_frontier, next_idcs = list(), list()
+			next_keys = current_keys[:0]
+			i = 0
+			while i < len(frontier):
+				n = min(self._chunk_size, (max_states - len(self)) // cube.action_dim)
+				if not n or self.tt.tock() >= time_limit:
+					return False
+
+				self.tt.profile("Expand frontier")
+				states, idcs = frontier[i:i+n], frontier_idcs[i:i+n]
+				last_actions = np.stack([self.parent_actions[self.parents[idcs]], self.parent_actions[idcs]], axis=1)
+				substates, parent_idcs, actions = cube.expand_children(states, last_actions)
+				self.tt.end_profile("Expand frontier")
+				i += n
+
+				self.tt.profile("Find new substates")
+				# Keys are sorted and unique, so new keys can be merged into next_keys in sorted order
+				keys, first_idcs = np.unique(cube.pack(substates), return_index=True)
+				new = ~(_in_sorted(keys, prev_keys) | _in_sorted(keys, current_keys) | _in_sorted(keys, next_keys))
+				keys, first_idcs = keys[new], first_idcs[new]
+				next_keys = np.sort(np.concatenate([next_keys, keys]))
+				self.tt.end_profile("Find new substates")
+
+				self.tt.profile("Add substates")
+				new_states = substates[first_idcs]
+				new_idcs = len(self) + np.arange(len(new_states))
+				self.parents = np.concatenate([self.parents, idcs[parent_idcs[first_idcs]]])
+				self.parent_actions = np.concatenate([self.parent_actions, actions[first_idcs]])
+				next_frontier.append(new_states)
+				next_idcs.append(new_idcs)
+				self.tt.end_profile("Add substates")
+
+				solved = np.where(cube.multi_is_solved(new_states))[0]
+				if solved.size:
+					self._build_action_queue(new_idcs[solved[0]])
 					return True
-				else:
-					self.states[new_tstate] = (tstate, i)
-					queue.append(new_state)
+
+			prev_keys, current_keys = current_keys, next_keys
+			frontier, frontier_idcs = np.concatenate(next_frontier), np.concatenate(next_idcs)
 
 		return False
 
+	def _build_action_queue(self, i: int):
+		while i:
+			self.action_queue.appendleft(self.parent_actions[i])
+			i = self.parents[i]
+
+	def reset(self, time_limit: float, max_states: int) -> (float, int):
+		time_limit, max_states = super().reset(time_limit, max_states)
+		self.parents = np.empty(0, dtype=int)
+		self.parent_actions = np.empty(0, dtype=int)
+		return time_limit, max_states
+
 	def __str__(self):
 		return "Breadth-first search"
 
 	def __len__(self):
-		return len(self.states)
+		return len(self.parents)
 
 
 class PolicySearch(DeepAgent):
@@ -142,8 +241,8 @@ class PolicySearch(DeepAgent):
 		return action, state, cube.is_solved(state)
 
 	@classmethod
-	def from_saved(cls, loc: str, use_best: bool, sample_policy=False):
-		net = Model.load(loc, load_best=use_best)
+	def from_saved(cls, loc: str, use_best: bool, sample_policy=False, frozen: bool=False, **load_kwargs):
+		net = (InferenceModel if frozen else Model).load(loc, load_best=use_best, **load_kwargs)
 		net.to(gpu)
 		return cls(net, sample_policy)
 
@@ -153,17 +252,20 @@ class PolicySearch(DeepAgent):
 
 class ValueSearch(DeepAgent):
 
+	batch_size = cube.action_dim
+
 	def _step(self, state: np.ndarray) -> (int, np.ndarray, bool):
-		substates = cube.multi_rotate(cube.repeat_state(state, cube.action_dim), *cube.iter_actions())
+		# Children that are redundant given the last two actions are not considered
+		last_actions = ([cube.no_action] * 2 + list(self.action_queue))[-2:]
+		substates, _, actions = cube.expand_children(np.expand_dims(state, 0), np.array([last_actions]))
 		solutions = cube.multi_is_solved(substates)
 		if np.any(solutions):
-			action = np.where(solutions)[0][0]
-			return action, substates[action], True
+			i = np.where(solutions)[0][0]
+			return actions[i], substates[i], True
 		else:
-			substates_oh = cube.as_oh(substates)
-			v = self.net(substates_oh, policy=False).squeeze().cpu().numpy()
-			action = np.argmax(v)
-			return action, substates[action], False
+			v = self._ff_children(substates, np.expand_dims(state, 0), np.zeros(len(substates), dtype=int), policy=False).squeeze().cpu().numpy()
+			i = np.argmax(v)
+			return actions[i], substates[i], False
 
 	def __str__(self):
 		return "Greedy value"
@@ -177,6 +279,11 @@ class AStar(DeepAgent):
 	f(node) = `self.lambda_` * g(node) + h(node)
 	where h(node) is given as the negative value (cost-to-go) of the DNN and g(x) is the path cost
 
+	If `self.top_k` is given, the policy is computed in the same forward pass as the value, and only the children
+	of the `self.top_k` most probable actions are generated when a node is expanded. The rest are deferred siblings:
+	The node is put back in the open queue behind the generated children and expands its next `self.top_k` actions
+	when it is popped again, so all children are eventually generated.
+
 	"""
 	# Expansion priority queue
 		# Min heap. An element contains tuple of (cost, index)
@@ -185,7 +292,8 @@ class AStar(DeepAgent):
 	open_queue: list
 
 	# State data structures
-	# The length of all arrays are dynamic and controlled by `reset` and `expand_stack_size`
+	# The arrays are presized by `reset` to hold max_states nodes and are reused between searches when large enough.
+	# If they run full, they are expanded by `increase_stack_size`
 	# Index 0 is not used in these to allow for
 		# states
 			# Contains all states currently visited in the representation set in cube
@@ -194,28 +302,54 @@ class AStar(DeepAgent):
 		# G_
 			# A* distance approximation of distance to starting node
 		# parents
-			#parents[i] is index of currently found parent with lowest G of state i
+			#parents[i] is index of currently found parent with lowest G of state i. The starting node has parent 0
 		# parent_actions
 			#parent_actions[i] is action idx taken FROM the lightest parent to state i
+		# action_order (only used with top_k)
+			# action_order[i] contains the actions sorted by descending policy of state i
+			# When state i is first expanded, it is replaced by its allowed actions in that order followed by cube.no_action
+		# n_expanded (only used with top_k)
+			# n_expanded[i] is the number of allowed actions of state i that have been expanded
 
 	indices = dict
 	states: np.ndarray
 	G: np.ndarray
 	parents: np.ndarray
 	parent_actions: np.ndarray
+	action_order: np.ndarray
+	n_expanded: np.ndarray
 
 
 	_stack_expand = 1000
-	def __init__(self, net: Model, lambda_: float, expansions: int):
+	_max_presize_bytes = 2 ** 30  # Node arrays larger than this are not presized but grown as needed
+
+	# Compact dtypes of the node arrays
+	_parent_dtype = np.int32
+	_action_dtype = np.uint8  # Also holds cube.no_action
+	_G_dtype = np.float32
+
+	# Estimated bytes used by CPython per node for the key and index in the indices dict and for the entry in the open queue
+	# These are larger than the node arrays themselves
+	_index_bytes = 120
+	_open_queue_bytes = 120
+
+	def __init__(self, net: Model, lambda_: float, expansions: int, top_k: int=None, memory_budget: int=None):
 		"""Init data structure, save params
 
 		:param net: Neural network whose value output is used as heuristic h
 		:param lambda_: The weighting factor in [0,1] that weighs the cost from start node g(x)
 		:param expansions: Number of expansions to perform at a time
+		:param top_k: If given, only the children of the top_k most probable actions according to the policy are
+			generated each time a node is expanded. The rest are deferred to later expansions of the same node
+		:param memory_budget: If given, max_states is capped such that the search uses at most this many bytes.
+			See `bytes_per_node`
 		"""
 		super().__init__(net)
 		self.lambda_ = lambda_
 		self.expansions = expansions
+		self.top_k = top_k
+		self.memory_budget = memory_budget
+		self.states = None
 
 	@no_grad
 	def search(self, state: np.ndarray, time_limit: float=None, max_states: int=None) -> bool:
@@ -229,31 +363,44 @@ class AStar(DeepAgent):
 		time_limit, max_states = self.reset(time_limit, max_states)
 		if cube.is_solved(state): return True
 
-			#First node
-		self.indices[state.tostring()], self.states[1], self.G[1] = 1, state, 0
-		heapq.heappush( self.open_queue, (0, 1) ) #Given cost 0: Should not matter; just to avoid np.empty weirdness
-
-		while self.tt.tock() < time_limit and len(self) + self.expansions * cube.action_dim <= max_states:
-			self.tt.profile("Remove nodes from open priority queue")
-			n_remove = min( len(self.open_queue), self.expansions )
-			expand_idcs = np.array([ heapq.heappop(self.open_queue)[1] for _ in range(n_remove) ], dtype=int)
-			self.tt.end_profile("Remove nodes from open priority queue")
+		self._add_first_node(state)
+		if self.top_k: self.cost(np.expand_dims(state, 0), np.array([1]))  # Only to compute the policy
 
-			is_won = self.expand_batch(expand_idcs)
+		while self.tt.tock() < time_limit and self._can_expand(max_states):
+			is_won = self.expand_batch(*self._pop_open_queue())
 			if is_won: #🦀🦀🦀WE DID IT BOIS🦀🦀🦀
-				i = self.indices[ cube.get_solved().tostring() ]
-					#Build action queue
-				while i != 1:
-					self.action_queue.appendleft(
-						self.parent_actions[i]
-					)
-					i = self.parents[i]
+				self._build_action_queue()
 				return True
 		return False
 
-	def expand_batch(self, expand_idcs: np.ndarray) -> bool:
+	def _add_first_node(self, state: np.ndarray):
+		self.indices[state.tostring()], self.states[1], self.G[1] = 1, state, 0
+		self.parents[1], self.parent_actions[:2] = 0, cube.no_action
+		heapq.heappush( self.open_queue, (0, 1) ) #Given cost 0: Should not matter; just to avoid np.empty weirdness
+
+	def _can_expand(self, max_states: int) -> bool:
+		return len(self) + self.expansions * cube.action_dim <= max_states
+
+	def _pop_open_queue(self) -> (np.ndarray, np.ndarray):
+		# Returns indices and costs of the best `self.expansions` open states
+		self.tt.profile("Remove nodes from open priority queue")
+		n_remove = min( len(self.open_queue), self.expansions )
+		expand_costs, expand_idcs = np.array([ heapq.heappop(self.open_queue) for _ in range(n_remove) ]).T.reshape(2, -1)
+		self.tt.end_profile("Remove nodes from open priority queue")
+		return expand_idcs.astype(int), expand_costs
+
+	def _build_action_queue(self):
+		i = self.indices[ cube.get_solved().tostring() ]
+		while i != 1:
+			self.action_queue.appendleft(
+				int(self.parent_actions[i])
+			)
+			i = self.parents[i]
+
+	def expand_batch(self, expand_idcs: np.ndarray, expand_costs: np.ndarray=None) -> bool:
 		"""
-		Expands to the neighbors of each of the states in
+		Expands to the neighbors of each of the states in expand_idcs
+		Children that are redundant given the two last actions taken to the state are pruned using cube.expand_children
 		Loose pseudo code:
 		```
 		1. Calculate children for all the batched expansion states
@@ -261,25 +408,39 @@ class AStar(DeepAgent):
 		3. FOR the unseen
 			IF they are the goal state: RETURN TRUE
 			Set the state as their parent and set their G
-			Calculate their H and add to open-list with correct cost
 		4. RELAX(seen) #See psudeo code under `relax_seen_states`
-		5. RETURN FALSE
+		5. Calculate H of the unseen and add them to open-list with correct cost
+		6. RETURN FALSE
 		```
+		Steps 1-4 are done in `self.expand` and step 5 in `self.push`, so the H calculation can be shared with other searches
 
 		:param expand_idcs: Indices corresponding to states in `self.states` of states from which to expand
+		:param expand_costs: Costs with which the states were popped from the open queue. Only needed with top_k
 		:return: True iff. solution was found in this expansion
 		"""
+		new_states, new_states_idcs, is_won = self.expand(expand_idcs, expand_costs)
+		if is_won:
+			return True
+		self.push(new_states_idcs, self.cost(new_states, new_states_idcs))
+		return False
+
+	def expand(self, expand_idcs: np.ndarray, expand_costs: np.ndarray=None) -> (np.ndarray, np.ndarray, bool):
+		"""
+		Performs all of the expansion except calculating costs of the new states and adding them to the open queue
+		:return: The new states, their indices in `self.states`, and whether a solution was found
+		"""
 		expand_size = len(expand_idcs)
 		while len(self) + expand_size * cube.action_dim > len(self.states):
 			self.increase_stack_size()
 
 		self.tt.profile("Calculate substates")
-		parent_idcs = np.repeat(expand_idcs, cube.action_dim, axis=0)
-		substates = cube.multi_rotate(
-			self.states[parent_idcs],
-			*cube.iter_actions(expand_size)
-		)
-		actions_taken = np.tile(np.arange(cube.action_dim), expand_size)
+		last_actions = np.stack([self.parent_actions[self.parents[expand_idcs]], self.parent_actions[expand_idcs]], axis=1)
+		if self.top_k:
+			expand_rows, actions_taken, deferred = self._get_top_k_actions(expand_idcs, last_actions)
+			substates = cube.multi_rotate(self.states[expand_idcs[expand_rows]], *cube.indices_to_actions(actions_taken))
+		else:
+			substates, expand_rows, actions_taken = cube.expand_children(self.states[expand_idcs], last_actions)
+		parent_idcs = expand_idcs[expand_rows]
 		self.tt.end_profile("Calculate substates")
 
 		self.tt.profile("Find new substates")
@@ -311,24 +472,68 @@ class AStar(DeepAgent):
 		self.G[new_states_idcs] = self.G[new_parent_idcs] + 1
 		self.parent_actions[new_states_idcs] = actions_taken[first_unseen]
 		self.parents[new_states_idcs] = new_parent_idcs
-			# Add the new states to "open" priority queue
-		costs = self.cost(new_states, new_states_idcs)
-		for i, cost in enumerate(costs):
-			heapq.heappush(self.open_queue, (cost, new_states_idcs[i]))
+		if self.top_k:
+			# Kept for pushing states with deferred siblings back into the open queue
+			self._deferred = (expand_idcs[deferred], np.array(expand_costs)[deferred], expand_rows[first_unseen], deferred)
 		self.tt.end_profile("Update new state values")
 
 		self.tt.profile("Check whether won")
 		solved_substates = cube.multi_is_solved(new_states)
-		if solved_substates.any():
-			return True
 		self.tt.end_profile("Check whether won")
+		if solved_substates.any():
+			return new_states, new_states_idcs, True
 
 		self.tt.profile("Old states: Update parents and G")
 		seen_batch_idcs = np.where(first_seen) #Old idcs corresponding to first_seen
 		self.relax_seen_states( old_states_idcs, parent_idcs[seen_batch_idcs], actions_taken[seen_batch_idcs] )
 		self.tt.end_profile("Old states: Update parents and G")
 
-		return False
+		return new_states, new_states_idcs, False
+
+	def push(self, new_states_idcs: np.ndarray, costs: np.ndarray):
+		"""
+		Adds the states found in the last call to `self.expand` to the open queue with the given costs
+		"""
+		self.tt.profile("Add new states to open queue")
+		for i, cost in enumerate(costs):
+			heapq.heappush(self.open_queue, (cost, new_states_idcs[i]))
+		if self.top_k:
+			# Nodes with deferred siblings are put back behind the most expensive of their new children
+			deferred_idcs, deferred_costs, new_rows, deferred = self._deferred
+			rows = np.cumsum(deferred) - 1
+			new_deferred = deferred[new_rows]
+			np.maximum.at(deferred_costs, rows[new_rows[new_deferred]], costs[new_deferred])
+			for idx, cost in zip(deferred_idcs, deferred_costs):
+				heapq.heappush(self.open_queue, (cost, idx))
+		self.tt.end_profile("Add new states to open queue")
+
+	def _get_top_k_actions(self, expand_idcs: np.ndarray, last_actions: np.ndarray) -> (np.ndarray, np.ndarray, np.ndarray):
+		"""
+		Finds the next top_k allowed actions in policy order for each of the states to expand
+		The allowed actions are fixed when a state is first expanded, as they depend on the last actions taken to the state,
+		which change if the state gets a new parent in `relax_seen_states`. Later expansions page through the same actions
+		:param expand_idcs: Indices in `self.states` of the states to expand
+		:param last_actions: len(expand_idcs) x 2 array of last two actions taken to the states
+		:return: Rows in expand_idcs and actions to take from them, and whether each state has actions left afterwards
+		"""
+		first = self.n_expanded[expand_idcs] == 0
+		if first.any():
+			order = self.action_order[expand_idcs[first]]
+			allowed = np.take_along_axis(cube.allowed_actions[last_actions[first, 0], last_actions[first, 1]], order, axis=1)
+			# A stable sort moves the allowed actions to the front while keeping them in policy order
+			allowed_first = np.argsort(~allowed, axis=1, kind="stable")
+			order = np.take_along_axis(order, allowed_first, axis=1)
+			order[~np.take_along_axis(allowed, allowed_first, axis=1)] = cube.no_action
+			self.action_order[expand_idcs[first]] = order
+
+		cols = self.n_expanded[expand_idcs, None] + np.arange(self.top_k)
+		window = np.take_along_axis(self.action_order[expand_idcs], np.minimum(cols, cube.action_dim-1), axis=1)
+		rows, ks = np.where((cols < cube.action_dim) & (window != cube.no_action))
+		self.n_expanded[expand_idcs] += self.top_k
+		n_expanded = self.n_expanded[expand_idcs].astype(int)
+		deferred = (n_expanded < cube.action_dim)\
+			& (self.action_order[expand_idcs, np.minimum(n_expanded, cube.action_dim-1)] != cube.no_action)
+		return rows, window[rows, ks].astype(int), deferred
 
 	def relax_seen_states(self, state_idcs: np.ndarray, parent_idcs: np.ndarray, actions_taken: np.ndarray):
 		"""A* relaxation of states already seen before
@@ -376,49 +581,211 @@ class AStar(DeepAgent):
 		:param states: (batch size, *(cube_dimensions)) of states
 		:param indeces: indeces in self.indeces corresponding to these states.
 		"""
-		states = cube.as_oh(states)
-		H = -self.net(states, value=True, policy=False)
-		H = H.cpu().squeeze().detach().numpy()
+		if self.top_k:
+			policy, value = self._ff_children(states, *self._parent_states(indeces), value=True, policy=True)
+		else:
+			policy, value = None, self._ff_children(states, *self._parent_states(indeces), value=True, policy=False)
+		return self.cost_from_net(indeces, value, policy)
+
+	def _parent_states(self, indeces: np.ndarray) -> (np.ndarray, np.ndarray):
+		"""
+		Returns the unique parent states of the given states and the index of the parent of each state
+		Both are None if any of the parents are not in the search, as is the case for the starting state
+		"""
+		parents, parent_idcs = np.unique(self.parents[indeces], return_inverse=True)
+		if parents[0] < 1 or parents[-1] > len(self):
+			return None, None
+		return self.states[parents], parent_idcs.ravel()
+
+	def cost_from_net(self, indeces: np.ndarray, value: torch.tensor, policy: torch.tensor=None) -> np.ndarray:
+		"""The A star cost given the network output for the states
+		If the policy is given, it is used for ordering the expansions of the states
+
+		:param indeces: indeces in self.indeces of the states
+		:param value: Value output of the network of shape (batch size, 1)
+		:param policy: Optional policy output of the network of shape (batch size, action_dim)
+		"""
+		if policy is not None:
+			self.action_order[indeces] = policy.argsort(dim=1, descending=True).cpu().numpy()
+			self.n_expanded[indeces] = 0
+		H = -value.cpu().detach().numpy().ravel()
 
 		return self.lambda_ * self.G[indeces] + H
 
 	def reset(self, time_limit: float, max_states: int) -> (float, int):
+		# Without a limit on the number of states, the arrays are not presized but grown as needed
+		is_limited = bool(max_states or self.memory_budget)
 		time_limit, max_states = super().reset(time_limit, max_states)
+		if self.memory_budget:
+			max_states = min(max_states, self.memory_budget // self.bytes_per_node() - 1)
 		self.open_queue = list()
 		self.indices   = dict()
 
-		self.states    = np.empty((self._stack_expand, *cube.shape()), dtype=cube.dtype)
-		self.parents = np.empty(self._stack_expand, dtype=int)
-		self.parent_actions = np.zeros(self._stack_expand, dtype=int)
-		self.G         = np.empty(self._stack_expand)
+		size = max(self._stack_expand, min(max_states + 1, self._max_presize_bytes // self.array_bytes_per_node()))\
+			if is_limited else self._stack_expand
+		# Buffers from the previous search are reused if possible
+		if self.states is None or len(self.states) < size or self.states.shape[1:] != cube.shape()\
+			or (self.top_k and getattr(self, "action_order", None) is None):
+			self.states    = np.empty((size, *cube.shape()), dtype=cube.dtype)
+			self.parents = np.empty(size, dtype=self._parent_dtype)
+			self.parent_actions = np.empty(size, dtype=self._action_dtype)
+			self.G         = np.empty(size, dtype=self._G_dtype)
+			if self.top_k:
+				self.action_order = np.empty((size, cube.action_dim), dtype=self._action_dtype)
+				self.n_expanded = np.empty(size, dtype=self._action_dtype)
 		return time_limit, max_states
 
 	def increase_stack_size(self):
 		expand_size    = len(self.states)
 
 		self.states	   = np.concatenate([self.states, np.empty((expand_size, *cube.shape()), dtype=cube.dtype)])
-		self.parents   = np.concatenate([self.parents, np.zeros(expand_size, dtype=int)])
-		self.parent_actions   = np.concatenate([self.parent_actions, np.zeros(expand_size, dtype=int)])
-		self.G         = np.concatenate([self.G, np.empty(expand_size)])
+		self.parents   = np.concatenate([self.parents, np.empty(expand_size, dtype=self._parent_dtype)])
+		self.parent_actions   = np.concatenate([self.parent_actions, np.empty(expand_size, dtype=self._action_dtype)])
+		self.G         = np.concatenate([self.G, np.empty(expand_size, dtype=self._G_dtype)])
+		if self.top_k:
+			self.action_order = np.concatenate([self.action_order, np.empty((expand_size, cube.action_dim), dtype=self._action_dtype)])
+			self.n_expanded = np.concatenate([self.n_expanded, np.empty(expand_size, dtype=self._action_dtype)])
+
+	def array_bytes_per_node(self) -> int:
+		"""Bytes used per node in the node arrays"""
+		array_bytes = int(np.prod(cube.shape())) * np.dtype(cube.dtype).itemsize\
+			+ np.dtype(self._parent_dtype).itemsize + np.dtype(self._action_dtype).itemsize + np.dtype(self._G_dtype).itemsize
+		if self.top_k:
+			array_bytes += (cube.action_dim + 1) * np.dtype(self._action_dtype).itemsize
+		return array_bytes
+
+	def bytes_per_node(self) -> int:
+		"""
+		Estimated memory use in bytes per node in the search.
+		This is the size of a node in the node arrays and the estimated size of its entries in the indices dict and open queue
+		"""
+		return self.array_bytes_per_node() + self._index_bytes + self._open_queue_bytes
 
 	@classmethod
-	def from_saved(cls, loc: str, use_best: bool, lambda_: float, expansions: int) -> DeepAgent:
-		net = Model.load(loc, load_best=use_best).to(gpu)
-		return cls(net, lambda_=lambda_, expansions=expansions)
+	def from_saved(cls, loc: str, use_best: bool, lambda_: float, expansions: int, top_k: int=None, memory_budget: int=None, frozen: bool=False, **load_kwargs) -> DeepAgent:
+		net = (InferenceModel if frozen else Model).load(loc, load_best=use_best, **load_kwargs).to(gpu)
+		return cls(net, lambda_=lambda_, expansions=expansions, top_k=top_k, memory_budget=memory_budget)
+
+	@property
+	def batch_size(self) -> int:
+		return self.expansions * (self.top_k or cube.action_dim)
 
 	def __len__(self) -> int:
 		return len(self.indices)
 
 	def __str__(self) -> str:
-		return f'AStar (lambda={self.lambda_}, N={self.expansions})'
+		return f'AStar (lambda={self.lambda_}, N={self.expansions}' + (f', k={self.top_k})' if self.top_k else ')')
+
+class BatchedAStar(AStar):
+	"""Solves many cubes at once with independent AStar searches run in lockstep
+	Each iteration pops the best `self.expansions` nodes from the open queue of every unfinished search,
+	and the children of all of them are scored in one forward pass of the network.
+	This keeps the batches large even with few expansions, so many cubes can be solved much faster than one at a time.
+	Single cubes can still be solved using `search`, which is the same as for AStar.
+	"""
+
+	searches: list  # AStar instance for each cube in the last call to search_many
+	times: np.ndarray  # Time spent on each cube in the last call to search_many
+
+	@no_grad
+	def search_many(self, states: np.ndarray, time_limit: float=None, max_states: int=None) -> (np.ndarray, list, np.ndarray, np.ndarray):
+		"""
+		Searches for solutions to all the given states
+		The time of each cube is the time spent on its own expansions plus its share of the batched feedforwards,
+		which is split between the cubes in proportion to the number of states they contribute. The times are therefore
+		comparable to the search times of the sequential agents, and their sum is the time spent on the batch
+		:param states: n x *Cube shape array of states to solve
+		:param time_limit: Time limit for each cube
+		:param max_states: Maximum number of states explored for each cube
+		:return: Whether each cube was solved, action queue of each cube, number of states explored for each cube,
+			and time spent on each cube
+		"""
+		self.tt.tick()
+		# The node arrays of this instance are not used, so only the time limit is set
+		# max_states is passed on to the searches as given, so they only presize their node arrays if it is set
+		time_limit, _ = super(AStar, self).reset(time_limit, max_states)
+		# Searches are reused between calls, so their node arrays can be reused as well
+		memory_budget = self.memory_budget // len(states) if self.memory_budget else None
+		if len(getattr(self, "searches", ())) != len(states) or self.searches[0].memory_budget != memory_budget:
+			self.searches = [AStar(self.net, self.lambda_, self.expansions, self.top_k, memory_budget) for _ in states]
+		solved = cube.multi_is_solved(states)
+		active = ~solved
+		self.times = np.zeros(len(states))
+		search_max_states = np.empty(len(states), dtype=int)
+		for i, (search, state, is_active) in enumerate(zip(self.searches, states, active)):
+			start = perf_counter()
+			_, search_max_states[i] = search.reset(time_limit, max_states)
+			if is_active: search._add_first_node(state)
+			self.times[i] += perf_counter() - start
+		if self.top_k:
+			# Only to compute the policy of the starting states. Solved cubes have no starting node
+			active_idcs = np.where(active)[0]
+			self._batch_cost(active_idcs, [np.array([1])]*len(active_idcs), states[active_idcs, None])
+
+		while active.any():
+			expanding, new_states_idcs, new_states = list(), list(), list()
+			for i in np.where(active)[0]:
+				search = self.searches[i]
+				if self.times[i] >= time_limit or not search._can_expand(search_max_states[i]):
+					active[i] = False
+					continue
+				start = perf_counter()
+				states_, idcs, is_won = search.expand(*search._pop_open_queue())
+				if is_won:
+					search._build_action_queue()
+					solved[i], active[i] = True, False
+				else:
+					expanding.append(i)
+					new_states_idcs.append(idcs)
+					new_states.append(states_)
+				self.times[i] += perf_counter() - start
+			self._batch_cost(np.array(expanding, dtype=int), new_states_idcs, new_states, push=True)
+
+		return solved, [search.action_queue for search in self.searches], np.array([len(search) for search in self.searches]), self.times.copy()
+
+	def __len__(self) -> int:
+		return sum(len(search) for search in getattr(self, "searches", ()))
+
+	def _batch_cost(self, search_idcs: np.ndarray, indices: list, states: list, push: bool=False):
+		"""
+		Calculates costs of the given states of each search in one forward pass and pushes them to the open queues if push
+		The time spent is added to the times of the searches in proportion to their number of states
+		"""
+		if not len(search_idcs): return
+		start_time = perf_counter()
+		searches = [self.searches[i] for i in search_idcs]
+		self.tt.profile("Batched feedforward")
+		sizes = np.cumsum([0] + [len(x) for x in indices])
+		parents = [search._parent_states(idcs) for search, idcs in zip(searches, indices)]
+		if any(p is None for p, _ in parents):
+			parent_states, parent_idcs = None, None
+		else:
+			parent_sizes = np.cumsum([0] + [len(p) for p, _ in parents])
+			parent_states = np.concatenate([p for p, _ in parents])
+			parent_idcs = np.concatenate([idcs + start for (_, idcs), start in zip(parents, parent_sizes)])
+		states = np.concatenate(states)
+		if self.top_k:
+			policy, value = self._ff_children(states, parent_states, parent_idcs, value=True, policy=True)
+		else:
+			policy, value = None, self._ff_children(states, parent_states, parent_idcs, value=True, policy=False)
+		self.tt.end_profile("Batched feedforward")
+		for search, idcs, start, end in zip(searches, indices, sizes[:-1], sizes[1:]):
+			costs = search.cost_from_net(idcs, value[start:end], policy[start:end] if policy is not None else None)
+			if push: search.push(idcs, costs)
+		self.times[search_idcs] += (perf_counter() - start_time) * np.diff(sizes) / sizes[-1]
+
+	def __str__(self) -> str:
+		return "Batched " + super().__str__()
 
 class MCTS(DeepAgent):
 
 	_expand_nodes = 1000  # Expands stack by 1000, then 2000, then 4000 and etc. each expansion
+	batch_size = cube.action_dim  # The neighbors of a leaf are evaluated together
 	n_states = 0
 	indices = dict()  # Key is state.tostring(). Contains index of state in the next arrays. Index 0 is not used
 	states: np.ndarray
-	neighbors: np.ndarray  # n x 12 array of neighbor indices. As first index is unused, np.all(self.neighbors, axis=1) can be used
+	neighbors: np.ndarray  # n x 12 array of neighbor indices. Index 0 means unknown, which is also the case for pruned actions
+	# The pruned actions of a node are those of the path that first reached it. See `expand_leaf`
 	leaves: np.ndarray  # Boolean vector containing whether a node is a leaf
 	P: np.ndarray
 	V: np.ndarray
@@ -510,7 +877,14 @@ class MCTS(DeepAgent):
 
 		self.tt.profile("Get substates")
 		state = self.states[leaf_index]
-		substates = cube.multi_rotate(cube.repeat_state(state), *cube.iter_actions())
+		# Children that are redundant given the last two actions are pruned and can never be chosen from this leaf
+		# The mask is set when the leaf is expanded, so it depends on the path that first reached the leaf. If the node is later
+		# reached by another path, the children pruned for the first path stay unavailable, even if they are allowed after
+		# the new path, and the children pruned for the new path remain available
+		last_actions = ([cube.no_action] * 2 + actions_taken)[-2:]
+		substates, _, actions = cube.expand_children(np.expand_dims(state, 0), np.array([last_actions]))
+		pruned = np.ones(cube.action_dim, dtype=bool)
+		pruned[actions] = False
 		self.tt.end_profile("Get substates")
 
 		# Check what states have been seen already
@@ -530,7 +904,6 @@ class MCTS(DeepAgent):
 		self.tt.end_profile("Update indices and states")
 
 		self.tt.profile("Update neigbors and leaf status")
-		actions = np.arange(cube.action_dim)
 		self.neighbors[leaf_index, actions] = substate_idcs
 		self.neighbors[substate_idcs, cube.rev_actions(actions)] = leaf_index
 		self.leaves[leaf_index] = False
@@ -540,15 +913,12 @@ class MCTS(DeepAgent):
 		solved_substate = np.where(cube.multi_is_solved(substates))[0]
 		if solved_substate.size:
 			solve_leaf = substate_idcs[solved_substate[0]]
-			solve_action = solved_substate[0]
+			solve_action = actions[solved_substate[0]]
 		self.tt.end_profile("Check for solution")
 
 		# Update policy, value, and W
-		self.tt.profile("One-hot encoding")
-		new_substates_oh = cube.as_oh(new_substates)
-		self.tt.end_profile("One-hot encoding")
 		self.tt.profile("Feedforward")
-		p, v = self.net(new_substates_oh)
+		p, v = self._ff_children(new_substates, np.expand_dims(state, 0), np.zeros(len(new_substates), dtype=int))
 		p, v = p.cpu().softmax(dim=1).numpy(), v.cpu().numpy().squeeze()
 		self.tt.end_profile("Feedforward")
 
@@ -558,6 +928,7 @@ class MCTS(DeepAgent):
 
 		best_substate_v = v.max()
 		self.W[leaf_index] = self.V[self.neighbors[leaf_index]]
+		self.W[leaf_index, pruned] = -np.inf
 		self.W[new_substate_idcs] = np.tile(v, (cube.action_dim, 1)).T
 		self.W[visited_states_idcs[:-1], actions_taken] = np.maximum(self.W[visited_states_idcs[:-1], actions_taken], best_substate_v)
 		self.tt.end_profile("Update P, V, and W")
@@ -633,8 +1004,8 @@ class MCTS(DeepAgent):
 		self.tt.end_profile("BFS")
 
 	@classmethod
-	def from_saved(cls, loc: str, use_best: bool, c: float, search_graph: bool):
-		net = Model.load(loc, load_best=use_best)
+	def from_saved(cls, loc: str, use_best: bool, c: float, search_graph: bool, frozen: bool=False, **load_kwargs):
+		net = (InferenceModel if frozen else Model).load(loc, load_best=use_best, **load_kwargs)
 		net.to(gpu)
 		return cls(net, c=c, search_graph=search_graph)
 
@@ -654,6 +1025,10 @@ class EGVM(DeepAgent):
 		self.workers = workers
 		self.depth = depth
 
+	@property
+	def batch_size(self) -> int:
+		return self.workers
+
 	@no_grad
 	def search(self, state: np.ndarray, time_limit: float=None, max_states: int=None) -> bool:
 		time_limit, max_states = self.reset(time_limit, max_states)
@@ -664,13 +1039,13 @@ class EGVM(DeepAgent):
 
 		while self.tt.tock() < time_limit and len(self) + self.workers * self.depth <= max_states:
 			# Expand from current best state
-			paths, states, states_oh, solved = self.expand(state)
+			paths, states, states_x, solved = self.expand(state)
 			# Break if solution is found
 			if solved != (-1, -1):
 				self.action_queue += deque(paths[solved[0], :solved[1]])
 				return True
 			# Update state with the high ground
-			v = self.net(states_oh, policy=False).cpu().squeeze()
+			v = self._ff_input(states_x, policy=False).cpu().squeeze()
 			best_value_index = int(v.argmax())
 			state = states[best_value_index]
 			worker, depth = best_value_index // self.depth, best_value_index % self.depth
@@ -682,12 +1057,15 @@ class EGVM(DeepAgent):
 		return np.arange(self.workers) * self.depth + depth
 
 	def expand(self, state: np.ndarray) -> (list, np.ndarray, torch.tensor, tuple):
+		# With incremental evaluation, the network input is the first layer output of each worker state,
+		# which is updated from one depth to the next. Otherwise it is the one-hot states
+		incremental = self._incremental()
 		# Initialize needed data structures
 		states = cube.repeat_state(state, self.workers)
-		states_oh = cube.as_oh(states)
+		states_x = self.net.first_layer(states) if incremental else cube.as_oh(states)
 		paths = paths = np.empty((self.workers, self.depth), dtype=int)  # Index n contains path for worker n
 		new_states = np.empty((self.workers * self.depth, *cube.shape()), dtype=cube.dtype)
-		new_states_oh = torch.empty(self.workers * self.depth, cube.get_oh_shape(), dtype=torch.float, device=gpu)
+		new_states_x = torch.empty(self.workers * self.depth, states_x.shape[1], dtype=torch.float, device=gpu)
 		# Expand for self.depth iterations
 		for d in range(self.depth):
 			# Use epsilon-greedy to decide where to use policy and random actions
@@ -697,29 +1075,29 @@ class EGVM(DeepAgent):
 			# Random actions
 			actions[use_random] = np.random.randint(0, cube.action_dim, use_random.sum())
 			# Policy actions
-			p = self.net(states_oh[use_policy], value=False).cpu().numpy()
+			p = self._ff_input(states_x[use_policy], value=False).cpu().numpy()
 			actions[use_policy] = p.argmax(axis=1)
 			# Update paths
 			paths[:, d] = actions
 
 			# Expand using selected actions
 			faces, dirs = cube.indices_to_actions(actions)
-			states = cube.multi_rotate(states, faces, dirs)
-			states_oh = cube.as_oh(states)
+			parents, states = states, cube.multi_rotate(states, faces, dirs)
+			states_x = self.net.first_layer_children(states_x, parents, states, np.arange(self.workers)) if incremental else cube.as_oh(states)
 			solved_states = cube.multi_is_solved(states)
 			if np.any(solved_states):
 				self._explored_states += (d+1) * self.workers
 				w = np.where(solved_states)[0][0]
 				return paths, None, None, (w, d+1)
 			new_states[self._get_indices(d)] = states
-			new_states_oh[self._get_indices(d)] = states_oh
+			new_states_x[self._get_indices(d)] = states_x
 		self._explored_states += len(new_states)
 
-		return paths, new_states, new_states_oh, (-1, -1)
+		return paths, new_states, new_states_x, (-1, -1)
 
 	@classmethod
-	def from_saved(cls, loc: str, use_best: bool, epsilon: float, workers: int, depth: int):
-		net = Model.load(loc, load_best=use_best).to(gpu)
+	def from_saved(cls, loc: str, use_best: bool, epsilon: float, workers: int, depth: int, frozen: bool=False, **load_kwargs):
+		net = (InferenceModel if frozen else Model).load(loc, load_best=use_best, **load_kwargs).to(gpu)
 		return cls(net, epsilon=epsilon, workers=workers, depth=depth)
 
 	def __str__(self):
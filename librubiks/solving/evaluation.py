@@ -51,6 +51,16 @@ class Evaluator:
 		if solution_found: turns_to_complete = len(agent.action_queue)
 		return turns_to_complete, dt
 
+	def _eval_batch(self, agent: agents.BatchedAStar, depth: int, profile: str) -> (list, np.ndarray, np.ndarray):
+		# Solves all games at once. The time limit and the returned times are for each game, as when playing them one at a time
+		depths = np.random.randint(100, 1000, self.n_games) if self._isdeep() else [depth] * self.n_games
+		states = np.array([cube.scramble(d, True)[0] for d in depths])
+		self.tt.profile(profile)
+		solved, action_queues, explored_states, dts = agent.search_many(states, self.max_time, self.max_states)
+		self.tt.end_profile(profile)
+		turns_to_complete = [len(q) if s else -1 for s, q in zip(solved, action_queues)]
+		return turns_to_complete, explored_states, dts
+
 	def eval(self, agent: agents.Agent) -> (np.ndarray, np.ndarray, np.ndarray):
 		"""
 		Evaluates an agent
@@ -69,15 +79,22 @@ class Evaluator:
 		states = []
 		times = []
 		for d in self.scrambling_depths:
-			for _ in range(self.n_games):
-				if self._isdeep():  # Randomly sample evaluation depth for deep evaluations
-					d = np.random.randint(100, 1000)
+			if isinstance(agent, agents.BatchedAStar):
 				p = f"Evaluation of {agent}. Depth {'100 - 999' if self._isdeep() else d}"
-				r, dt = self._eval_game(agent, d, p)
-
-				res.append(r)
-				states.append(len(agent))
-				times.append(dt)
+				r, s, dt = self._eval_batch(agent, d, p)
+				res.extend(r)
+				states.extend(s)
+				times.extend(dt)
+			else:
+				for _ in range(self.n_games):
+					if self._isdeep():  # Randomly sample evaluation depth for deep evaluations
+						d = np.random.randint(100, 1000)
+					p = f"Evaluation of {agent}. Depth {'100 - 999' if self._isdeep() else d}"
+					r, dt = self._eval_game(agent, d, p)
+
+					res.append(r)
+					states.append(len(agent))
+					times.append(dt)
 			if not self._isdeep():
 				self.log.verbose(f"Performed evaluation at depth: {d}/{self.scrambling_depths[-1]}")
 
@@ -124,6 +141,24 @@ class Evaluator:
 			f"Pr. sec.: {states_per_sec.mean():.2f} +/- {states_per_sec.std():.0f} (std.)", with_timestamp=False)
 		self.log(f"\tTime:  {times.mean():.2f} +/- {times.std():.2f} (std.)", with_timestamp=False)
 
+	def log_comparison(self, name: str, results: tuple, base_name: str, base_results: tuple):
+		"""Logs the differences in solve rate and states seen per second between two agents evaluated by this evaluator
+
+		:param results: (results, states, times) of the agent as returned by `eval`
+		:param base_results: (results, states, times) of the agent to compare against
+		"""
+		self.log.section(f"Comparison of {name} to {base_name}")
+		for i, d in enumerate(self.scrambling_depths):
+			share, base_share = (results[0][i] != -1).mean(), (base_results[0][i] != -1).mean()
+			error = np.sqrt(bernoulli_error(share, self.n_games, 0.05)**2 + bernoulli_error(base_share, self.n_games, 0.05)**2)
+			self.log(
+				f"Scrambling depth {d if d else 'deep'}: Share completed {share*100:.2f} % vs. {base_share*100:.2f} %, "
+				f"difference {(share-base_share)*100:+.2f} % +/- {error*100:.0f} % (approx. 95 % CI)",
+				with_timestamp=False
+			)
+		states_per_sec = [states[times != 0].sum() / times[times != 0].sum() for _, states, times in (results, base_results)]
+		self.log(f"States seen pr. sec.: {states_per_sec[0]:.2f} vs. {states_per_sec[1]:.2f}, ratio {states_per_sec[0]/states_per_sec[1]:.2f}", with_timestamp=False)
+
 	@classmethod
 	def plot_evaluators(cls, eval_results: dict, eval_states: dict, eval_times: dict, eval_settings: dict, save_dir: str, title: str='') -> list:
 		"""
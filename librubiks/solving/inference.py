@@ -0,0 +1,189 @@
+import os
+import queue
+from time import perf_counter
+
+import torch
+import torch.multiprocessing as mp
+
+from librubiks import gpu, cube
+from librubiks.model import Model, InferenceModel
+
+
+class InferenceClient:
+	"""
+	Net-like proxy that evaluates states using an InferenceServer, so it can be given to a DeepAgent in place of a Model.
+	The states are written to a buffer in shared memory, which is also where the server writes the output.
+	It can be passed to worker processes, but each client should only be used by one process at a time.
+	If the server stops before answering a request, the client raises a RuntimeError instead of waiting forever.
+	"""
+	poll_interval = 1  # Seconds between checks of whether the server is running while waiting for an answer
+
+	def __init__(self, client_id: int, requests, done, inputs: torch.tensor, policies: torch.tensor, values: torch.tensor,
+				 server_pid, stopped):
+		self.client_id = client_id
+		self.requests = requests
+		self.done = done
+		self.inputs, self.policies, self.values = inputs, policies, values
+		self.server_pid, self.stopped = server_pid, stopped
+
+	def __call__(self, x: torch.tensor, policy=True, value=True):
+		assert policy or value
+		policies, values = list(), list()
+		# Larger requests than the buffer are split in chunks
+		for start in range(0, len(x), len(self.inputs)):
+			n = min(len(x) - start, len(self.inputs))
+			self.inputs[:n] = x[start:start+n]
+			self.requests.put((self.client_id, n, policy, value))
+			self._wait()
+			if policy: policies.append(self.policies[:n].clone())
+			if value: values.append(self.values[:n].clone())
+
+		return_values = []
+		if policy: return_values.append(torch.cat(policies))
+		if value: return_values.append(torch.cat(values))
+		return return_values if len(return_values) > 1 else return_values[0]
+
+	def _wait(self):
+		# Waits for the server to answer the request. The server sets `stopped` when it exits, but not if it is killed
+		while not self.done.acquire(timeout=self.poll_interval):
+			if self.stopped.is_set() or not _is_running(self.server_pid.value):
+				raise RuntimeError("The inference server stopped before answering the request")
+
+	def eval(self):
+		return self
+
+	def train(self, mode=True):
+		return self
+
+	def to(self, *args, **kwargs):
+		# The output is always on the cpu, as that is where the shared memory is
+		return self
+
+class InferenceServer:
+	"""
+	Process that owns a model and evaluates requests from many search processes in dynamic batches.
+	A request is collected with the requests that arrive within `max_wait` seconds after it, or until `max_batch` states
+	have been collected, and all of them are evaluated in one feedforward.
+	Each client has a preallocated input and output buffer in shared memory, so only small messages are sent through the request queue.
+
+	Usage:
+	```
+	with InferenceServer(loc, use_best, n_clients=4) as server:
+		agent = AStar(server.clients[0], lambda_, expansions)
+	```
+	"""
+	def __init__(self, loc: str, use_best: bool, n_clients: int, max_request: int=2000, max_batch: int=10_000,
+				 max_wait: float=1e-3, frozen: bool=False, quantized: bool=False):
+		"""
+		:param loc: Location of the saved model
+		:param n_clients: Number of clients to create. Each client can be used by one process at a time
+		:param max_request: Maximum number of states in a request. Larger calls to a client are split into multiple requests
+		:param max_batch: Number of states after which the server stops waiting for more requests
+		:param max_wait: Maximum time in seconds the server waits for more requests after the first in a batch
+		:param frozen, quantized: Passed to the model loading, see DeepAgent.from_saved
+		"""
+		self.loc, self.use_best, self.frozen, self.quantized = loc, use_best, frozen, quantized
+		self.max_batch, self.max_wait = max_batch, max_wait
+
+		# The server is spawned rather than forked, as forking after torch has started threads can cause deadlocks
+		self.ctx = mp.get_context("spawn")
+		self.requests = self.ctx.Queue()
+		# Shared with the clients, so they can tell whether the server is running
+		self.server_pid = self.ctx.Value("i", 0)
+		self.stopped = self.ctx.Event()
+		self.clients = list()
+		for i in range(n_clients):
+			self.clients.append(InferenceClient(
+				i, self.requests, self.ctx.Semaphore(0),
+				torch.empty(max_request, cube.get_oh_shape()).share_memory_(),
+				torch.empty(max_request, cube.action_dim).share_memory_(),
+				torch.empty(max_request, 1).share_memory_(),
+				self.server_pid, self.stopped,
+			))
+		self.process = None
+
+	def start(self):
+		ready = self.ctx.Event()
+		self.process = self.ctx.Process(
+			target = _serve,
+			args = (self.loc, self.use_best, self.frozen, self.quantized, cube.get_is2024(), self.requests,
+				[(c.done, c.inputs, c.policies, c.values) for c in self.clients], self.max_batch, self.max_wait, ready, self.stopped),
+			daemon = True,
+		)
+		self.stopped.clear()
+		self.process.start()
+		self.server_pid.value = self.process.pid
+		# Waits for the model to be loaded, so errors are raised here instead of clients waiting forever
+		while not ready.wait(0.1):
+			if not self.process.is_alive():
+				raise RuntimeError(f"Inference server stopped with exit code {self.process.exitcode} before the model was loaded")
+		return self
+
+	def close(self):
+		if self.process is not None:
+			self.requests.put(None)
+			self.process.join()
+			self.process = None
+
+	def __enter__(self):
+		return self.start()
+
+	def __exit__(self, *args):
+		self.close()
+
+def _is_running(pid: int) -> bool:
+	# Works from any process, not only the parent. A zombie process has exited but has not been joined by its parent
+	try:
+		with open(f"/proc/{pid}/stat", encoding="utf-8") as f:
+			return f.read().rsplit(")", 1)[1].split()[0] != "Z"
+	except OSError:
+		try:
+			os.kill(pid, 0)
+		except OSError:
+			return False
+		return True
+
+def _serve(*args):
+	# Clients waiting for an answer are told when the server stops, also if it is because of an error
+	*args, stopped = args
+	try:
+		_serve_requests(*args)
+	finally:
+		stopped.set()
+
+def _serve_requests(loc: str, use_best: bool, frozen: bool, quantized: bool, is2024: bool, requests, clients: list,
+					max_batch: int, max_wait: float, ready):
+	cube.set_is2024(is2024)
+	net = (InferenceModel if frozen else Model).load(loc, load_best=use_best, quantized=quantized).to(gpu).eval()
+	ready.set()
+	stop = False
+	with torch.no_grad():
+		while not stop:
+			batch = [requests.get()]
+			if batch[0] is None: break
+			# Collects requests until the batch is large enough or the deadline is reached
+			n_states = batch[0][1]
+			deadline = perf_counter() + max_wait
+			while n_states < max_batch:
+				try:
+					request = requests.get(timeout=max(deadline-perf_counter(), 0))
+				except queue.Empty:
+					break
+				if request is None:
+					stop = True
+					break
+				batch.append(request)
+				n_states += request[1]
+
+			policy = any(r[2] for r in batch)
+			value = any(r[3] for r in batch)
+			x = torch.cat([clients[client_id][1][:n] for client_id, n, _, _ in batch]).to(gpu)
+			out = net(x, policy=policy, value=value)
+			policies, values = (out if policy and value else (out, None) if policy else (None, out))
+			start = 0
+			for client_id, n, _, _ in batch:
+				done, _, client_policies, client_values = clients[client_id]
+				if policy: client_policies[:n] = policies[start:start+n]
+				if value: client_values[:n] = values[start:start+n]
+				start += n
+				done.release()
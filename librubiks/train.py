@@ -1,20 +1,298 @@
 import os
+import copy
+import inspect
+import queue
+import random
+import socket
 
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 
 from librubiks import gpu, no_grad, reset_cuda, rc_params
-from librubiks.utils import Logger, NullLogger, unverbose, TickTock, TimeUnit, bernoulli_error
+from librubiks.utils import Logger, NullLogger, unverbose, TickTock, TimeUnit, RunningMetrics, bernoulli_error
 
 from librubiks.analysis import TrainAnalysis
 from librubiks import cube
-from librubiks.model import Model
+from librubiks.cube import tensor_cube
+from librubiks.cube.distance_table import DistanceTable
+from librubiks.model import Model, InferenceProfile
 
 from librubiks.solving.agents import DeepAgent
 from librubiks.solving.evaluation import Evaluator
 plt.rcParams.update(rc_params)
 
+class MinibatchSampler:
+	"""
+	Shuffled minibatches of training data that is already on the device.
+	In each epoch, the data is reordered using one on-device permutation, and the batches are contiguous views into the reordered data.
+	This way, batches mix states from different games and scrambling depths, and no copy is made per batch.
+
+	Usage:
+	```
+	sampler = MinibatchSampler(batch_size, epochs=2)
+	for states, targets in sampler(all_states, all_targets):
+		...
+	```
+	"""
+	def __init__(self, batch_size: int, epochs: int=1):
+		self.batch_size = batch_size
+		self.epochs = epochs
+
+	def n_batches(self, size: int) -> int:
+		# Total number of batches over all epochs for data of the given size
+		return int(np.ceil(size / self.batch_size)) * self.epochs
+
+	def __call__(self, *data: torch.tensor):
+		"""
+		Yields a tuple with a batch of each of the given tensors. The tensors must have the same length and be on the same device
+		The final batch in each epoch is smaller if the size is not divisible by the batch size
+		"""
+		size = len(data[0])
+		assert all(len(x) == size for x in data)
+		for _ in range(self.epochs):
+			perm = torch.randperm(size, device=data[0].device)
+			reordered = [x[perm] for x in data]
+			for start in range(0, size, self.batch_size):
+				yield tuple(x[start:start+self.batch_size] for x in reordered)
+
+def _cpu_supports_bf16() -> bool:
+	# The check uses a private op, so the CPU is assumed to support bfloat16 if the op does not exist in this torch version
+	try:
+		return torch.ops.mkldnn._is_mkldnn_bf16_supported()
+	except (AttributeError, RuntimeError):
+		return True
+
+class GeneratorEMA:
+	"""
+	Exponential moving average of the weights of a network, used as the generator network in ADI when tau != 1.
+	After update, the weights are tau * net + (1-tau) * previous weights. The update is done in place on the generator's
+	own tensors, so nothing is allocated or loaded per update. Fused multi-tensor operations are used if torch has them
+	"""
+	def __init__(self, net: Model, tau: float):
+		self.tau = tau
+		self.net = net.clone()
+		self.net.eval()
+		self.float_tensors, self.other_tensors = self._split(self.net)
+
+	@staticmethod
+	def _split(net: Model) -> (list, list):
+		# Floating point parameters and buffers are averaged, others, such as the number of batchnorm batches, are copied
+		tensors = list(net.state_dict().values())
+		return [t for t in tensors if t.is_floating_point()], [t for t in tensors if not t.is_floating_point()]
+
+	@torch.no_grad()
+	def update(self, net: Model) -> Model:
+		float_tensors, other_tensors = self._split(net)
+		if hasattr(torch, "_foreach_lerp_"):
+			torch._foreach_lerp_(self.float_tensors, float_tensors, self.tau)
+		else:
+			for gen_tensor, tensor in zip(self.float_tensors, float_tensors):
+				gen_tensor.lerp_(tensor, self.tau)
+		for gen_tensor, tensor in zip(self.other_tensors, other_tensors):
+			gen_tensor.copy_(tensor)
+		return self.net
+
+class FeedforwardPlanner:
+	"""
+	Evaluates the values of many states, such as the substates in ADI, in chunks that are as large as memory allows.
+	The chunk size is planned before the feedforward from the memory available on the device and an estimate of the
+	activation memory per state, which is found from the layer sizes in the model config. The values of the chunks are
+	written into one preallocated tensor. After each chunk, the plan is checked against the memory in use: On cuda, the
+	peak allocation of the chunk is measured, and on the host, the available memory is read again. If either has drifted,
+	the chunk size is lowered for the rest of the feedforward, and measured memory use is remembered for later feedforwards.
+
+	Usage:
+	```
+	planner = FeedforwardPlanner()
+	values = planner(net, oh_states)
+	```
+	"""
+	memory_fraction = 0.5  # Share of the available memory that activations are planned to use
+
+	def __init__(self, memory_limit: int=None, logger: Logger=NullLogger()):
+		"""
+		:param int memory_limit: If given, at most this many bytes are considered available
+		"""
+		self.memory_limit = memory_limit
+		self.measured_bytes = 0  # Largest measured memory use per state
+		self.log = logger
+
+	@staticmethod
+	def available_memory(device: torch.device) -> int:
+		# Bytes that can be allocated on the device. On cuda, this includes memory cached by torch
+		if device.type == "cuda":
+			if hasattr(torch.cuda, "mem_get_info"):
+				free, _ = torch.cuda.mem_get_info(device)
+				return free + torch.cuda.memory_reserved(device) - torch.cuda.memory_allocated(device)
+			# Older torch versions cannot see memory used by other processes, so all memory not allocated by torch is assumed free
+			return torch.cuda.get_device_properties(device).total_memory - torch.cuda.memory_allocated(device)
+		try:
+			with open("/proc/meminfo", encoding="utf-8") as f:
+				meminfo = dict(line.split(":") for line in f)
+			return int(meminfo["MemAvailable"].split()[0]) * 1024
+		except (OSError, KeyError):
+			return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+	def bytes_per_state(self, net: Model) -> int:
+		# float32 activations are used as the estimate, as they are at least as large as the bfloat16 ones from autocast
+		return max(4 * net.config.activation_size(), self.measured_bytes)
+
+	def plan(self, net: Model, n: int, device: torch.device=gpu) -> int:
+		# Number of states in each chunk when evaluating n states
+		available = self.available_memory(device)
+		if self.memory_limit is not None:
+			available = min(available, self.memory_limit)
+		return int(max(1, min(n, self.memory_fraction * available // self.bytes_per_state(net))))
+
+	@no_grad
+	def __call__(self, net: Model, oh_states: torch.tensor, chunk_size: int=None) -> torch.tensor:
+		"""
+		Returns the float32 values of all states
+		:param int chunk_size: Planned chunk size. If not given, it is planned using `plan`
+		"""
+		device = oh_states.device
+		values = torch.empty(len(oh_states), device=device)
+		chunk_size = chunk_size or self.plan(net, len(oh_states), device)
+		start = 0
+		while start < len(oh_states):
+			chunk = oh_states[start:start+chunk_size]
+			if device.type == "cuda":
+				torch.cuda.reset_peak_memory_stats(device)
+				baseline = torch.cuda.memory_allocated(device)
+			try:
+				values[start:start+len(chunk)] = net(chunk, policy=False, value=True).squeeze(1)
+			except RuntimeError as e:  # Out of memory despite the plan. Other errors are raised
+				if "alloc" not in str(e) or chunk_size == 1:
+					raise e
+				self.measured_bytes = max(self.measured_bytes, 2 * self.bytes_per_state(net))
+				self.log.verbose(f"Intercepted RuntimeError {e}\nLowering feedforward chunk size from {chunk_size} to {chunk_size//2}")
+				chunk_size //= 2
+				continue
+			start += len(chunk)
+			if device.type == "cuda":
+				self.measured_bytes = max(self.measured_bytes, (torch.cuda.max_memory_allocated(device) - baseline) // len(chunk))
+			replanned = self.plan(net, len(oh_states), device)
+			if replanned < chunk_size:
+				self.log.verbose(f"Memory use drifted from the plan. Lowering feedforward chunk size from {chunk_size} to {replanned}")
+				chunk_size = replanned
+		return values
+
+class DepthCurriculum:
+	"""
+	Adaptive distribution of the scrambling depths of the states generated in ADI.
+	After each rollout, the mean value target at each depth, as in TrainAnalysis.avg_value_targets, is compared with the one from the
+	previous rollout, and a moving average of the absolute change is kept for each depth. Depths whose targets are still changing
+	get a larger share of the states in the next rollout. Half of the shares are uniform by default, so converged depths are still
+	trained on, and each depth gets at most max_ratio times its uniform share, which limits how many games are scrambled.
+	Depths are indexed by the position of the state in its game, such that the solved state is at index 0 when it is included
+	"""
+	def __init__(self, depth: int, uniform_share: float=0.5, max_ratio: float=4, smoothing: float=0.9):
+		self.depth = depth
+		self.uniform_share = uniform_share
+		self.max_ratio = max_ratio
+		assert self.max_ratio >= 1, "Each depth must be allowed at least its uniform share"
+		self.smoothing = smoothing
+		self.mean_targets = None  # Mean value target at each depth in the latest rollout
+		self.changes = np.zeros(self.depth)  # Moving average of the absolute change of the mean value targets
+		self.shares = np.full(self.depth, 1 / self.depth)
+
+	def counts(self, n: int) -> np.ndarray:
+		# Number of states at each depth such that there are n in total. The rounding remainders go to the largest fractions
+		exact = self.shares * n
+		counts = np.floor(exact).astype(int)
+		counts[np.argsort(counts - exact)[:n-counts.sum()]] += 1
+		return counts
+
+	def update(self, mean_targets: np.ndarray):
+		"""
+		Updates the shares from the mean value target at each depth in a rollout
+		Depths without any states in the rollout are nan and keep their previous mean
+		"""
+		if self.mean_targets is not None:
+			mean_targets = np.where(np.isnan(mean_targets), self.mean_targets, mean_targets)
+			self.changes = self.smoothing * self.changes + (1 - self.smoothing) * np.abs(mean_targets - self.mean_targets)
+		self.mean_targets = mean_targets
+		if self.changes.sum() > 0:
+			ratios = self.uniform_share + (1 - self.uniform_share) * self.depth * self.changes / self.changes.sum()
+			self.shares = self._cap(ratios / ratios.sum())
+
+	def _cap(self, shares: np.ndarray) -> np.ndarray:
+		# Caps the shares at max_ratio times the uniform share. The excess is given to the uncapped depths in proportion
+		# to their shares, which is repeated until no depth is above the cap
+		cap = self.max_ratio / self.depth
+		capped = np.zeros(self.depth, dtype=bool)
+		while (shares > cap * (1 + 1e-12)).any():
+			capped |= shares >= cap
+			shares = np.where(capped, cap, shares)
+			free = shares[~capped].sum()
+			shares[~capped] *= (1 - cap * capped.sum()) / free
+		return shares
+
+	def state_dict(self) -> dict:
+		return { "mean_targets": self.mean_targets, "changes": self.changes, "shares": self.shares }
+
+	def load_state_dict(self, state: dict):
+		self.mean_targets, self.changes, self.shares = state["mean_targets"], state["changes"], state["shares"]
+
+class AsyncEvaluator:
+	"""
+	Evaluates snapshots of a network in a background process, so training continues while the snapshots are evaluated.
+	Snapshots are evaluated in the order they are submitted, and finished evaluations are collected using `results`.
+
+	Usage:
+	```
+	async_evaluator = AsyncEvaluator(evaluator, agent, net.config)
+	async_evaluator.submit(rollout, net)
+	for rollout, sol_percent, snapshot in async_evaluator.results(wait=True):
+		...
+	async_evaluator.close()
+	```
+	"""
+	def __init__(self, evaluator: Evaluator, agent: DeepAgent, config, inference_profile: InferenceProfile=None):
+		# The process is spawned rather than forked, as forking after torch has started threads can cause deadlocks
+		self.ctx = mp.get_context("spawn")
+		self.snapshots = self.ctx.Queue()
+		self.finished = self.ctx.Queue()
+		self.pending = dict()  # Snapshots that have not been evaluated yet by rollout
+		self.process = self.ctx.Process(
+			target = _evaluate_snapshots,
+			args = (evaluator, agent, config, inference_profile, cube.get_is2024(), self.snapshots, self.finished),
+			daemon = True,
+		)
+		self.process.start()
+
+	def submit(self, rollout: int, net: Model):
+		# Sends a copy of the current weights of net to be evaluated
+		snapshot = net.clone().eval()
+		self.pending[rollout] = snapshot
+		self.snapshots.put((rollout, { name: tensor.cpu() for name, tensor in snapshot.state_dict().items() }))
+
+	def results(self, wait: bool=False) -> list:
+		"""
+		Finished evaluations as a list of (rollout, solve rate, snapshot) in the order they were submitted
+		:param wait: If true, waits for all submitted snapshots to be evaluated, else only returns those already finished
+		"""
+		results = list()
+		while self.pending:
+			try:
+				rollout, sol_percent = self.finished.get(timeout=1) if wait else self.finished.get_nowait()
+			except queue.Empty:
+				if not self.process.is_alive():
+					raise RuntimeError(f"Evaluation process stopped with exit code {self.process.exitcode}")
+				if wait: continue
+				break
+			results.append((rollout, sol_percent, self.pending.pop(rollout)))
+		return results
+
+	def close(self):
+		if self.process is not None:
+			self.snapshots.put(None)
+			self.process.join()
+			self.process = None
+
 class Train:
 
 	states_per_rollout: int
@@ -23,6 +301,9 @@ class Train:
 	value_losses: np.ndarray
 	policy_losses: np.ndarray
 	train_losses: np.ndarray
+	precision_loss_diffs: np.ndarray
+	dedup_ratios: np.ndarray
+	depth_shares: np.ndarray
 	sol_percents: list
 
 	def __init__(self,
@@ -44,6 +325,15 @@ class Train:
 				 policy_criterion	= torch.nn.CrossEntropyLoss,
 				 value_criterion	= torch.nn.MSELoss,
 				 logger: Logger		= NullLogger(),
+				 inference_profile: InferenceProfile = None,
+				 mixed_precision: bool = False,
+				 workers: int = 1,
+				 epochs: int = 1,
+				 async_evaluation: bool = False,
+				 checkpoint_interval: int = 0,
+				 checkpoint_dir: str = "",
+				 distance_table: DistanceTable = None,
+				 depth_curriculum: bool = False,
 				 ):
 		"""Sets up evaluation array, instantiates critera and stores and documents settings
 
@@ -52,14 +342,34 @@ class Train:
 		:param float alpha_update: alpha <- alpha + alpha_update every update_interval rollouts (excl. rollout 0)
 		:param float gamma: lr <- lr * gamma every update_interval rollouts (excl. rollout 0)
 		:param float tau: How much of the new network to use to generate ADI data
+		:param InferenceProfile inference_profile: If given, the fastest number of threads for the batch sizes is used
+			in ADI feedforward, training, and evaluation
+		:param bool mixed_precision: If true, ADI feedforward and the forward and backward passes in training run under bfloat16 autocast.
+			The parameters and optimizer stay in float32, and the relative difference to the float32 loss is logged for each rollout
+		:param int workers: Number of data-parallel training processes. Each generates rollout_games / workers games of ADI data
+			and trains on batches of batch_size / workers states, and the gradients are averaged over all processes.
+			Logging, analysis, and evaluation are only done by the calling process
+		:param int epochs: Number of passes over the training data of each rollout. Each pass is in a new random order
+		:param bool async_evaluation: If true, evaluations are done on snapshots of the network in a background process, so training does not wait for them.
+			The solve rates and best network are updated when the evaluations finish, and training waits for the remaining ones at the end
+		:param int checkpoint_interval: A checkpoint with everything needed to resume training is saved to checkpoint_dir every checkpoint_interval rollouts.
+			Set to 0 for never
+		:param DistanceTable distance_table: If given, ADI substates in the table get their exact values instead of being evaluated by the net
+		:param bool depth_curriculum: If true, the number of states at each scrambling depth in ADI is set by a DepthCurriculum,
+			which shifts the states toward depths whose value targets are still changing. Else, each game has a state at every depth
 		"""
 		self.rollouts = rollouts
 		self.train_rollouts = np.arange(self.rollouts)
 		self.batch_size = self.states_per_rollout if not batch_size else batch_size
 		self.rollout_games = rollout_games
 		self.rollout_depth = rollout_depth
-		self.adi_ff_batches = 1  # Number of batches used for feedforward in ADI_traindata. Used to limit vram usage
 		self.reward_method = reward_method
+		self.epochs = epochs
+		assert self.epochs > 0
+		self.workers = workers
+		self.rank = 0  # Rank of this process in data-parallel training. Only rank 0 logs and evaluates
+		assert self.workers > 0 and self.rollout_games % self.workers == 0 and self.batch_size % self.workers == 0,\
+			f"rollout_games and batch_size must be divisible by the number of workers, {self.workers}"
 
 		# Perform evaluation every evaluation_interval and after last rollout
 		if evaluation_interval:
@@ -85,7 +395,21 @@ class Train:
 		self.value_criterion = value_criterion(reduction='none')
 
 		self.evaluator = evaluator
+		self.async_evaluation = async_evaluation
+		self.checkpoint_interval = checkpoint_interval
+		self.checkpoint_dir = checkpoint_dir
+		assert not self.checkpoint_interval or self.checkpoint_dir, "A checkpoint directory must be given to save checkpoints"
+		self.distance_table = distance_table
+		self.curriculum = DepthCurriculum(self.rollout_depth) if depth_curriculum else None
+		self.inference_profile = inference_profile
+		self.mixed_precision = mixed_precision
 		self.log = logger
+		self.adi_ff_planner = FeedforwardPlanner(logger=self.log)  # Limits the memory used by the feedforward in ADI_traindata
+		if self.inference_profile is not None and self.workers > 1:
+			self.log("Warning: The inference profile is not used when training with more than one worker, as the threads are shared between the workers")
+			self.inference_profile = None
+		if self.mixed_precision and gpu.type == "cpu" and not _cpu_supports_bf16():
+			self.log("Warning: The CPU does not support bfloat16 natively, so mixed precision will likely be slower than float32")
 		self.log("\n".join([
 			"Created trainer",
 			f"Alpha update: {self.alpha_update:.2f}",
@@ -98,7 +422,13 @@ class Train:
 			f"Batch size:     {self.batch_size}",
 			f"Rollout games:  {self.rollout_games}",
 			f"Rollout depth:  {self.rollout_depth}",
+			f"Epochs:         {self.epochs}",
 			f"alpha update:   {self.alpha_update}",
+			f"Precision:      {'bfloat16 autocast' if self.mixed_precision else 'float32'}",
+			f"Workers:        {self.workers}",
+			f"Evaluation:     {'Asynchronous' if self.async_evaluation else 'Inline'}",
+			f"Distance table: {f'{len(self.distance_table):,} states within {self.distance_table.depth} moves' if self.distance_table is not None else 'None'}",
+			f"Depths:         {'Adaptive curriculum' if self.curriculum is not None else 'Uniform'}",
 		]))
 
 		self.with_analysis = with_analysis
@@ -108,7 +438,7 @@ class Train:
 		self.tt = TickTock()
 
 
-	def train(self, net: Model) -> (Model, Model):
+	def train(self, net: Model, resume: bool=False) -> (Model, Model):
 		""" Training loop: generates data, optimizes parameters, evaluates (sometimes) and repeats.
 
 		Trains `net` for `self.rollouts` rollouts each consisting of `self.rollout_games` games and scrambled  `self.rollout_depth`.
@@ -116,14 +446,43 @@ class Train:
 		Stores multiple performance and training results.
 
 		:param torch.nn.Model net: The network to be trained. Must accept input consistent with cube.get_oh_size()
+		:param bool resume: If true and there is a checkpoint in `self.checkpoint_dir`, training continues from the checkpoint.
+			The weights of `net` are replaced by those in the checkpoint
 		:return: The network after all evaluations and the network with the best evaluation score (win fraction)
 		:rtype: (torch.nn.Model, torch.nn.Model)
 		"""
-
+		if self.workers == 1:
+			return self._train(net, resume)
+
+		# Data-parallel training: This process is rank 0, and the other workers are spawned with a copy of the trainer and net
+		# The workers are spawned rather than forked, as forking after torch has started threads can cause deadlocks
+		port = _free_port()
+		seed = int(torch.randint(2**31, ()))
+		threads = max(torch.get_num_threads() // self.workers, 1)
+		ctx = mp.get_context("spawn")
+		processes = [ctx.Process(
+			target = _train_worker,
+			args = (self._worker_copy(), rank, port, net, resume, seed, threads, cube.get_is2024()),
+			daemon = True,
+		) for rank in range(1, self.workers)]
+		for process in processes: process.start()
+
+		orig_threads = torch.get_num_threads()
+		torch.set_num_threads(threads)
+		dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=0, world_size=self.workers)
+		try:
+			return self._train(net, resume)
+		finally:
+			dist.destroy_process_group()
+			for process in processes: process.join()
+			torch.set_num_threads(orig_threads)
+
+	def _train(self, net: Model, resume: bool) -> (Model, Model):
 		self.tt.reset()
 		self.tt.tick()
 		self.states_per_rollout = self.rollout_depth * self.rollout_games
-		self.log(f"Beginning training. Optimization is performed in batches of {self.batch_size}")
+		self.log(f"Beginning training. Optimization is performed in batches of {self.batch_size}"
+				 + (f" split over {self.workers} workers" if self.workers > 1 else ""))
 		self.log("\n".join([
 			f"Rollouts: {self.rollouts}",
 			f"Each consisting of {self.rollout_games} games with a depth of {self.rollout_depth}",
@@ -131,11 +490,14 @@ class Train:
 		]))
 		best_solve = 0
 		best_net = net.clone()
+		async_evaluator = AsyncEvaluator(self.evaluator, self.agent, net.config, self.inference_profile)\
+			if self.async_evaluation and len(self.evaluation_rollouts) else None
+		net.inference_profile = self.inference_profile  # Used by the agent during evaluation
 		self.agent.net = net
 		if self.with_analysis:
 			self.analysis.orig_params = net.get_params()
 
-		generator_net = net.clone()
+		generator = GeneratorEMA(net, self.tau) if self.tau != 1 else None
 
 		alpha = 1 if self.alpha_update == 1 else 0
 		optimizer = self.optim(net.parameters(), lr=self.lr)
@@ -143,50 +505,79 @@ class Train:
 		self.policy_losses = np.zeros(self.rollouts)
 		self.value_losses = np.zeros(self.rollouts)
 		self.train_losses = np.empty(self.rollouts)
+		self.precision_loss_diffs = np.zeros(self.rollouts)
+		self.dedup_ratios = np.zeros(self.rollouts)
+		self.depth_shares = np.full((self.rollouts, self.rollout_depth), 1 / self.rollout_depth)
 		self.sol_percents = list()
 
-		for rollout in range(self.rollouts):
+		start_rollout = 0
+		if resume and os.path.exists(self._checkpoint_path()):
+			start_rollout, alpha, best_solve = self._load_checkpoint(net, generator, best_net, optimizer, lr_scheduler)
+			self.log(f"Resuming training from checkpoint after {start_rollout} rollouts")
+		elif resume:
+			self.log(f"No checkpoint found in {self.checkpoint_dir}, so training starts from the beginning")
+
+		for rollout in range(start_rollout, self.rollouts):
 			reset_cuda()
 
-			generator_net = self._update_gen_net(generator_net, net) if self.tau != 1 else net
+			if generator is not None:
+				self.tt.profile("Updating generator network")
+				generator_net = generator.update(net)
+				self.tt.end_profile("Updating generator network")
+			else:
+				generator_net = net
 
+			if self.curriculum is not None:
+				self.depth_shares[rollout] = self.curriculum.shares
 			self.tt.profile("ADI training data")
+			# The training data is generated on the device, so it does not have to be moved
 			training_data, policy_targets, value_targets, loss_weights = self.ADI_traindata(generator_net, alpha)
-			self.tt.profile("To cuda")
-			training_data = training_data.to(gpu)
-			policy_targets = policy_targets.to(gpu)
-			value_targets = value_targets.to(gpu)
-			loss_weights = loss_weights.to(gpu)
-			self.tt.end_profile("To cuda")
+			self.dedup_ratios[rollout] = self.dedup_ratio
 			self.tt.end_profile("ADI training data")
 
 			reset_cuda()
 
 			self.tt.profile("Training loop")
+			if self.inference_profile is not None:
+				self.inference_profile.apply(self.batch_size)
 			net.train()
-			batches = self._get_batches(self.states_per_rollout, self.batch_size)
-			for i, batch in enumerate(batches):
+			sampler = MinibatchSampler(self.batch_size // self.workers, self.epochs)
+			# The losses are summed on the device, so the loop does not wait for each batch to finish
+			metrics = RunningMetrics("policy_loss", "value_loss")
+			for i, batch in enumerate(sampler(training_data, policy_targets, value_targets, loss_weights)):
+				if i == 0:
+					first_batch = batch
+				states_batch, policy_batch, value_batch, weight_batch = batch
 				optimizer.zero_grad()
-				policy_pred, value_pred = net(training_data[batch], policy=True, value=True)
+				with self._autocast():
+					policy_pred, value_pred = net(states_batch, policy=True, value=True)
 
-				# Use loss on both policy and value
-				policy_loss = self.policy_criterion(policy_pred, policy_targets[batch]) * loss_weights[batch]
-				value_loss = self.value_criterion(value_pred.squeeze(), value_targets[batch]) * loss_weights[batch]
+				# Use loss on both policy and value. The losses are always computed in float32
+				policy_loss = self.policy_criterion(policy_pred.float(), policy_batch) * weight_batch
+				value_loss = self.value_criterion(value_pred.float().squeeze(), value_batch) * weight_batch
 				loss = torch.mean(policy_loss + value_loss)
 				loss.backward()
+				if self.workers > 1:
+					self._all_reduce_grads(net)
 				optimizer.step()
-				self.policy_losses[rollout] += policy_loss.detach().cpu().numpy().mean() / len(batches)
-				self.value_losses[rollout] += value_loss.detach().cpu().numpy().mean() / len(batches)
+				metrics.add("policy_loss", policy_loss.mean())
+				metrics.add("value_loss", value_loss.mean())
 
-				if self.with_analysis: #Save policy output to compute entropy
-					with torch.no_grad():
-						self.analysis.rollout_policy.append(
-							torch.nn.functional.softmax(policy_pred.detach(), dim=0).cpu().numpy()
-						)
+				if self.with_analysis:
+					self.analysis.batch(policy_pred.detach())
 
+			means = metrics.means()
+			self.policy_losses[rollout], self.value_losses[rollout] = means["policy_loss"], means["value_loss"]
+			if self.workers > 1:
+				self._sync_rollout(net, rollout)
 			self.train_losses[rollout] = (self.policy_losses[rollout] + self.value_losses[rollout])
 			self.tt.end_profile("Training loop")
 
+			if self.mixed_precision and not self.rank:
+				self.tt.profile("Mixed precision loss difference")
+				self.precision_loss_diffs[rollout] = self._precision_loss_diff(net, *first_batch)
+				self.tt.end_profile("Mixed precision loss difference")
+
 			# Updates learning rate and alpha
 			if rollout and self.update_interval and rollout % self.update_interval == 0:
 				if self.gamma != 1:
@@ -201,58 +592,80 @@ class Train:
 					alpha = 1
 
 			if self.log.is_verbose() or rollout in (np.linspace(0, 1, 20)*self.rollouts).astype(int):
-				self.log(f"Rollout {rollout} completed with mean loss {self.train_losses[rollout]}")
+				self.log(f"Rollout {rollout} completed with mean loss {self.train_losses[rollout]}. "
+						 f"{self.dedup_ratios[rollout]*100:.1f} % of ADI substates were duplicates"
+						 + (f". Mean scrambling depth: {self.depth_shares[rollout] @ self._depths():.2f}" if self.curriculum is not None else "")
+						 + (f". bfloat16 loss differs from float32 by {self.precision_loss_diffs[rollout]*100:.3f} %" if self.mixed_precision else ""))
 
 			if self.with_analysis:
 				self.tt.profile("Analysis of rollout")
-				self.analysis.rollout(net, rollout, value_targets)
+				self.analysis.rollout(net, rollout, value_targets, self.positions)
 				self.tt.end_profile("Analysis of rollout")
 
+			evaluations = list()
 			if rollout in self.evaluation_rollouts:
 				net.eval()
 
 				self.agent.net = net
 				self.tt.profile(f"Evaluating using agent {self.agent}")
-				with unverbose:
-					eval_results, _, _ = self.evaluator.eval(self.agent)
-				eval_reward = (eval_results != -1).mean()
-				self.sol_percents.append(eval_reward)
+				if async_evaluator is not None:
+					async_evaluator.submit(rollout, net)
+				else:
+					with unverbose:
+						eval_results, _, _ = self.evaluator.eval(self.agent)
+					evaluations.append((rollout, (eval_results != -1).mean(), net))
 				self.tt.end_profile(f"Evaluating using agent {self.agent}")
 
-				if eval_reward > best_solve:
-					best_solve = eval_reward
-					best_net = net.clone()
-					self.log(f"Updated best net with solve rate {eval_reward*100:.2f} % at depth {self.evaluator.scrambling_depths}")
+			if async_evaluator is not None:
+				evaluations += async_evaluator.results()
+			best_solve, best_net = self._update_best(evaluations, best_solve, best_net)
+
+			if self.checkpoint_interval and (rollout + 1) % self.checkpoint_interval == 0 and not self.rank:
+				if async_evaluator is not None:
+					# The checkpoint includes all evaluations up to this point
+					best_solve, best_net = self._update_best(async_evaluator.results(wait=True), best_solve, best_net)
+				self.tt.profile("Saving checkpoint")
+				self._save_checkpoint(rollout + 1, net, generator, best_net, best_solve, alpha, optimizer, lr_scheduler)
+				self.tt.end_profile("Saving checkpoint")
+
+		if async_evaluator is not None:
+			self.tt.profile(f"Evaluating using agent {self.agent}")
+			best_solve, best_net = self._update_best(async_evaluator.results(wait=True), best_solve, best_net)
+			async_evaluator.close()
+			self.tt.end_profile(f"Evaluating using agent {self.agent}")
 
 		self.log.section("Finished training")
 		if len(self.evaluation_rollouts):
 			self.log(f"Best net solves {best_solve*100:.2f} % of games at depth {self.evaluator.scrambling_depths}")
+		if self.mixed_precision:
+			self.log(f"bfloat16 loss differs from float32 by {np.abs(self.precision_loss_diffs).mean()*100:.3f} % on average "
+					 f"and at most {np.abs(self.precision_loss_diffs).max()*100:.3f} %")
 		self.log.verbose("Training time distribution")
 		self.log.verbose(self.tt)
 		total_time = self.tt.tock()
-		eval_time = self.tt.profiles[f'Evaluating using agent {self.agent}'].sum() if len(self.evaluation_rollouts) else 0
-		train_time = self.tt.profiles["Training loop"].sum()
-		adi_time = self.tt.profiles["ADI training data"].sum()
-		nstates = self.rollouts * self.rollout_games * self.rollout_depth * cube.action_dim
-		states_per_sec = int(nstates / (adi_time+train_time))
+		# Profiles may be missing if training was resumed from a checkpoint after the last rollout
+		profile_time = lambda name: self.tt.profiles[name].sum() if name in self.tt.profiles else 0
+		eval_time = profile_time(f'Evaluating using agent {self.agent}')
+		train_time = profile_time("Training loop")
+		adi_time = profile_time("ADI training data")
+		# Speeds are of the rollouts in this run, which is all of them unless resumed
+		rollouts_run = self.rollouts - start_rollout
+		nstates = rollouts_run * self.rollout_games * self.rollout_depth * cube.action_dim
+		states_per_sec = int(nstates / (adi_time+train_time)) if rollouts_run else 0
+		samples_per_sec = int(rollouts_run * self.states_per_rollout * self.epochs / train_time) if rollouts_run else 0
 		self.log("\n".join([
 			f"Total running time:               {self.tt.stringify_time(total_time, TimeUnit.second)}",
 			f"- Training data for ADI:          {self.tt.stringify_time(adi_time, TimeUnit.second)} or {adi_time/total_time*100:.2f} %",
 			f"- Training time:                  {self.tt.stringify_time(train_time, TimeUnit.second)} or {train_time/total_time*100:.2f} %",
 			f"- Evaluation time:                {self.tt.stringify_time(eval_time, TimeUnit.second)} or {eval_time/total_time*100:.2f} %",
 			f"States witnessed incl. substates: {TickTock.thousand_seps(nstates)}",
+			f"- Duplicates not evaluated:       {self.dedup_ratios.mean()*100:.2f} %",
 			f"- Per training second:            {TickTock.thousand_seps(states_per_sec)}",
+			f"Training samples per second:      {TickTock.thousand_seps(samples_per_sec)}",
 		]))
 
 		return net, best_net
 
-	def _get_adi_ff_slices(self):
-		data_points = self.rollout_games * self.rollout_depth * cube.action_dim
-		slice_size = data_points // self.adi_ff_batches + 1
-		# Final slice may have overflow, however this is simply ignored when indexing
-		slices = [slice(i*slice_size, (i+1)*slice_size) for i in range(self.adi_ff_batches)]
-		return slices
-
 	@no_grad
 	def ADI_traindata(self, net, alpha: float):
 		""" Training data generation
@@ -270,86 +683,287 @@ class Train:
 
 		:rtype: (torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor)
 
+		The share of substates that were duplicates and thus not evaluated is stored in `self.dedup_ratio`, and the position of each
+		state in its game is stored in `self.positions`. With a depth curriculum, the curriculum is updated from the value targets
 		"""
 		net.eval()
+		# States are generated on the device using the torch cube, so the data stays there all the way to the loss
 		self.tt.profile("Scrambling")
 		# Only include solved state in training if using Max Lapan convergence fix
-		states, oh_states = cube.sequence_scrambler(self.rollout_games, self.rollout_depth, with_solved = self.reward_method == 'lapanfix')
+		# In data-parallel training, each worker generates its share of the games
+		games = self.rollout_games // self.workers
+		with_solved = self.reward_method == 'lapanfix'
+		if self.curriculum is not None:
+			states, self.positions = self._curriculum_scramble(self.curriculum.counts(games * self.rollout_depth), with_solved)
+			oh_states = tensor_cube.as_oh(states)
+		else:
+			states, oh_states = tensor_cube.sequence_scrambler(games, self.rollout_depth, with_solved, device=gpu)
+			self.positions = torch.arange(self.rollout_depth, device=gpu).repeat(games)
 		self.tt.end_profile("Scrambling")
 
 		# Keeps track of solved states - Max Lapan's convergence fix
-		solved_scrambled_states = cube.multi_is_solved(states)
+		solved_scrambled_states = tensor_cube.multi_is_solved(states)
 
 		# Generates possible substates for all scrambled states. Shape: n_states*action_dim x *Cube_shape
 		self.tt.profile("ADI substates")
-		substates = cube.multi_rotate(np.repeat(states, cube.action_dim, axis=0), *cube.iter_actions(len(states)))
+		substates = tensor_cube.multi_rotate(states.repeat_interleave(cube.action_dim, dim=0), *tensor_cube.iter_actions(len(states), gpu))
 		self.tt.end_profile("ADI substates")
+
+		# Many substates are identical, e.g. a substate of a state is often also the substate of the next state in the game,
+		# so only the unique substates are encoded and evaluated, and the values are scattered back by inverse index
+		self.tt.profile("Deduplicating substates")
+		unique_substates, inverse = tensor_cube.unique(substates)
+		self.dedup_ratio = 1 - len(unique_substates) / len(substates)
+		self.tt.end_profile("Deduplicating substates")
+
+		# Substates in the distance table get their exact values, so only the others are evaluated by the net
+		unique_values = torch.empty(len(unique_substates), device=gpu)
+		evaluate = torch.ones(len(unique_substates), dtype=torch.bool, device=gpu)
+		if self.distance_table is not None:
+			self.tt.profile("Distance table lookup")
+			distances = self.distance_table.lookup(unique_substates)
+			evaluate = distances < 0
+			unique_values[~evaluate] = self._exact_values(distances[~evaluate])
+			self.tt.end_profile("Distance table lookup")
+
 		self.tt.profile("One-hot encoding")
-		substates_oh = cube.as_oh(substates)
+		substates_oh = tensor_cube.as_oh(unique_substates[evaluate])
 		self.tt.end_profile("One-hot encoding")
 
 		self.tt.profile("Reward")
-		solved_substates = cube.multi_is_solved(substates)
+		solved_substates = tensor_cube.multi_is_solved(substates)
 		# Reward for won state is 1 normally but 0 if running with reward0
-		rewards = (torch.zeros if self.reward_method == 'reward0' else torch.ones)\
-			(*solved_substates.shape)
-		rewards[~solved_substates] = -1
+		rewards = torch.full(solved_substates.shape, -1.0, device=gpu)
+		rewards[solved_substates] = 0 if self.reward_method == 'reward0' else 1
 		self.tt.end_profile("Reward")
 
 		# Generates policy and value targets
 		self.tt.profile("ADI feedforward")
-		while True:
-			try:
-				value_parts = [net(substates_oh[slice_], policy=False, value=True).squeeze() for slice_ in self._get_adi_ff_slices()]
-				values = torch.cat(value_parts).cpu()
-				break
-			except RuntimeError as e:  # Usually caused by running out of vram. If not, the error is still raised, else batch size is reduced
-				if "alloc" not in str(e):
-					raise e
-				self.log.verbose(f"Intercepted RuntimeError {e}\nIncreasing number of ADI feed forward batches from {self.adi_ff_batches} to {self.adi_ff_batches*2}")
-				self.adi_ff_batches *= 2
+		chunk_size = self.adi_ff_planner.plan(net, len(substates_oh), gpu)
+		if self.inference_profile is not None:
+			self.inference_profile.apply(chunk_size)
+		with self._autocast():
+			unique_values[evaluate] = self.adi_ff_planner(net, substates_oh, chunk_size)
 		self.tt.end_profile("ADI feedforward")
 
 		self.tt.profile("Calculating targets")
-		values += rewards
+		values = unique_values[inverse] + rewards
 		values = values.reshape(-1, 12)
 		policy_targets = torch.argmax(values, dim=1)
-		value_targets = values[np.arange(len(values)), policy_targets]
+		value_targets = values[torch.arange(len(values), device=gpu), policy_targets]
 		if self.reward_method == 'lapanfix':
 			# Trains on goal state, sets goalstate to 0
 			value_targets[solved_scrambled_states] = 0
 		elif self.reward_method == 'schultzfix':
 			# Does not train on goal state, but sets first 12 substates to 0
-			first_substates = np.zeros(len(states), dtype=bool)
-			first_substates[np.arange(0, len(states), self.rollout_depth)] = True
-			value_targets[first_substates] = 0
+			value_targets[self.positions == 0] = 0
 
 		self.tt.end_profile("Calculating targets")
 
 		# Weighting examples according to alpha
-		weighted = np.tile(1 / np.arange(1, self.rollout_depth+1), self.rollout_games)
-		unweighted = np.ones_like(weighted)
-		ws, us = weighted.sum(), len(unweighted)
-		loss_weights = ((1-alpha) * weighted / ws + alpha * unweighted / us) * (ws + us)
+		weighted = 1 / (self.positions + 1).double()
+		ws, us = weighted.sum(), len(weighted)
+		loss_weights = ((1-alpha) * weighted / ws + alpha / us) * (ws + us)
+
+		if self.curriculum is not None:
+			self.tt.profile("Updating depth curriculum")
+			self._update_curriculum(value_targets)
+			self.tt.end_profile("Updating depth curriculum")
 
 		if self.with_analysis:
 			self.tt.profile("ADI analysis")
 			self.analysis.ADI(values)
 			self.tt.end_profile("ADI analysis")
-		return oh_states, policy_targets, value_targets, torch.from_numpy(loss_weights).float()
-
-	def _update_gen_net(self, generator_net: Model, net: Model):
-		"""Create a network with parameters weighted by self.tau"""
-		self.tt.profile("Creating generator network")
-		genparams, netparams = generator_net.state_dict(), net.state_dict()
-		new_genparams = dict(genparams)
-		for pname, param in netparams.items():
-			new_genparams[pname].data.copy_(
-					self.tau * param.data.to(gpu) + (1-self.tau) * new_genparams[pname].data.to(gpu)
-					)
-		generator_net.load_state_dict(new_genparams)
-		self.tt.end_profile("Creating generator network")
-		return generator_net.to(gpu)
+		return oh_states, policy_targets, value_targets, loss_weights.float()
+
+	def _curriculum_scramble(self, counts: np.ndarray, with_solved: bool) -> (torch.tensor, torch.tensor):
+		"""
+		Scrambles enough games to take counts[i] states at position i from different games
+		:return: The states and their positions in their games
+		"""
+		states, _ = tensor_cube.sequence_scrambler(int(counts.max()), self.rollout_depth, with_solved, device=gpu)
+		states = states.reshape(int(counts.max()), self.rollout_depth, *cube.shape())
+		counts = torch.from_numpy(counts).to(gpu)
+		positions = torch.repeat_interleave(torch.arange(self.rollout_depth, device=gpu), counts)
+		# The i'th state at each position is taken from game i
+		games = torch.arange(len(positions), device=gpu) - torch.repeat_interleave(torch.cumsum(counts, 0) - counts, counts)
+		return states[games, positions], positions
+
+	def _update_curriculum(self, value_targets: torch.tensor):
+		# Updates the curriculum with the mean value target at each position over all workers in one transfer
+		stats = torch.stack([
+			torch.bincount(self.positions, weights=value_targets.float(), minlength=self.rollout_depth),
+			torch.bincount(self.positions, minlength=self.rollout_depth).float(),
+		])
+		if self.workers > 1:
+			dist.all_reduce(stats)
+		sums, counts = stats.cpu().double().numpy()
+		with np.errstate(invalid="ignore"):
+			self.curriculum.update(sums / counts)
+
+	def _depths(self) -> np.ndarray:
+		# Scrambling depth of the state at each position in a game
+		return np.arange(self.rollout_depth) + (self.reward_method != 'lapanfix')
+
+	def _exact_values(self, distances: torch.tensor) -> torch.tensor:
+		"""
+		Values of states at the given distances from the solved state, which are the fixed point of the ADI targets.
+		The solved state has value 0, and states at distance d > 0 have the reward of solving minus the d-1 moves before that
+		"""
+		solve_reward = 0 if self.reward_method == 'reward0' else 1
+		return torch.where(distances == 0, 0, solve_reward - (distances - 1)).float()
+
+	def _autocast(self):
+		# bfloat16 autocast if training with mixed precision. Parameters are kept in float32 either way
+		return torch.autocast(gpu.type, dtype=torch.bfloat16, enabled=self.mixed_precision)
+
+	@no_grad
+	def _precision_loss_diff(self, net: Model, states: torch.tensor, policy_targets: torch.tensor, value_targets: torch.tensor,
+							 loss_weights: torch.tensor) -> float:
+		"""
+		Relative difference between the loss with bfloat16 autocast and in float32 on the given training data
+		The net is in eval mode, so the batchnorm statistics are not changed
+		"""
+		net.eval()
+		losses = list()
+		for enabled in (True, False):
+			with torch.autocast(gpu.type, dtype=torch.bfloat16, enabled=enabled):
+				policy_pred, value_pred = net(states, policy=True, value=True)
+			policy_loss = self.policy_criterion(policy_pred.float(), policy_targets) * loss_weights
+			value_loss = self.value_criterion(value_pred.float().squeeze(), value_targets) * loss_weights
+			losses.append(torch.mean(policy_loss + value_loss).item())
+		net.train()
+		return (losses[0] - losses[1]) / losses[1]
+
+	def _update_best(self, evaluations: list, best_solve: float, best_net: Model) -> (float, Model):
+		# Stores the solve rates of finished evaluations given as (rollout, solve rate, net) and returns the new best solve rate and net
+		for rollout, eval_reward, eval_net in evaluations:
+			self.sol_percents.append(eval_reward)
+			if eval_reward > best_solve:
+				best_solve = eval_reward
+				best_net = eval_net.clone()
+				self.log(f"Updated best net with solve rate {eval_reward*100:.2f} % at depth {self.evaluator.scrambling_depths}"
+						 + (f" from evaluation after rollout {rollout}" if self.async_evaluation else ""))
+		return best_solve, best_net
+
+	def _checkpoint_path(self) -> str:
+		return os.path.join(self.checkpoint_dir, "checkpoint.pt")
+
+	def _save_checkpoint(self, rollouts: int, net: Model, generator: GeneratorEMA, best_net: Model, best_solve: float, alpha: float,
+						 optimizer: torch.optim.Optimizer, lr_scheduler):
+		"""
+		Saves everything needed to continue training bit-exactly after `rollouts` rollouts.
+		The checkpoint is written to a temporary file which then replaces the previous checkpoint, so a checkpoint is never partially written
+		"""
+		checkpoint = {
+			"rollouts": rollouts,
+			"net": net.state_dict(),
+			"generator": generator.net.state_dict() if generator is not None else None,
+			"best_net": best_net.state_dict(),
+			"best_solve": best_solve,
+			"alpha": alpha,
+			"optimizer": optimizer.state_dict(),
+			"lr_scheduler": lr_scheduler.state_dict(),
+			"adi_ff_measured_bytes": self.adi_ff_planner.measured_bytes,
+			"policy_losses": self.policy_losses[:rollouts],
+			"value_losses": self.value_losses[:rollouts],
+			"train_losses": self.train_losses[:rollouts],
+			"precision_loss_diffs": self.precision_loss_diffs[:rollouts],
+			"dedup_ratios": self.dedup_ratios[:rollouts],
+			"depth_shares": self.depth_shares[:rollouts],
+			"curriculum": self.curriculum.state_dict() if self.curriculum is not None else None,
+			"sol_percents": self.sol_percents,
+			"analysis": { k: v for k, v in self.analysis.__dict__.items() if k != "log" } if self.with_analysis else None,
+			"rng": {
+				"torch": torch.get_rng_state(),
+				"cuda": torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None,
+				"numpy": np.random.get_state(),
+				"random": random.getstate(),
+			},
+		}
+		os.makedirs(self.checkpoint_dir, exist_ok=True)
+		path = self._checkpoint_path()
+		with open(path + ".tmp", "wb") as f:
+			torch.save(checkpoint, f)
+			f.flush()
+			os.fsync(f.fileno())
+		os.replace(path + ".tmp", path)
+		self.log.verbose(f"Saved checkpoint after {rollouts} rollouts to {path}")
+
+	def _load_checkpoint(self, net: Model, generator: GeneratorEMA, best_net: Model, optimizer: torch.optim.Optimizer, lr_scheduler)\
+			-> (int, float, float):
+		"""
+		Loads the checkpoint in self.checkpoint_dir into the given objects and the loss and evaluation history of the trainer
+		:return: Number of rollouts already done, alpha, and best solve rate
+		"""
+		# The checkpoint contains more than tensors, which torch >= 2.6 only loads when weights_only is turned off
+		# The argument does not exist before torch 1.13, where everything is loaded
+		load_kwargs = { "weights_only": False } if "weights_only" in inspect.signature(torch.load).parameters else dict()
+		checkpoint = torch.load(self._checkpoint_path(), map_location=gpu, **load_kwargs)
+		rollouts = checkpoint["rollouts"]
+		net.load_state_dict(checkpoint["net"])
+		if generator is not None:
+			generator.net.load_state_dict(checkpoint["generator"])
+		best_net.load_state_dict(checkpoint["best_net"])
+		optimizer.load_state_dict(checkpoint["optimizer"])
+		lr_scheduler.load_state_dict(checkpoint["lr_scheduler"])
+		self.adi_ff_planner.measured_bytes = checkpoint["adi_ff_measured_bytes"]
+		self.policy_losses[:rollouts] = checkpoint["policy_losses"]
+		self.value_losses[:rollouts] = checkpoint["value_losses"]
+		self.train_losses[:rollouts] = checkpoint["train_losses"]
+		self.precision_loss_diffs[:rollouts] = checkpoint["precision_loss_diffs"]
+		self.dedup_ratios[:rollouts] = checkpoint["dedup_ratios"]
+		self.depth_shares[:rollouts] = checkpoint["depth_shares"]
+		if self.curriculum is not None and checkpoint["curriculum"] is not None:
+			self.curriculum.load_state_dict(checkpoint["curriculum"])
+		self.sol_percents = checkpoint["sol_percents"]
+		if self.with_analysis and checkpoint["analysis"] is not None:
+			self.analysis.__dict__.update(checkpoint["analysis"])
+		# The other workers in data-parallel training keep their own random states, so they do not generate the same games as rank 0
+		if not self.rank:
+			torch.set_rng_state(checkpoint["rng"]["torch"].cpu())
+			if checkpoint["rng"]["cuda"] is not None and torch.cuda.is_available():
+				torch.cuda.set_rng_state_all([state.cpu() for state in checkpoint["rng"]["cuda"]])
+			np.random.set_state(checkpoint["rng"]["numpy"])
+			random.setstate(checkpoint["rng"]["random"])
+		return rollouts, checkpoint["alpha"], checkpoint["best_solve"]
+
+	def _worker_copy(self):
+		# Copy of the trainer for the other workers, which only generate data and compute gradients
+		worker = copy.copy(self)
+		worker.log = NullLogger()
+		worker.evaluation_rollouts = np.array([])
+		worker.with_analysis = False
+		worker.__dict__.pop("analysis", None)
+		worker.tt = TickTock()
+		return worker
+
+	def _all_reduce_grads(self, net: Model):
+		# Averages the gradients over all workers in one flat buffer. As the workers have batches of the same size,
+		# the result is the gradient of the mean loss over the global batch
+		grads = [p.grad for p in net.parameters() if p.grad is not None]
+		flat = torch.cat([g.flatten() for g in grads])
+		dist.all_reduce(flat)
+		flat /= self.workers
+		start = 0
+		for g in grads:
+			g.copy_(flat[start:start+g.numel()].view_as(g))
+			start += g.numel()
+
+	def _sync_rollout(self, net: Model, rollout: int):
+		"""
+		Averages the batchnorm running statistics and the rollout losses over all workers.
+		The parameters are kept equal by the averaged gradients, but the batch statistics differ between the workers
+		"""
+		buffers = [b for b in net.buffers() if b.is_floating_point()]
+		flat = torch.cat([b.flatten() for b in buffers] + [torch.tensor([self.policy_losses[rollout], self.value_losses[rollout]], device=gpu)])
+		dist.all_reduce(flat)
+		flat /= self.workers
+		start = 0
+		for b in buffers:
+			b.copy_(flat[start:start+b.numel()].view_as(b))
+			start += b.numel()
+		self.policy_losses[rollout], self.value_losses[rollout] = flat[start:].tolist()
 
 	def plot_training(self, save_dir: str, name: str, semi_logy=False, show=False):
 		"""
@@ -397,16 +1011,38 @@ class Train:
 		if show: plt.show()
 		plt.clf()
 
-	@staticmethod
-	def _get_batches(size: int, bsize: int):
-		"""
-		Generates indices for batch
-		"""
-		nbatches = int(np.ceil(size/bsize))
-		idcs = np.arange(size)
-		np.random.shuffle(idcs)
-		batches = [slice(batch*bsize, (batch+1)*bsize) for batch in range(nbatches)]
-		batches[-1] = slice(batches[-1].start, size)
-		return batches
+def _free_port() -> int:
+	# Port for the process group, found by letting the OS choose a free one
+	with socket.socket() as s:
+		s.bind(("127.0.0.1", 0))
+		return s.getsockname()[1]
+
+def _train_worker(train: Train, rank: int, port: int, net: Model, resume: bool, seed: int, threads: int, is2024: bool):
+	cube.set_is2024(is2024)
+	torch.set_num_threads(threads)
+	# Each worker has its own seed, so they generate different games
+	torch.manual_seed(seed + rank)
+	np.random.seed(seed + rank)
+	train.rank = rank
+	dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=train.workers)
+	try:
+		train._train(net, resume)
+	finally:
+		dist.destroy_process_group()
+
+def _evaluate_snapshots(evaluator: Evaluator, agent: DeepAgent, config, inference_profile: InferenceProfile, is2024: bool, snapshots, finished):
+	cube.set_is2024(is2024)
+	net = Model.create(config)
+	net.inference_profile = inference_profile
+	agent.net = net
+	while True:
+		snapshot = snapshots.get()
+		if snapshot is None: break
+		rollout, state_dict = snapshot
+		net.load_state_dict(state_dict)
+		net.eval()
+		with unverbose:
+			eval_results, _, _ = evaluator.eval(agent)
+		finished.put((rollout, (eval_results != -1).mean()))
 
 
@@ -51,3 +51,4 @@ def get_timestamp(for_file=False):
 from .logger import *
 from .parse import *
 from .ticktock import *
+from .metrics import *
@@ -15,7 +15,7 @@ unverbose = Unverbose()
 
 class Logger:
 
-	def __init__(self, fpath: str, title: str, verbose=True):
+	def __init__(self, fpath: str, title: str, verbose=True, append=False):
 		dirs = "/".join(fpath.split('/')[:-1])
 		if not os.path.exists(dirs) and dirs:
 			os.makedirs(dirs)
@@ -23,7 +23,8 @@ class Logger:
 		self.fpath = fpath
 		self._verbose = verbose
 
-		with open(self.fpath, "w+", encoding="utf-8") as logfile:
+		# If appending, e.g. when resuming a job, the existing log is kept
+		with open(self.fpath, "a" if append else "w+", encoding="utf-8") as logfile:
 			logfile.write("")
 
 		self.log(title + "\n")
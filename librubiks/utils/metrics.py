@@ -0,0 +1,40 @@
+import numpy as np
+import torch
+
+from librubiks import gpu
+
+
+class RunningMetrics:
+	"""
+	Running sums of scalar metrics kept on the device, so adding a value does not wait for the device.
+	The means are read in one transfer using `means`, e.g. once per rollout, which is the only synchronization.
+
+	Usage:
+	```
+	metrics = RunningMetrics("policy_loss", "value_loss")
+	for batch in batches:
+		metrics.add("policy_loss", policy_loss)
+	means = metrics.means()  # {"policy_loss": ..., "value_loss": ...}
+	```
+	"""
+	def __init__(self, *names: str, device: torch.device=gpu):
+		self.names = names
+		self.idcs = { name: i for i, name in enumerate(names) }
+		self.sums = torch.zeros(len(names), device=device)
+		self.counts = np.zeros(len(names), dtype=int)  # Kept on the host, as they are known without looking at the values
+
+	def add(self, name: str, value: torch.tensor):
+		# Adds a scalar tensor to the sum of the metric
+		i = self.idcs[name]
+		self.sums[i] += value.detach().float()
+		self.counts[i] += 1
+
+	def means(self) -> dict:
+		# Means of all metrics since the last reset. Metrics without any values are nan
+		sums = self.sums.cpu().numpy()
+		with np.errstate(invalid="ignore", divide="ignore"):
+			return { name: float(sums[i] / self.counts[i]) for name, i in self.idcs.items() }
+
+	def reset(self):
+		self.sums.zero_()
+		self.counts[:] = 0
@@ -0,0 +1,47 @@
+from ast import literal_eval
+
+from librubiks.utils import Parser
+from librubiks.jobs import CalibrateJob
+
+####
+# Should correspond to arguments in librubiks.jobs.CalibrateJob
+####
+options = {
+	'location': {
+		'default':  '',
+		'help':     "Folder containing model.pt and config.json. The inference profile is saved here",
+		'type':     str,
+	},
+	'use_best': {
+		'default':  True,
+		'help':     "Set to True to use model-best.pt instead of model.pt.",
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
+	'quantized': {
+		'default':  False,
+		'help':     "Set to True to calibrate the model with linear layers dynamically quantized to int8",
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
+	'batch_sizes': {
+		'default':  [1, 12, 120, 1200, 12000],
+		'help':     'List of batch sizes to benchmark',
+		'type':     literal_eval,
+	},
+	'min_time': {
+		'default':  0.2,
+		'help':     'Minimum time in seconds spent on each combination of batch size and thread count',
+		'type':     float,
+	},
+}
+
+if __name__ == "__main__":
+	description = r"""
+Benchmark the feedforward of a saved model for different batch sizes and thread counts using config or CLI arguments.
+The resulting inference profile is saved next to the model, where it is used by Model.load to set the fastest number of threads.
+"""
+	parser = Parser(options, description=description, name='calibrate', description_last=True)
+	jobs = [CalibrateJob(**settings) for settings in parser.parse()]
+	for job in jobs:
+		job.execute()
@@ -0,0 +1,36 @@
+from ast import literal_eval
+
+from librubiks.utils import Parser, get_timestamp
+from librubiks.jobs import DistanceTableJob
+
+####
+# Should correspond to arguments in librubiks.jobs.DistanceTableJob
+####
+options = {
+	'location': {
+		'default':  'data/local_distance_table'+get_timestamp(for_file=True),
+		'help':     'Folder in which the table is saved',
+		'type':     str,
+	},
+	'depth': {
+		'default':  6,
+		'help':     'All states within this many moves of the solved state are included. Depth 6 is about a million states',
+		'type':     int,
+	},
+	'is2024': {
+		'default':  True,
+		'help':     'True for 20x24 Rubiks representation and False for 6x8x6',
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
+}
+
+if __name__ == "__main__":
+	description = r"""
+Create a table of the exact distance to the solved state for all states within a number of moves using config or CLI arguments.
+The table can be given to runtrain.py with --distance_table where ADI uses the exact values of the states in it instead of evaluating them with the network.
+"""
+	parser = Parser(options, description=description, name='distance_table', description_last=True)
+	jobs = [DistanceTableJob(**settings) for settings in parser.parse()]
+	for job in jobs:
+		job.execute()
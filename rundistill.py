@@ -0,0 +1,89 @@
+from ast import literal_eval
+
+from librubiks.utils import get_timestamp, Parser, set_seeds
+from librubiks.jobs import DistillJob
+
+####
+# Should correspond to arguments in librubiks.jobs.DistillJob
+####
+options = {
+	'location': {
+		'default':  'data/local_distill'+get_timestamp(for_file=True),
+		'help':     "Save location for logs, plots and the student model",
+		'type':     str,
+	},
+	'teacher': {
+		'default':  '',
+		'help':     "Folder containing model.pt and config.json of the teacher network",
+		'type':     str,
+	},
+	'use_best': {
+		'default':  True,
+		'help':     "Set to True to use model-best.pt of the teacher instead of model.pt.",
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
+	'arch': {
+		'default':  'fc_tiny',
+		'help':     'Network architecture of the student. See runtrain for the options',
+		'type':     str,
+		'choices':  ['fc_tiny', 'fc_small', 'fc_big', 'res_small', 'res_big', 'conv'],
+	},
+	'rollouts': {
+		'default':  200,
+		'help':     'Number of rollouts, each consisting of generating states, computing the teacher outputs, and training the student on them',
+		'type':     int,
+	},
+	'rollout_games': {
+		'default':  1000,
+		'help':     'Number of scrambled games in each rollout',
+		'type':     int,
+	},
+	'rollout_depth': {
+		'default':  100,
+		'help':     'Number of random rotations applied to each game. All states on the way are used',
+		"type":     int,
+	},
+	'batch_size': {
+		'default':  1000,
+		'help':     'Number of states used in each parameter update of the student. Must be <= rollout_games*rollout_depth',
+		'type':     int
+	},
+	'optim_fn': {
+		'default':  'Adam',
+		'help':     'Name of optimization function corresponding to class in torch.optim',
+		'type':     str,
+	},
+	'lr': {
+		'default':  1e-4,
+		'help':     'Learning rate of parameter update',
+		'type':     float,
+	},
+	'temperature': {
+		'default':  2,
+		'help':     'Temperature of the policy softmaxes in the distillation loss. Higher values transfer more of the teachers preferences between less likely actions',
+		'type':     float,
+	},
+	'evaluation_interval': {
+		'default':  50,
+		'help':     'An evaluation of the student is performed every evaluation_interval rollouts. Set to 0 for never',
+		'type':     int,
+	},
+	'nn_init': {
+		'default':  'glorot',
+		'help':     'Initialialization strategy for the student. Choose either "glorot", "he" or write a number.',
+		'type':     str,
+	},
+}
+
+if __name__ == "__main__":
+	description = r"""
+Distill a trained network into a smaller student network using config or CLI arguments.
+The student is saved in the same way as trained networks, so it can be evaluated using runeval.
+"""
+	set_seeds()
+
+	parser = Parser(options, description=description, name='distill', description_last=True)
+	jobs = [DistillJob(**settings) for settings in parser.parse()]
+	for job in jobs:
+		job.execute()
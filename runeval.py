@@ -18,9 +18,11 @@ options = {
 	},
 	'agent': {
 		'default':  'AStar',
-		'help':     'Type of solver agent corresponding to agent class in librubiks.solving.agents',
+		'help':     'Type of solver agent corresponding to agent class in librubiks.solving.agents.\n'
+					'BatchedAStar solves all games of a depth at once. max_time and max_states still apply to each cube,\n'
+					'and the time of each cube includes its share of the batched feedforward.',
 		'type':     str,
-		'choices':  ['AStar', 'MCTS', 'PolicySearch', 'ValueSearch', 'EGVM', 'BFS', 'RandomDFS', ],
+		'choices':  ['AStar', 'BatchedAStar', 'MCTS', 'PolicySearch', 'ValueSearch', 'EGVM', 'BFS', 'RandomDFS', ],
 	},
 	'scrambling': {
 		'default':  100,
@@ -50,6 +52,20 @@ options = {
 		'type':     literal_eval,
 		'choices':  [True, False],
 	},
+	'frozen': {
+		'default':  False,
+		'help':     "Set to True to use a frozen TorchScript version of the model with batchnorms folded into linear layers.\n"
+					"It is exported and cached next to the model the first time.",
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
+	'quantized': {
+		'default':  False,
+		'help':     "Set to True to also evaluate the model with linear layers dynamically quantized to int8 (CPU only)\n"
+					"and log the differences in solve rate and states seen per second compared to the float model.",
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
 	'optimized_params' : {
 		'default':  False,
 		'help':     "Set to True to overwrite agent params with the ones in corresponding JSON created by hyper_optim, if it exists.",
@@ -66,6 +82,12 @@ options = {
 		'help':     'The A* expansions parameter: How many nodes to expand to at a time. Can be thought of as a batch size: Higher is much faster but lower should be a bit more precise.',
 		'type':     int,
 	},
+	'astar_top_k' : {
+		'default':  0,
+		'help':     'If > 0, A* computes the policy along with the value and only generates the children of the top k actions when expanding a node.\n'
+					'The remaining children are deferred and generated when the node is popped from the open queue again. 0 for all children.',
+		'type':     int,
+	},
 	'mcts_c': {
 		'default':  0.6,
 		'help':     'Exploration parameter c for MCTS',
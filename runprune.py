@@ -0,0 +1,85 @@
+from ast import literal_eval
+
+from librubiks.utils import get_timestamp, Parser, set_seeds
+from librubiks.jobs import PruneJob
+
+####
+# Should correspond to arguments in librubiks.jobs.PruneJob
+####
+options = {
+	'location': {
+		'default':  'data/local_prune'+get_timestamp(for_file=True),
+		'help':     "Save location for logs, plots and the pruned models",
+		'type':     str,
+	},
+	'model': {
+		'default':  '',
+		'help':     "Folder containing model.pt and config.json of the fully connected network to prune",
+		'type':     str,
+	},
+	'use_best': {
+		'default':  True,
+		'help':     "Set to True to prune model-best.pt instead of model.pt.",
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
+	'amounts': {
+		'default':  [0.25, 0.5, 0.75, 0.9],
+		'help':     'List of fractions of the neurons in each hidden layer to remove. A pruned model is made for each',
+		'type':     literal_eval,
+	},
+	'rollouts': {
+		'default':  50,
+		'help':     'Number of rollouts each pruned model is fine-tuned for. Set to 0 to not fine-tune',
+		'type':     int,
+	},
+	'rollout_games': {
+		'default':  1000,
+		'help':     'Number of games in ADI in each fine-tuning rollout',
+		'type':     int,
+	},
+	'rollout_depth': {
+		'default':  100,
+		'help':     'Number of rotations applied to each game in ADI',
+		"type":     int,
+	},
+	'batch_size': {
+		'default':  1000,
+		'help':     'Number of training examples in each parameter update. Must be <= rollout_games*rollout_depth',
+		'type':     int
+	},
+	'optim_fn': {
+		'default':  'Adam',
+		'help':     'Name of optimization function corresponding to class in torch.optim',
+		'type':     str,
+	},
+	'lr': {
+		'default':  1e-5,
+		'help':     'Learning rate of the fine-tuning. Should be lower than in training, as the pruned model is already trained',
+		'type':     float,
+	},
+	'reward_method' : {
+		'default':  'lapanfix',
+		'help':     'Which way to set target values near goal state. Should be the same as the model was trained with. See runtrain for the options',
+		'type':     str,
+		'choices':  ['paper', 'lapanfix', 'schultzfix', 'reward0'],
+	},
+	'latency_batch_size': {
+		'default':  1200,
+		'help':     'Number of states in the feedforward used to measure latency. The default is the batch size of AStar with 100 expansions',
+		'type':     int,
+	},
+}
+
+if __name__ == "__main__":
+	description = r"""
+Prune a trained fully connected network by removing the least important neurons and fine-tune the result using config or CLI arguments.
+A pruned model is saved in a subfolder for each pruning amount, so they can be evaluated using runeval,
+and the latency versus solve rate curve is plotted.
+"""
+	set_seeds()
+
+	parser = Parser(options, description=description, name='prune', description_last=True)
+	jobs = [PruneJob(**settings) for settings in parser.parse()]
+	for job in jobs:
+		job.execute()
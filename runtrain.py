@@ -31,9 +31,9 @@ options = {
 	},
 	'arch': {
 		'default':  'fc_small',
-		'help':     'Network architecture. fc_small or fc_big for fully connected, res_small or res_big for fully connected with residual blocks, and conv for convolutional blocks',
+		'help':     'Network architecture. fc_tiny, fc_small or fc_big for fully connected, res_small or res_big for fully connected with residual blocks, and conv for convolutional blocks',
 		'type':     str,
-		'choices':  ['fc_small', 'fc_big', 'res_small', 'res_big', 'conv'],
+		'choices':  ['fc_tiny', 'fc_small', 'fc_big', 'res_small', 'res_big', 'conv'],
 	},
 	'alpha_update': {
 		'default':  0,
@@ -102,6 +102,64 @@ options = {
 		'type':     literal_eval,
 		'choices':  [True, False],
 	},
+	'inference_profile': {
+		'default':  '',
+		'help':     'Folder containing an inference profile created by runcalibrate.py for a model of the same architecture.\n'
+					'If given, it is used to choose the number of threads in ADI, training, and evaluation.',
+		'type':     str,
+	},
+	'mixed_precision': {
+		'default':  False,
+		'help':     'If true, ADI feedforward and training run under bfloat16 autocast with float32 parameters. '
+					'The difference to the float32 loss is logged. Fastest on CPUs with native bfloat16 support',
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
+	'workers': {
+		'default':  1,
+		'help':     'Number of data-parallel training processes. Each generates its share of the ADI data and computes gradients on it, '
+					'and the gradients are averaged. rollout_games and batch_size must be divisible by this. '
+					'Logging and evaluation are done by the main process',
+		'type':     int,
+	},
+	'epochs': {
+		'default':  1,
+		'help':     'Number of passes over the training data of each rollout. The data is shuffled on the device for each pass',
+		'type':     int,
+	},
+	'async_evaluation': {
+		'default':  False,
+		'help':     'If true, evaluations are done on snapshots of the network in a background process while training continues. '
+					'Solve rates and the best network are updated when the evaluations finish',
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
+	'checkpoint_interval': {
+		'default':  0,
+		'help':     'A checkpoint with everything needed to resume training is saved in the location every checkpoint_interval rollouts, '
+					'replacing the previous one. 0 for never, so it must be set to be able to resume',
+		'type':     int,
+	},
+	'resume': {
+		'default':  False,
+		'help':     'If true, training continues from the checkpoint in the location instead of cleaning it. '
+					'If there is no checkpoint, training starts from the beginning',
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
+	'distance_table': {
+		'default':  '',
+		'help':     'Folder containing a distance table created by rundistancetable.py.\n'
+					'If given, ADI uses the exact values of states in the table instead of evaluating them with the network',
+		'type':     str,
+	},
+	'depth_curriculum': {
+		'default':  False,
+		'help':     'If true, the share of ADI states at each scrambling depth adapts during training, such that more states are\n'
+					'generated at depths where the value targets are still changing. Else, every game has a state at every depth',
+		'type':     literal_eval,
+		'choices':  [True, False],
+	},
 }
 
 if __name__ == "__main__":
@@ -123,7 +181,8 @@ on the Rubik's Cube using config or CLI arguments.
 
 	parser = Parser(options, description=description, name='train', description_last=True)
 	parsley = parser.parse()
-	TrainJob.clean_dir(parser.save_location)
+	if not any(settings['resume'] for settings in parsley):
+		TrainJob.clean_dir(parser.save_location)
 	jobs = [TrainJob(**settings) for settings in parsley]
 	for job in jobs:
 		job.execute()
@@ -1,3 +1,5 @@
+import time
+
 import numpy as np
 import torch
 
@@ -7,7 +9,8 @@ from librubiks import gpu
 from librubiks import cube
 from librubiks.model import Model, ModelConfig
 
-from librubiks.solving.agents import Agent, RandomSearch, BFS, PolicySearch, ValueSearch, EGVM, MCTS, AStar
+from librubiks.solving.agents import Agent, RandomSearch, BFS, PolicySearch, ValueSearch, EGVM, MCTS, AStar, BatchedAStar
+from librubiks.solving.evaluation import Evaluator
 
 def _action_queue_test(state, agent, sol_found):
 	assert all([0 <= x < cube.action_dim for x in agent.action_queue])
@@ -35,6 +38,64 @@ class TestAgents(MainTest):
 			state = cube.rotate(state, *cube.action_space[action])
 		assert solution_found == cube.is_solved(state)
 
+	def test_incremental(self):
+		# Incremental evaluation of the first layer should not change the searches
+		net = Model.create(ModelConfig()).eval()
+		assert net.supports_incremental()
+		state, _, _ = cube.scramble(8)
+		for agent in (AStar(net, 0.2, 10), AStar(net, 0.2, 10, top_k=3), MCTS(net, 0.6, False)):
+			results = list()
+			for incremental in (False, True):
+				agent.incremental = incremental
+				np.random.seed(42)
+				agent.search(state, time_limit=None, max_states=500)
+				results.append(list(agent.action_queue))
+			assert results[0] == results[1]
+		agent = ValueSearch(net)
+		steps = list()
+		for incremental in (False, True):
+			agent.incremental = incremental
+			with torch.no_grad():
+				steps.append(agent._step(state)[0])
+		assert steps[0] == steps[1]
+		# In EGVM, the same state can be reached in different ways, which gives slightly different first layer outputs
+		# Ties between such states can be broken differently, so only the values are compared
+		agent = EGVM(net, 0.1, 4, 12)
+		values = list()
+		for incremental in (False, True):
+			agent.incremental = incremental
+			np.random.seed(42)
+			with torch.no_grad():
+				values.append(agent._ff_input(agent.expand(state)[2], policy=False))
+		assert torch.allclose(values[0], values[1], atol=1e-5)
+
+class TestBFS(MainTest):
+
+	def test_agent(self):
+		agent = BFS()
+		for depth in range(1, 4):
+			state, _, _ = cube.scramble(depth, force_not_solved=True)
+			assert agent.search(state, time_limit=5)
+			assert len(agent.action_queue) <= depth
+			_action_queue_test(state, agent, True)
+
+	def test_optimal(self):
+		# Moves on three different faces cannot be shortened, and the number of states in the first layers is known
+		state = cube.get_solved()
+		for action in [(0, 1), (2, 0), (4, 1)]:
+			state = cube.rotate(state, *action)
+		agent = BFS()
+		assert agent.search(state, time_limit=5)
+		assert len(agent.action_queue) == 3
+		_action_queue_test(state, agent, True)
+		assert 1 + 12 + 114 < len(agent) <= 1 + 12 + 114 + 1068
+
+	def test_max_states(self):
+		state, _, _ = cube.scramble(20, force_not_solved=True)
+		agent = BFS()
+		agent.search(state, max_states=1000)
+		assert len(agent) <= 1000
+
 class TestMCTS(MainTest):
 
 	def test_agent(self):
@@ -86,7 +147,10 @@ class TestMCTS(MainTest):
 
 		# Leaves
 		if not search_graph:
-			assert np.all(agent.neighbors.all(axis=1) != agent.leaves)
+			# Leaves are missing neighbors, and expanded nodes know at least all neighbors that are not pruned
+			expanded = ~agent.leaves[used_idcs]
+			assert not agent.neighbors[used_idcs][~expanded].all(axis=1).any()
+			assert np.all((agent.neighbors[used_idcs][expanded] != 0).sum(axis=1) >= cube.allowed_actions[:, :-1].sum(axis=2).min())
 
 		# W
 		assert agent.W[used_idcs].all()
@@ -107,7 +171,7 @@ class TestAStar(MainTest):
 		for params in test_params:
 			agent = AStar(net, *params)
 			self._can_win_all_easy_games(agent)
-			agent.reset("Tue", "Herlau")
+			agent.reset("Tue", 1)
 			assert not len(agent.indices)
 			assert not len(agent.open_queue)
 
@@ -133,6 +197,99 @@ class TestAStar(MainTest):
 			assert agent.G[idx] == 1
 			assert agent.parents[idx] == init_idx
 
+	def test_top_k(self):
+		net = Model.create(ModelConfig()).eval()
+		for top_k in (1, 4):
+			agent = AStar(net, lambda_=0.5, expansions=3, top_k=top_k)
+			self._can_win_all_easy_games(agent)
+			assert str(agent).endswith(f"k={top_k})")
+
+		# The first expansion only generates the top k children, and the starting node is deferred
+		state, _, _ = cube.scramble(10, force_not_solved=True)
+		agent = AStar(net, lambda_=0.5, expansions=1, top_k=4)
+		agent.reset(1, 1)
+		agent.indices[state.tostring()], agent.states[1], agent.G[1] = 1, state, 0
+		agent.parents[1], agent.parent_actions[:2] = 0, cube.no_action
+		agent.cost(np.expand_dims(state, 0), np.array([1]))
+		agent.expand_batch(np.array([1]), np.array([0.]))
+		assert len(agent) == 1 + 4
+		assert agent.n_expanded[1] == 4
+		assert set(agent.parent_actions[2:6]) == set(agent.action_order[1, :4])
+		assert 1 in [i for _, i in agent.open_queue]
+
+		# A deferred state that gets a new parent keeps paging through the actions that were allowed when it was first expanded
+		agent = AStar(net, lambda_=0.5, expansions=1, top_k=5)
+		agent.reset(1, 100)
+		agent.action_order[1] = np.random.permutation(cube.action_dim)
+		agent.n_expanded[1] = 0
+		first_last_actions, new_last_actions = np.array([[cube.no_action, 0]]), np.array([[cube.no_action, 3]])
+		actions = list()
+		rows, taken, deferred = agent._get_top_k_actions(np.array([1]), first_last_actions)
+		actions += taken.tolist()
+		while deferred[0]:
+			rows, taken, deferred = agent._get_top_k_actions(np.array([1]), new_last_actions)
+			actions += taken.tolist()
+		assert sorted(actions) == np.where(cube.allowed_actions[cube.no_action, 0])[0].tolist()
+
+	def test_batched(self):
+		net = Model.create(ModelConfig()).eval()
+		states = np.array([cube.get_solved()] + [cube.scramble(2, force_not_solved=True)[0] for _ in range(4)])
+		for top_k in (None, 3):
+			agent = BatchedAStar(net, lambda_=0.5, expansions=2, top_k=top_k)
+			solved, action_queues, explored_states, times = agent.search_many(states, time_limit=5, max_states=2000)
+			assert len(solved) == len(action_queues) == len(explored_states) == len(times) == len(states)
+			assert solved[0] and not len(action_queues[0])
+			for state, sol_found, action_queue in zip(states, solved, action_queues):
+				for action in action_queue:
+					state = cube.rotate(state, *cube.action_space[action])
+				assert cube.is_solved(state) == sol_found
+			assert np.all(explored_states <= 2000)
+			assert len(agent) == explored_states.sum()
+		assert not len(BatchedAStar(net, lambda_=0.5, expansions=2))
+
+		# The time limit is for each cube, and the times of the cubes add up to the time spent on the batch
+		states = np.array([cube.scramble(20, force_not_solved=True)[0] for _ in range(4)])
+		agent = BatchedAStar(net, lambda_=0.5, expansions=2)
+		start = time.perf_counter()
+		solved, _, _, times = agent.search_many(states, time_limit=.2)
+		total = time.perf_counter() - start
+		assert not solved.any()
+		assert np.all(times >= .2) and np.all(times < .2 + total / 4)
+		assert times.sum() <= total
+
+		evaluator = Evaluator(3, [1, 2], max_states=1000)
+		res, explored_states, times = evaluator.eval(BatchedAStar(net, lambda_=0.5, expansions=2))
+		assert res.shape == explored_states.shape == times.shape == (2, 3)
+
+	def test_memory_budget(self):
+		net = Model.create(ModelConfig()).eval()
+		agent = AStar(net, lambda_=0.5, expansions=2)
+		assert agent.bytes_per_node() > np.prod(cube.shape())
+		_, max_states = agent.reset(1, 5000)
+		assert max_states == 5000 and len(agent.states) == 5001
+		assert agent.parents.dtype == np.int32 and agent.parent_actions.dtype == np.uint8 and agent.G.dtype == np.float32
+		states = agent.states
+		agent.search(cube.scramble(4, force_not_solved=True)[0], max_states=3000)
+		assert agent.states is states  # Presized buffers are reused
+		agent._max_presize_bytes = 3000 * agent.array_bytes_per_node()
+		agent.states = None
+		agent.reset(1, 5000)
+		assert len(agent.states) == 3000  # The cap is on the node arrays only
+		agent = AStar(net, lambda_=0.5, expansions=2)
+		agent.reset(1, None)
+		assert len(agent.states) == agent._stack_expand  # Not presized without a limit on the number of states
+
+		budget = 2000 * agent.bytes_per_node()
+		agent = AStar(net, lambda_=0.5, expansions=2, memory_budget=budget)
+		_, max_states = agent.reset(1, 5000)
+		assert max_states < 2000 and len(agent.states) * agent.bytes_per_node() <= budget
+		agent.search(cube.scramble(20, force_not_solved=True)[0], time_limit=5)
+		assert len(agent) <= max_states
+
+		agent = BatchedAStar(net, lambda_=0.5, expansions=2, memory_budget=budget)
+		_, _, explored_states, _ = agent.search_many(np.array([cube.scramble(20, True)[0] for _ in range(2)]), time_limit=5)
+		assert np.all(explored_states < 1000)
+
 	def test_cost(self):
 		net = Model.create(ModelConfig()).eval()
 		games = 5
@@ -4,7 +4,9 @@ import torch
 from tests import MainTest
 
 from librubiks import gpu, cube
-from librubiks.cube import with_used_repr
+from librubiks.cube import with_used_repr, tensor_cube
+from librubiks.cube.distance_table import DistanceTable
+from librubiks.jobs import DistanceTableJob
 from librubiks.cube.maps import SimpleState, get_corner_pos, get_side_pos
 
 class TestRubiksCube(MainTest):
@@ -138,6 +140,45 @@ class TestRubiksCube(MainTest):
 		supposed_state[torch.arange(8, 20), sides] = 1
 		assert (supposed_state.flatten() == oh).all()
 
+	def test_pack(self):
+		self.is2024 = True
+		self._pack_test()
+		self.is2024 = False
+		self._pack_test()
+
+	@with_used_repr
+	def _pack_test(self):
+		states, _ = cube.sequence_scrambler(10, 5, True)
+		states = np.vstack([states, states[:7]])
+		keys = cube.pack(states)
+		assert keys.shape == (len(states),)
+		_, unique_state_idcs = np.unique(states.reshape(len(states), -1), axis=0, return_inverse=True)
+		_, unique_key_idcs = np.unique(keys, return_inverse=True)
+		assert np.all((unique_state_idcs[:, None] == unique_state_idcs) == (unique_key_idcs[:, None] == unique_key_idcs))
+
+	def test_pruning(self):
+		# Everything is allowed from the starting state
+		assert cube.allowed_actions[cube.no_action, cube.no_action].all()
+		for action in range(cube.action_dim):
+			allowed = cube.allowed_actions[cube.no_action, action]
+			assert not allowed[cube.rev_action(action)]
+		# Half turns are done as two positive moves, and F, T, L come before B, D, R
+		assert cube.allowed_actions[cube.no_action, 0, 0] and not cube.allowed_actions[0, 0, 0]
+		assert not cube.allowed_actions[cube.no_action, 1, 1]
+		assert cube.allowed_actions[cube.no_action, 0, 2] and not cube.allowed_actions[cube.no_action, 2, 0]
+
+		# Children are the states reached by the allowed actions
+		states, _ = cube.sequence_scrambler(3, 4, False)
+		last_actions = np.array([[cube.no_action, cube.no_action], [cube.no_action, 5], [4, 4]])
+		children, parent_idcs, actions = cube.expand_children(states[:3], last_actions)
+		assert len(children) == cube.allowed_actions[last_actions[:, 0], last_actions[:, 1]].sum()
+		assert len(children) < 3 * cube.action_dim
+		for child, i, action in zip(children, parent_idcs, actions):
+			assert cube.allowed_actions[last_actions[i, 0], last_actions[i, 1], action]
+			assert np.all(child == cube.rotate(states[i], *cube.action_space[action]))
+		_, _, actions = cube.expand_children(states[:1], np.array([3]))
+		assert 3 not in actions and 2 not in actions
+
 	def test_as633(self):
 		state = cube.as633(cube.get_solved())
 		target633 = list()
@@ -165,3 +206,61 @@ class TestRubiksCube(MainTest):
 		], device=gpu)
 		assert torch.all(correctness == cube.as_correct(torch.from_numpy(state).unsqueeze(0)))
 
+	def test_tensor_cube(self):
+		self.is2024 = True
+		self._tensor_cube_test()
+		self.is2024 = False
+		self._tensor_cube_test()
+
+	@with_used_repr
+	def _tensor_cube_test(self):
+		# The torch cube should give the same results as the numpy cube
+		states, _ = cube.sequence_scrambler(10, 5, True)
+		faces, dirs = np.random.randint(0, 6, len(states)), np.random.randint(0, 2, len(states))
+		tensor_states = torch.from_numpy(states).to(gpu)
+		rotated = tensor_cube.multi_rotate(tensor_states, torch.from_numpy(faces), torch.from_numpy(dirs))
+		assert np.all(rotated.cpu().numpy() == cube.multi_rotate(states, faces, dirs))
+		assert np.all(tensor_cube.rotate(tensor_states[1], 3, 0).cpu().numpy() == cube.rotate(states[1], 3, 0))
+		assert torch.equal(tensor_cube.as_oh(tensor_states), cube.as_oh(states))
+		assert np.all(tensor_cube.multi_is_solved(tensor_states).cpu().numpy() == cube.multi_is_solved(states))
+		assert tensor_cube.is_solved(tensor_cube.get_solved()) and not tensor_cube.is_solved(rotated[0])
+		substates = tensor_cube.multi_rotate(tensor_states.repeat_interleave(cube.action_dim, dim=0), *tensor_cube.iter_actions(len(states)))
+		unique, inverse = tensor_cube.unique(substates)
+		assert torch.equal(unique[inverse], substates)
+		assert len(unique) == len(np.unique(cube.pack(substates.cpu().numpy())))
+		assert all(np.all(a.cpu().numpy() == b) for a, b in zip(tensor_cube.iter_actions(2), cube.iter_actions(2)))
+
+		states, oh_states = tensor_cube.sequence_scrambler(4, 3, True)
+		assert states.shape == (12, *cube.shape()) and oh_states.shape == (12, cube.get_oh_shape())
+		assert tensor_cube.multi_is_solved(states[::3]).all()
+		# Each state is one move from the previous one in the same game
+		for i in range(4):
+			previous = states[3*i:3*i+2].repeat_interleave(cube.action_dim, dim=0)
+			children = tensor_cube.multi_rotate(previous, *tensor_cube.iter_actions(2)).reshape(2, cube.action_dim, -1)
+			assert (children == states[3*i+1:3*i+3].reshape(2, 1, -1)).all(dim=2).any(dim=1).all()
+
+	def test_distance_table(self):
+		self.is2024 = True
+		self._distance_table_test()
+		self.is2024 = False
+		self._distance_table_test()
+
+	@with_used_repr
+	def _distance_table_test(self):
+		table = DistanceTable.build(3)
+		# Number of states at each distance from the solved state
+		assert np.all(np.bincount(table.distances.cpu().numpy()) == [1, 12, 114, 1068])
+		table.save("local_tests/distance_table")
+		loaded = DistanceTable.load("local_tests/distance_table")
+		assert loaded.depth == 3 and loaded.is2024 == cube.get_is2024()
+		assert all(torch.equal(getattr(table, name), getattr(loaded, name)) for name in ("hashes", "keys", "distances"))
+		assert DistanceTable.load("local_tests/no_distance_table") is None
+		job = DistanceTableJob("Distance table test", "local_tests/distance_table_job", depth=2, is2024=cube.get_is2024())
+		assert job.execute().depth == 2
+		assert DistanceTable.load("local_tests/distance_table_job").is2024 == cube.get_is2024()
+
+		# Quarter turns of four different faces, where the last state is four moves from the solved state
+		states = [tensor_cube.get_solved()]
+		for face in (0, 2, 4, 1):
+			states.append(tensor_cube.rotate(states[-1], face, 1))
+		assert torch.equal(loaded.lookup(torch.stack(states)).cpu(), torch.tensor([0, 1, 2, 3, -1]))
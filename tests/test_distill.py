@@ -0,0 +1,51 @@
+import os, sys
+import subprocess
+
+import numpy as np
+import torch
+
+from tests import MainTest
+
+from librubiks import cube
+from librubiks.distill import Distill
+from librubiks.model import Model, ModelConfig
+from librubiks.solving.agents import AStar, PolicySearch
+from librubiks.solving.evaluation import Evaluator
+
+
+class TestDistill(MainTest):
+	def test_distill(self):
+		torch.manual_seed(42)
+		teacher = Model.create(ModelConfig(architecture="fc_small"))
+		student = Model.create(ModelConfig(architecture="fc_tiny"))
+		evaluator = Evaluator(2, max_time=.02, max_states=None, scrambling_depths=[2])
+		distill = Distill(rollouts=3, batch_size=10, rollout_games=5, rollout_depth=4, optim_fn=torch.optim.Adam, lr=1e-3,
+			temperature=2, agent=PolicySearch(None), evaluator=evaluator, evaluation_interval=2)
+		oh_states, policy_targets, value_targets = distill.teacher_targets(teacher)
+		assert oh_states.shape == (20, cube.get_oh_shape())
+		assert policy_targets.shape == (20, cube.action_dim) and torch.allclose(policy_targets.sum(dim=1), torch.ones(20))
+		assert value_targets.shape == (20,)
+
+		student, best_student = distill.distill(teacher, student)
+		assert np.all(distill.evaluation_rollouts == [1, 2]) and len(distill.sol_percents) == 2
+		assert distill.train_losses.shape == (3,) and np.all(distill.train_losses >= 0)
+		distill.plot_distillation("local_tests/local_distill_test", "test")
+		assert os.path.exists("local_tests/local_distill_test/distillation_test.png")
+
+	def test_run(self):
+		teacher_location = 'local_tests/distill_teacher'
+		Model.create(ModelConfig()).save(teacher_location)
+		run_path = os.path.join( os.path.dirname(os.path.dirname(os.path.abspath(__file__))),  'rundistill.py' )
+		location = 'local_tests/distill'
+		run_settings = {'location': location, 'teacher': teacher_location, 'use_best': False, 'rollouts': 2, 'rollout_games': 2,
+				'rollout_depth': 3, 'batch_size': 3, 'evaluation_interval': 1}
+		args = [sys.executable, run_path]
+		for k, v in run_settings.items():
+			args.extend([f'--{k}', str(v)])
+		subprocess.check_call(args)  # Raises error on problems in call
+
+		for fname in ['model.pt', 'model-best.pt', 'config.json', 'distill.log']:
+			assert fname in os.listdir(location)
+		assert Model.load(location).config.architecture == "fc_tiny"
+		agent = AStar.from_saved(location, use_best=True, lambda_=0.2, expansions=10)
+		agent.search(cube.scramble(2, True)[0], max_states=500)
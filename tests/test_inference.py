@@ -0,0 +1,71 @@
+import numpy as np
+import torch
+import torch.multiprocessing as mp
+
+from tests import MainTest
+
+from librubiks import cube
+from librubiks.model import Model, ModelConfig
+from librubiks.solving.agents import AStar
+from librubiks.solving.inference import InferenceServer
+
+
+def _solve(client, states, results):
+	agent = AStar(client, lambda_=0.2, expansions=10)
+	results.put([agent.search(state, max_states=2000) for state in states])
+
+class TestInferenceServer(MainTest):
+	def test_server(self):
+		model_dir = "local_tests/local_inference_test"
+		Model.create(ModelConfig()).save(model_dir)
+		model = Model.load(model_dir).eval()
+		with InferenceServer(model_dir, use_best=False, n_clients=2, max_request=50) as server:
+			# Requests larger than the buffers are split
+			x = cube.as_oh(np.array([cube.scramble(10)[0] for _ in range(120)]))
+			policy, value = server.clients[0](x)
+			with torch.no_grad():
+				assert torch.allclose(policy, model(x, value=False), atol=1e-5)
+				assert torch.allclose(value, model(x, policy=False), atol=1e-5)
+			assert server.clients[0](x, policy=False).shape == (120, 1)
+			assert server.clients[0](x, value=False).shape == (120, cube.action_dim)
+
+			# Clients can be used by agents in other processes at the same time
+			ctx = mp.get_context("spawn")
+			results = ctx.Queue()
+			worker = ctx.Process(target=_solve, args=(server.clients[1], [cube.scramble(2, True)[0] for _ in range(2)], results))
+			worker.start()
+			agent = AStar(server.clients[0], lambda_=0.2, expansions=10)
+			assert agent.search(cube.scramble(2, True)[0], max_states=2000)
+			# Fails instead of waiting forever if the worker dies
+			assert all(results.get(timeout=120))
+			worker.join()
+			assert worker.exitcode == 0
+		assert server.process is None
+
+	def test_server_stopped(self):
+		# Clients raise an error instead of waiting forever if the server is gone
+		model_dir = "local_tests/local_inference_test"
+		Model.create(ModelConfig()).save(model_dir)
+		x = cube.as_oh(np.array([cube.scramble(10)[0] for _ in range(10)]))
+		server = InferenceServer(model_dir, use_best=False, n_clients=1).start()
+		client = server.clients[0]
+		client.poll_interval = .05
+		server.process.kill()
+		server.process.join()
+		try:
+			client(x)
+			raised = False
+		except RuntimeError:
+			raised = True
+		assert raised
+
+		# Also after the server has been closed
+		server = InferenceServer(model_dir, use_best=False, n_clients=1).start()
+		server.clients[0].poll_interval = .05
+		server.close()
+		try:
+			server.clients[0](x)
+			raised = False
+		except RuntimeError:
+			raised = True
+		assert raised
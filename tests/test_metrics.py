@@ -0,0 +1,16 @@
+import numpy as np
+import torch
+
+from librubiks.utils import RunningMetrics
+
+def test_metrics():
+	metrics = RunningMetrics("loss", "entropy")
+	for value in (1., 2., 6.):
+		metrics.add("loss", torch.tensor(value))
+	means = metrics.means()
+	assert np.isclose(means["loss"], 3)
+	assert np.isnan(means["entropy"])
+	metrics.reset()
+	metrics.add("entropy", torch.tensor(0.5, requires_grad=True))
+	means = metrics.means()
+	assert np.isnan(means["loss"]) and np.isclose(means["entropy"], 0.5)
@@ -1,12 +1,16 @@
 import os
 import json
+import numpy as np
 import torch
 
 from tests import MainTest
 
-from librubiks import gpu
-from librubiks.model import Model, ModelConfig
+import librubiks.model
+from librubiks import gpu, cube
+from librubiks.model import Model, ModelConfig, InferenceModel, InferenceProfile
+from librubiks.solving.agents import AStar
 from librubiks.utils import NullLogger
+from librubiks.jobs import CalibrateJob
 
 
 class TestModel(MainTest):
@@ -43,6 +47,150 @@ class TestModel(MainTest):
 		model = Model.load(model_dir).to(gpu)
 		assert next(model.parameters()).device.type == gpu.type
 
+	def test_export_inference(self):
+		for arch, is2024 in [("fc_small", True), ("res_small", True), ("conv", False)]:
+			cube.store_repr()
+			cube.set_is2024(is2024)
+			model = Model.create(ModelConfig(architecture=arch, is2024=is2024))
+			model(torch.randn(10, cube.get_oh_shape()).to(gpu))  # Updates batchnorm statistics
+			model.eval()
+			inference_model = model.export_inference()
+			for n in (1, 5):
+				x = cube.as_oh(np.array([cube.scramble(10)[0] for _ in range(n)]))
+				policy, value = inference_model(x)
+				assert torch.allclose(policy, model(x, value=False), atol=1e-5)
+				assert torch.allclose(value, model(x, policy=False), atol=1e-5)
+				assert torch.allclose(inference_model(x, policy=False), value)
+				assert torch.allclose(inference_model(x, value=False), policy)
+			cube.restore_repr()
+
+		model_dir = "local_tests/local_frozen_test"
+		Model.create(ModelConfig()).save(model_dir)
+		inference_model = InferenceModel.load(model_dir)
+		assert all(os.path.isfile(f"{model_dir}/model-frozen-{head}.pt") for head in InferenceModel.heads)
+		x = cube.as_oh(cube.get_solved())
+		assert torch.allclose(InferenceModel.load(model_dir)(x, policy=False), inference_model(x, policy=False))
+		agent = AStar.from_saved(model_dir, use_best=False, lambda_=0.2, expansions=10, frozen=True)
+		assert isinstance(agent.net, InferenceModel)
+		assert agent.search(cube.scramble(2, True)[0], max_states=1000)
+
+	def test_quantize(self):
+		model = Model.create(ModelConfig())
+		model(torch.randn(10, cube.get_oh_shape()).to(gpu))  # Updates batchnorm statistics
+		model.eval()
+		quantized_model = model.quantize()
+		assert isinstance(quantized_model.shared_net[0], torch.nn.quantized.dynamic.Linear)
+		x = cube.as_oh(np.array([cube.scramble(10)[0] for _ in range(5)]))
+		assert torch.allclose(quantized_model(x, policy=False), model(x, policy=False), atol=0.1)
+
+		model_dir = "local_tests/local_quantized_test"
+		model.save(model_dir)
+		assert isinstance(Model.load(model_dir, quantized=True).shared_net[0], torch.nn.quantized.dynamic.Linear)
+		inference_model = InferenceModel.load(model_dir, quantized=True)
+		assert inference_model.quantized
+		assert all(os.path.isfile(f"{model_dir}/model-int8-frozen-{head}.pt") for head in InferenceModel.heads)
+		assert torch.allclose(inference_model(x, policy=False), quantized_model(x, policy=False), atol=1e-5)
+
+	def test_mmap(self):
+		for arch in ("fc_small", "res_small"):
+			model_dir = f"local_tests/local_mmap_test_{arch}"
+			model = Model.create(ModelConfig(architecture=arch))
+			model.save(model_dir)
+			mmap_model = Model.load(model_dir, mmap=True)
+			with open(f"{model_dir}/model.mmap.json", encoding="utf-8") as f:
+				data_file = json.load(f)["data"]
+			assert os.path.isfile(f"{model_dir}/{data_file}")
+			x = cube.as_oh(np.array([cube.scramble(10)[0] for _ in range(5)]))
+			# The warm-up feedforward is done on the first call only
+			assert len(mmap_model._forward_pre_hooks) == 1
+			with torch.no_grad():
+				for output, mmap_output in zip(model.eval()(x), mmap_model.eval()(x)):
+					assert torch.equal(output, mmap_output)
+				model_output = mmap_model(x, policy=False)
+			assert not mmap_model._forward_pre_hooks and not mmap_model.training
+			assert mmap_model.state_dict().keys() == model.state_dict().keys()
+
+			# Without load_state_dict(assign=True), the memory mapped tensors are swapped into a created model
+			has_assign, librubiks.model._has_assign = librubiks.model._has_assign, False
+			try:
+				with torch.no_grad():
+					assert torch.equal(Model.load(model_dir, mmap=True).eval()(x, policy=False), model_output)
+			finally:
+				librubiks.model._has_assign = has_assign
+
+			# The memory mapped file is updated when the model is saved again
+			torch.nn.init.zeros_(model.value_net[-1].weight)
+			torch.nn.init.zeros_(model.value_net[-1].bias)
+			os.utime(f"{model_dir}/model.mmap.json", (0, 0))
+			model.save(model_dir)
+			with torch.no_grad():
+				assert not Model.load(model_dir, mmap=True).eval()(x, policy=False).any()
+			# The new version is written to a new file, and the old one is removed
+			assert os.listdir(model_dir).count(data_file) == 0
+			assert len([f for f in os.listdir(model_dir) if f.endswith(".mmap")]) == 1
+			# The old model is still usable, as its file is mapped
+			with torch.no_grad():
+				assert torch.equal(mmap_model.eval()(x, policy=False), model_output)
+
+	def test_prune(self):
+		model = Model.create(ModelConfig(architecture="fc_tiny"))
+		x = cube.as_oh(np.array([cube.scramble(10)[0] for _ in range(20)]))
+		model(x)  # Updates batchnorm statistics
+		with torch.no_grad():
+			for output, pruned_output in zip(model.eval()(x), model.prune(0)(x)):
+				assert torch.allclose(output, pruned_output)
+		pruned = model.prune(0.5)
+		assert pruned.config.shared_sizes == [512, 256] and pruned.config.part_sizes == [128]
+		assert pruned.shared_net[0].weight.shape == (512, cube.get_oh_shape())
+		assert pruned.policy_net[-1].weight.shape == (cube.action_dim, 128)
+
+		# The custom sizes are saved in the config, such that the pruned model can be loaded
+		model_dir = "local_tests/local_prune_test"
+		pruned.save(model_dir)
+		with open(f"{model_dir}/config.json", encoding="utf-8") as f:
+			assert json.load(f)["shared_sizes"] == [512, 256]
+		loaded = Model.load(model_dir).eval()
+		with torch.no_grad():
+			for output, loaded_output in zip(pruned(x), loaded(x)):
+				assert torch.equal(output, loaded_output)
+
+	def test_incremental(self):
+		for arch in ("fc_small", "res_small"):
+			model = Model.create(ModelConfig(architecture=arch)).eval()
+			assert model.supports_incremental() and not model.quantize().supports_incremental()
+			parents = np.array([cube.scramble(10)[0] for _ in range(3)])
+			children, parent_idcs, _ = cube.expand_children(parents, np.full((3, 2), cube.no_action))
+			with torch.no_grad():
+				first_layer = model.first_layer_children(model.first_layer(parents), parents, children, parent_idcs)
+				assert torch.allclose(first_layer, model.shared_net[0](cube.as_oh(children)), atol=1e-5)
+				for output, incremental_output in zip(model(cube.as_oh(children)), model.forward_from_first_layer(first_layer)):
+					assert torch.allclose(output, incremental_output, atol=1e-5)
+
+	def test_inference_profile(self):
+		model_dir = "local_tests/local_profile_test"
+		model = Model.create(ModelConfig())
+		model.save(model_dir)
+		assert Model.load(model_dir).inference_profile is None
+		threads = torch.get_num_threads()
+		profile = InferenceProfile.calibrate(model, batch_sizes=[1, 12], threads=[1, 2], min_time=0.01)
+		assert profile.states_per_sec.shape == (2, 2) and (profile.states_per_sec > 0).all()
+		assert torch.get_num_threads() == threads
+		assert profile.best_threads(10) in (1, 2)
+
+		profile.states_per_sec = np.array([[2, 1], [1, 2]])
+		profile.save(model_dir)
+		agent = AStar.from_saved(model_dir, use_best=False, lambda_=0.2, expansions=10)
+		assert np.all(agent.net.inference_profile.states_per_sec == profile.states_per_sec)
+		agent.search(cube.scramble(1, True)[0], max_states=1000)
+		assert torch.get_num_threads() == 2
+		torch.set_num_threads(threads)
+
+		job = CalibrateJob("Calibration test", model_dir, use_best=False, quantized=False, batch_sizes=[1, 12], min_time=0.01)
+		profile = job.execute()
+		assert InferenceProfile.load(model_dir).states_per_sec.shape == profile.states_per_sec.shape
+		assert os.path.isfile(os.path.join(model_dir, "calibration.log"))
+		torch.set_num_threads(threads)
+
 	def test_model_config(self):
 		cf = ModelConfig(torch.nn.ReLU())
 		with open("local_tests/test_config.json", "w", encoding="utf-8") as f:
@@ -0,0 +1,47 @@
+import os, sys
+import subprocess
+import json
+
+import numpy as np
+import torch
+
+from tests import MainTest
+
+from librubiks.model import Model, ModelConfig
+from librubiks.prune import Prune
+from librubiks.solving.agents import PolicySearch
+from librubiks.solving.evaluation import Evaluator
+
+
+class TestPrune(MainTest):
+	def test_prune(self):
+		torch.manual_seed(42)
+		model = Model.create(ModelConfig(architecture="fc_tiny"))
+		evaluator = Evaluator(2, max_time=.02, max_states=None, scrambling_depths=[2])
+		prune = Prune([0.5, 0.9], rollouts=2, batch_size=10, rollout_games=5, rollout_depth=4, optim_fn=torch.optim.Adam, lr=1e-5,
+			reward_method="lapanfix", agent=PolicySearch(None), evaluator=evaluator, latency_batch_size=100)
+		pruned_models = prune.prune(model)
+		assert np.all(prune.amounts == [0, 0.5, 0.9]) and pruned_models[0] is model
+		assert [m.config.shared_sizes[0] for m in pruned_models] == [1024, 512, 102]
+		assert np.all(np.diff(prune.n_params) < 0)
+		assert np.all(prune.latencies > 0) and prune.sol_percents.shape == (3,)
+		prune.plot_pruning("local_tests/local_prune_test", "test")
+		assert os.path.exists("local_tests/local_prune_test/pruning_test.png")
+
+	def test_run(self):
+		model_location = 'local_tests/prune_model'
+		Model.create(ModelConfig(architecture="fc_tiny")).save(model_location)
+		run_path = os.path.join( os.path.dirname(os.path.dirname(os.path.abspath(__file__))),  'runprune.py' )
+		location = 'local_tests/prune'
+		run_settings = {'location': location, 'model': model_location, 'use_best': False, 'amounts': [0.5], 'rollouts': 1,
+				'rollout_games': 2, 'rollout_depth': 3, 'batch_size': 3, 'latency_batch_size': 10}
+		args = [sys.executable, run_path]
+		for k, v in run_settings.items():
+			args.extend([f'--{k}', str(v)])
+		subprocess.check_call(args)  # Raises error on problems in call
+
+		for fname in ['pruning.json', 'prune.log', 'pruned-50']:
+			assert fname in os.listdir(location)
+		with open(os.path.join(location, "pruning.json"), encoding="utf-8") as f:
+			assert json.load(f)["shared_sizes"] == [[1024, 512], [512, 256]]
+		assert Model.load(os.path.join(location, "pruned-50")).config.part_sizes == [128]
@@ -23,6 +23,11 @@ class TestRubiks(MainTest):
 		assert not self._get_is2024()
 		assert get_is2024()
 
+		# Representations used by nested methods are restored in turn
+		self.is2024 = False
+		assert self._get_nested_is2024() == (False, True, False)
+		assert get_is2024()
+
 	@with_used_repr
 	def _get_is2024(self):
 		return get_is2024()
@@ -33,6 +38,13 @@ class TestRubiks(MainTest):
 		assert not self._get_grad()
 		assert torch.is_grad_enabled()
 
+	@with_used_repr
+	def _get_nested_is2024(self):
+		outer = get_is2024()
+		self.is2024 = True
+		inner = self._get_is2024()
+		return outer, inner, get_is2024()
+
 	@no_grad
 	def _get_grad(self):
 		return torch.is_grad_enabled()
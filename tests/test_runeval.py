@@ -4,6 +4,7 @@ import subprocess
 from tests import MainTest
 from tests.test_hyper_optim import TestOptimizer
 
+from librubiks.model import Model, ModelConfig
 from librubiks.solving.agents import BFS
 
 
@@ -50,3 +51,18 @@ class TestRuneval(MainTest):
 				astar_found = True
 				assert str(dank_unlikely_number) not in found_file, "To test whether the optimized param was used"
 		assert astar_found, "Find output file"
+
+	def test_quantized(self):
+		run_path = os.path.join( os.path.dirname(os.path.dirname(os.path.abspath(__file__))),  'runeval.py' )
+		location = 'local_tests/eval_quantized'
+		Model(ModelConfig()).save(location)
+
+		# The int8 agent is evaluated along with the float agent
+		run_settings = {'location': location, 'agent': 'AStar', 'games': 1, 'max_time': 1, 'scrambling': '1 3', 'quantized': True}
+		args = [sys.executable, run_path,]
+		for k, v in run_settings.items(): args.extend([f'--{k}', str(v)])
+		subprocess.check_call(args)  # Raises error on problems in call
+
+		result_files = os.listdir(os.path.join(location, "evaluation_results"))
+		assert any('int8' in fname for fname in result_files)
+		assert any('AStar' in fname and 'int8' not in fname for fname in result_files)
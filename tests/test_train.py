@@ -1,13 +1,37 @@
 import os
+import numpy as np
 import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
 
 from tests import MainTest
 
-from librubiks.train import Train
+from librubiks.train import Train, MinibatchSampler, GeneratorEMA, FeedforwardPlanner, DepthCurriculum, _free_port
 from librubiks.model import Model, ModelConfig
-from librubiks import cpu, gpu
+from librubiks import cpu, gpu, cube
+from librubiks.cube import tensor_cube
+from librubiks.cube.distance_table import DistanceTable
+from librubiks.utils import set_seeds
 from librubiks.solving.agents import PolicySearch
 from librubiks.solving.evaluation import Evaluator
+def _grads(train: Train, net: Model, data: list) -> torch.tensor:
+	states, policy_targets, value_targets, loss_weights = data
+	net.zero_grad()
+	policy_pred, value_pred = net(states, policy=True, value=True)
+	loss = torch.mean(train.policy_criterion(policy_pred, policy_targets) * loss_weights + train.value_criterion(value_pred.squeeze(), value_targets) * loss_weights)
+	loss.backward()
+	return torch.cat([p.grad.flatten() for p in net.parameters()])
+
+def _all_reduce_worker(train: Train, rank: int, port: int, net: Model, data: list, results):
+	dist.init_process_group("gloo", init_method=f"tcp://127.0.0.1:{port}", rank=rank, world_size=2)
+	try:
+		_grads(train, net, data)
+		train._all_reduce_grads(net)
+		# Sent as an array, as shared tensors can be released when the worker exits before the parent has received them
+		results.put((rank, torch.cat([p.grad.flatten() for p in net.parameters()]).numpy()))
+	finally:
+		dist.destroy_process_group()
+
 class TestTrain(MainTest):
 
 	def test_train(self):
@@ -26,3 +50,211 @@ class TestTrain(MainTest):
 		# optim = torch.optim.Adam
 		# policy_loss = torch.nn.CrossEntropyLoss
 		# val_loss = torch.nn.MSE
+
+	def test_mixed_precision(self):
+		torch.manual_seed(42)
+		net = Model.create(ModelConfig())
+		evaluator = Evaluator(2, max_time=.02, max_states=None, scrambling_depths=[2])
+		train = Train(rollouts=2, batch_size=5, tau=1, alpha_update=1, gamma=1, rollout_games=3, rollout_depth=4, optim_fn=torch.optim.Adam, agent=PolicySearch(None), lr=1e-5, evaluation_interval=0, evaluator=evaluator, update_interval=0, with_analysis=True, reward_method='lapanfix', mixed_precision=True)
+		net, _ = train.train(net)
+		# Master weights are kept in float32
+		assert all(p.dtype == torch.float32 for p in net.parameters())
+		assert train.train_losses.shape == (2,) and (train.train_losses > 0).all()
+		assert (train.precision_loss_diffs != 0).any() and (abs(train.precision_loss_diffs) < 0.1).all()
+
+	def test_data_parallel(self):
+		torch.manual_seed(42)
+		net = Model.create(ModelConfig())
+		evaluator = Evaluator(2, max_time=.02, max_states=None, scrambling_depths=[2])
+		train = Train(rollouts=2, batch_size=4, tau=0.5, alpha_update=.5, gamma=1, rollout_games=4, rollout_depth=3, optim_fn=torch.optim.Adam, agent=PolicySearch(None), lr=1e-5, evaluation_interval=1, evaluator=evaluator, update_interval=1, with_analysis=True, reward_method='lapanfix', workers=2)
+		orig_params = net.get_params()
+		net, min_net = train.train(net)
+		assert not torch.equal(orig_params, net.get_params())
+		assert train.train_losses.shape == (2,) and (train.train_losses > 0).all()
+		assert len(train.sol_percents) == len(train.evaluation_rollouts)
+
+		# All-reducing the gradients of two equal halves of a batch through the process group gives both ranks the gradients of the full batch
+		train = Train(rollouts=1, batch_size=4, tau=1, alpha_update=1, gamma=1, rollout_games=4, rollout_depth=3, optim_fn=torch.optim.SGD, agent=PolicySearch(None), lr=1e-5, evaluation_interval=0, evaluator=evaluator, update_interval=0, with_analysis=False, reward_method='lapanfix')
+		data = train.ADI_traindata(net, 1)
+		train.workers = 2
+		net.eval()
+		full_grads = _grads(train, net, list(data))
+		ctx = mp.get_context("spawn")
+		results = ctx.Queue()
+		port = _free_port()
+		workers = [ctx.Process(target=_all_reduce_worker, args=(train, rank, port, net, [x[6*rank:6*(rank+1)] for x in data], results)) for rank in range(2)]
+		for worker in workers: worker.start()
+		reduced = { rank: torch.from_numpy(grads) for rank, grads in (results.get(timeout=120) for _ in workers) }
+		for worker in workers: worker.join()
+		assert all(worker.exitcode == 0 for worker in workers)
+		assert torch.equal(reduced[0], reduced[1])
+		assert torch.allclose(reduced[0], full_grads, atol=1e-6)
+
+	def test_sampler(self):
+		sampler = MinibatchSampler(4, epochs=2)
+		states, targets = torch.arange(10).reshape(5, 2), torch.arange(5)
+		batches = list(sampler(states, targets))
+		assert len(batches) == sampler.n_batches(5) == 4
+		assert [len(b[0]) for b in batches] == [4, 1, 4, 1]
+		for epoch in range(2):
+			epoch_states = torch.cat([b[0] for b in batches[2*epoch:2*epoch+2]])
+			epoch_targets = torch.cat([b[1] for b in batches[2*epoch:2*epoch+2]])
+			# Each epoch contains all data once, and states and targets are shuffled together
+			assert torch.equal(epoch_targets.sort().values, targets)
+			assert torch.equal(epoch_states, states[epoch_targets])
+		# Batches are views into the shuffled data
+		assert all(b._base is not None for batch in batches for b in batch)
+
+	def test_generator_ema(self):
+		torch.manual_seed(42)
+		net = Model.create(ModelConfig())
+		ema = GeneratorEMA(net, tau=0.25)
+		params = lambda net: torch.cat([p.flatten() for p in net.parameters()])
+		orig_params = params(net).detach().clone()
+		with torch.no_grad():
+			for p in net.parameters(): p.add_(1)
+			for b in net.buffers(): b.add_(1)
+		gen_net = ema.update(net)
+		assert gen_net is ema.net
+		assert torch.allclose(params(gen_net), 0.25 * params(net) + 0.75 * orig_params)
+		for name, buffer in net.state_dict().items():
+			gen_buffer = gen_net.state_dict()[name]
+			if not buffer.is_floating_point():
+				assert torch.equal(gen_buffer, buffer)
+
+		# Without fused multi-tensor operations, the tensors are updated one at a time
+		foreach_lerp = getattr(torch, "_foreach_lerp_", None)
+		if foreach_lerp is not None:
+			del torch._foreach_lerp_
+		try:
+			ema = GeneratorEMA(net, tau=0.25)
+			expected = 0.25 * params(gen_net) + 0.75 * params(net)
+			assert torch.allclose(params(ema.update(gen_net)), expected)
+		finally:
+			if foreach_lerp is not None:
+				torch._foreach_lerp_ = foreach_lerp
+
+	def test_async_evaluation(self):
+		torch.manual_seed(42)
+		net = Model.create(ModelConfig())
+		evaluator = Evaluator(2, max_time=.02, max_states=None, scrambling_depths=[2])
+		train = Train(rollouts=3, batch_size=4, tau=1, alpha_update=1, gamma=1, rollout_games=2, rollout_depth=3, optim_fn=torch.optim.Adam, agent=PolicySearch(None), lr=1e-5, evaluation_interval=1, evaluator=evaluator, update_interval=0, with_analysis=False, reward_method='lapanfix', async_evaluation=True)
+		net, min_net = train.train(net)
+		# All evaluations are collected before training returns
+		assert len(train.sol_percents) == len(train.evaluation_rollouts) == 3
+		assert all(0 <= sol_percent <= 1 for sol_percent in train.sol_percents)
+		assert min_net is not net
+
+	def test_resume(self):
+		# Training that is stopped after a checkpoint and resumed should be the same as training without stopping
+		location = "local_tests/local_train_resume"
+		evaluator = Evaluator(2, max_time=.02, max_states=None, scrambling_depths=[2])
+		def get_train(rollouts: int, checkpoint_dir: str) -> Train:
+			return Train(rollouts=rollouts, batch_size=4, tau=0.5, alpha_update=.25, gamma=0.9, rollout_games=2, rollout_depth=5, optim_fn=torch.optim.Adam, agent=PolicySearch(None), lr=1e-3, evaluation_interval=0, evaluator=evaluator, update_interval=1, with_analysis=True, reward_method='lapanfix', checkpoint_interval=2, checkpoint_dir=checkpoint_dir)
+
+		set_seeds()
+		full_train = get_train(4, f"{location}/full")
+		full_net, _ = full_train.train(Model.create(ModelConfig()))
+
+		set_seeds()
+		get_train(3, f"{location}/stopped").train(Model.create(ModelConfig()))
+		resumed_train = get_train(4, f"{location}/stopped")
+		resumed_net, _ = resumed_train.train(Model.create(ModelConfig()), resume=True)
+
+		assert torch.equal(full_net.get_params(), resumed_net.get_params())
+		assert (full_train.train_losses == resumed_train.train_losses).all()
+		assert full_train.analysis.policy_entropies == resumed_train.analysis.policy_entropies
+
+	def test_adi_dedup(self):
+		# ADI with deduplication should give the same targets as evaluating all substates
+		net = Model.create(ModelConfig()).eval()
+		evaluator = Evaluator(2, max_time=.02, max_states=None, scrambling_depths=[2])
+		train = Train(rollouts=1, batch_size=4, tau=1, alpha_update=1, gamma=1, rollout_games=10, rollout_depth=4, optim_fn=torch.optim.Adam, agent=PolicySearch(None), lr=1e-5, evaluation_interval=0, evaluator=evaluator, update_interval=0, with_analysis=False, reward_method='paper')
+		torch.manual_seed(42)
+		_, policy_targets, value_targets, _ = train.ADI_traindata(net, 1)
+		# Each scrambled state has the previous state in the game as a substate, so there are always duplicates
+		assert train.dedup_ratio > 0
+
+		torch.manual_seed(42)
+		states, _ = tensor_cube.sequence_scrambler(10, 4, with_solved=False)
+		substates = tensor_cube.multi_rotate(states.repeat_interleave(cube.action_dim, dim=0), *tensor_cube.iter_actions(len(states)))
+		with torch.no_grad():
+			values = net(tensor_cube.as_oh(substates), policy=False).squeeze(1)
+		values = (values + torch.where(tensor_cube.multi_is_solved(substates), 1., -1.)).reshape(-1, cube.action_dim)
+		assert torch.allclose(values.max(dim=1).values, value_targets, atol=1e-5)
+		assert torch.equal(values.argmax(dim=1), policy_targets)
+
+
+	def test_distance_table(self):
+		# All substates are in the table, so the targets are the exact values
+		table = DistanceTable.build(3)
+		net = Model.create(ModelConfig()).eval()
+		evaluator = Evaluator(2, max_time=.02, max_states=None, scrambling_depths=[2])
+		train = Train(rollouts=1, batch_size=4, tau=1, alpha_update=1, gamma=1, rollout_games=10, rollout_depth=2, optim_fn=torch.optim.Adam, agent=PolicySearch(None), lr=1e-5, evaluation_interval=0, evaluator=evaluator, update_interval=0, with_analysis=False, reward_method='paper', distance_table=table)
+		torch.manual_seed(42)
+		_, policy_targets, value_targets, _ = train.ADI_traindata(net, 1)
+		torch.manual_seed(42)
+		states, _ = tensor_cube.sequence_scrambler(10, 2, with_solved=False)
+		distances = table.lookup(states)
+		# The solved state is one move from its substates, which have value 1, and the reward for not solving is -1
+		assert torch.equal(value_targets, torch.where(distances == 0, 0, 2 - distances).float())
+		substates = tensor_cube.multi_rotate(states.repeat_interleave(cube.action_dim, dim=0), *tensor_cube.iter_actions(len(states)))
+		chosen = substates.reshape(len(states), cube.action_dim, *cube.shape())[torch.arange(len(states)), policy_targets]
+		# The policy targets are optimal moves
+		assert torch.equal(table.lookup(chosen)[distances > 0], distances[distances > 0] - 1)
+
+	def test_feedforward_planner(self):
+		net = Model.create(ModelConfig()).eval()
+		oh_states = tensor_cube.sequence_scrambler(10, 10, with_solved=False)[1]
+		bytes_per_state = 4 * net.config.activation_size()
+		assert net.config.activation_size() == 2 * max(net.config.shared_sizes)
+		# The limit fits 7 states in each chunk, so the states are split into several chunks
+		planner = FeedforwardPlanner(memory_limit=int(7.5 * bytes_per_state / FeedforwardPlanner.memory_fraction))
+		assert planner.plan(net, len(oh_states), gpu) == 7
+		assert planner.plan(net, 3, gpu) == 3
+		with torch.no_grad():
+			assert torch.allclose(planner(net, oh_states), net(oh_states, policy=False).squeeze(1), atol=1e-5)
+		# Measured memory use lowers later plans
+		planner.measured_bytes = 2 * bytes_per_state
+		assert planner.plan(net, len(oh_states), gpu) == 3
+		assert FeedforwardPlanner().plan(net, 100, gpu) == 100
+
+	def test_depth_curriculum(self):
+		curriculum = DepthCurriculum(4)
+		assert np.allclose(curriculum.shares, 1/4) and curriculum.counts(10).sum() == 10
+		curriculum.update(np.array([1, 0, -1, -2.]))
+		curriculum.update(np.array([1, 0, -1, -1.]))
+		# Only the targets at the last depth changed, so it gets the largest share, but not more than max_ratio times the uniform share
+		assert curriculum.shares.argmax() == 3 and curriculum.shares[3] <= curriculum.max_ratio / 4
+		assert np.allclose(curriculum.shares[:3], curriculum.shares[0])
+		counts = curriculum.counts(101)
+		assert counts.sum() == 101 and counts[3] > counts[0]
+		# The cap holds after normalization, also when most of the change is at a few depths
+		curriculum = DepthCurriculum(10, uniform_share=0.1, max_ratio=2)
+		curriculum.update(np.zeros(10))
+		curriculum.update(np.array([5, 4, 0, 0, 0, 0, 0, 0, 0, 0.]))
+		assert curriculum.shares.max() <= curriculum.max_ratio / 10 + 1e-12
+		assert np.isclose(curriculum.shares.sum(), 1) and np.allclose(curriculum.shares[:2], curriculum.max_ratio / 10)
+		curriculum = DepthCurriculum(4)
+		curriculum.update(np.array([1, 0, -1, -2.]))
+		curriculum.update(np.array([1, 0, -1, -1.]))
+		# Depths without states keep their mean
+		curriculum.update(np.array([1, np.nan, -1, -1.]))
+		assert np.all(curriculum.mean_targets == [1, 0, -1, -1])
+
+		# The ADI states are taken at the positions given by the curriculum
+		net = Model.create(ModelConfig()).eval()
+		evaluator = Evaluator(2, max_time=.02, max_states=None, scrambling_depths=[2])
+		train = Train(rollouts=1, batch_size=4, tau=1, alpha_update=0, gamma=1, rollout_games=10, rollout_depth=4, optim_fn=torch.optim.Adam, agent=PolicySearch(None), lr=1e-5, evaluation_interval=0, evaluator=evaluator, update_interval=0, with_analysis=False, reward_method='paper', depth_curriculum=True)
+		train.curriculum = curriculum
+		expected_counts = curriculum.counts(40)
+		oh_states, _, value_targets, loss_weights = train.ADI_traindata(net, 0)
+		assert len(oh_states) == len(value_targets) == 40
+		assert torch.bincount(train.positions, minlength=4).cpu().numpy().tolist() == expected_counts.tolist()
+		weights = 1 / (train.positions + 1).float()
+		assert torch.allclose(loss_weights, weights / weights.sum() * (weights.sum() + len(weights)))
+		# No state is further from the solved state than its scrambling depth
+		states, positions = train._curriculum_scramble(expected_counts, False)
+		table = DistanceTable.build(4)
+		assert torch.equal(positions, train.positions)
+		assert (table.lookup(states) <= positions + 1).all() and (table.lookup(states) >= 0).all()
@@ -3,7 +3,9 @@ import torch
 import scipy
 
 def test_torch_version():
-	assert torch.__version__.startswith("1.5")
+	# Needed for bfloat16 autocast
+	v = torch.__version__.split(".")
+	assert (int(v[0]), int(v[1])) >= (1, 10)
 
 def test_python_version():
 	assert platform.architecture()[0] == "64bit"